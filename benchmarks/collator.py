@@ -0,0 +1,55 @@
+"""
+    Compare collation time when finding special tokens with a lookup tensor & with the tokenizer row by row.
+
+    python benchmarks/collator.py --transformer_name t5-small --mlm_probability 0.15
+"""
+import argparse
+import time
+import torch
+from transformers import AutoTokenizer
+
+from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding
+
+
+def tokenizer_special_tokens_mask(tokenizer, input_ids):
+    # how `mask_tokens` found special tokens before using `special_ids_lookup`
+    special_tokens_mask = [
+        tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in input_ids.tolist()
+    ]
+    return torch.tensor(special_tokens_mask, dtype=torch.bool)
+
+
+def milliseconds_per_batch(collator, examples, n_repeats, special_tokens_mask=None):
+    start = time.time()
+    for _ in range(n_repeats):
+        batch = collator._pad(examples)
+        mask = None if special_tokens_mask is None else special_tokens_mask(collator.tokenizer, batch["input_ids"])
+        collator.mask_tokens(batch["input_ids"], special_tokens_mask=mask)
+    return (time.time() - start) * 1_000 / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--transformer_name", default="t5-small")
+    parser.add_argument("--mlm_probability", type=float, default=0.15)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--seq_sizes", type=int, nargs="+", default=[60, 256, 1024])
+    parser.add_argument("--n_repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.transformer_name)
+    tokenizer.mask_token = tokenizer.unk_token
+    collator = DataCollatorForLanguageAutoencoding(tokenizer=tokenizer, mlm_probability=args.mlm_probability)
+
+    for seq_size in args.seq_sizes:
+        for batch_size in args.batch_sizes:
+            examples = [{"input_ids": row} for row in torch.randint(len(tokenizer), (batch_size, seq_size))]
+            lookup = milliseconds_per_batch(collator, examples, args.n_repeats)
+            rows = milliseconds_per_batch(collator, examples, args.n_repeats, tokenizer_special_tokens_mask)
+            print(
+                f"seq_size={seq_size} batch_size={batch_size}: lookup {lookup:.2f}ms/batch, row by row {rows:.2f}ms/batch"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+    Compare tokens/sec when generating from latent codes with & without the decoder's key/value cache.
+
+    python benchmarks/generation_cache.py --transformer_type t5 --transformer_name t5-small --max_length 60
+"""
+import argparse
+import time
+import torch
+
+from transformer_vae.train import CONFIG, MODEL
+
+
+def tokens_per_second(model, latents, batch_size, max_length, use_cache):
+    start = time.time()
+    sequences = model.decode_latents(
+        latents, batch_size=batch_size, min_length=max_length, max_length=max_length, use_cache=use_cache
+    ).sequences
+    return sequences.numel() / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--transformer_type", default="t5", choices=["t5", "funnel-t5", "funnel-gpt2"])
+    parser.add_argument("--transformer_name", default="t5-small")
+    parser.add_argument("--set_seq_size", type=int, default=60)
+    parser.add_argument("--latent_size", type=int, default=1_000)
+    parser.add_argument("--n_latents", type=int, default=32)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_length", type=int, default=60)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    config = CONFIG[args.transformer_type](
+        transformer_name=args.transformer_name,
+        set_seq_size=args.set_seq_size,
+        latent_size=args.latent_size,
+        encoder_model="n-tokens",
+        decoder_model="n-tokens",
+        n_latent_tokens=args.set_seq_size,
+    )
+    model = MODEL[args.transformer_type](config).to(args.device).eval()
+    latents = torch.randn(args.n_latents, config.latent_size, device=args.device)
+
+    # warm up
+    tokens_per_second(model, latents[:1], 1, 4, use_cache=True)
+    for use_cache in [False, True]:
+        speed = tokens_per_second(model, latents, args.batch_size, args.max_length, use_cache)
+        print(f"use_cache={use_cache}: {speed:.1f} tokens/sec")
+
+
+if __name__ == "__main__":
+    main()
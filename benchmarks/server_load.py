@@ -0,0 +1,109 @@
+"""
+    Load test a running Transformer-VAE server from many concurrent keep-alive connections.
+
+    python -m transformer_vae serve --model_path poet &
+    python benchmarks/server_load.py --endpoint encode --concurrency 64 --n_requests 2000
+
+    Compare `--max_batch_size 1` on the server to see the effect of micro-batching.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+
+TEXTS = [
+    "the quick brown fox",
+    "jumps over the lazy dog",
+    "a short poem about the sea",
+    "def add(a, b): return a + b",
+]
+
+
+def request_body(endpoint, latent_size):
+    if endpoint == "encode":
+        return {"texts": [random.choice(TEXTS)]}
+    if endpoint == "decode":
+        return {"latents": [[random.gauss(0, 1) for _ in range(latent_size)]]}
+    if endpoint == "interpolate":
+        return {"start": random.choice(TEXTS), "end": random.choice(TEXTS), "steps": 4}
+    return {"n": 1}
+
+
+async def http_request(reader, writer, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        key, value = line.decode().split(":", 1)
+        if key.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(args, latent_size, counter, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    while counter[0] < args.n_requests:
+        counter[0] += 1
+        start = time.perf_counter()
+        status, _ = await http_request(
+            reader, writer, "POST", f"/{args.endpoint}", request_body(args.endpoint, latent_size)
+        )
+        latencies.append((time.perf_counter() - start) * 1_000)
+        if status != 200:
+            errors.append(status)
+    writer.close()
+
+
+def percentile(values, percent):
+    return sorted(values)[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def load_test(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    latent_size = args.latent_size
+    if latent_size is None and args.endpoint == "decode":
+        _, sample = await http_request(reader, writer, "POST", "/sample", {"n": 1})
+        latent_size = len(sample["latents"][0])
+
+    counter, latencies, errors = [0], [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, latent_size, counter, latencies, errors) for _ in range(args.concurrency)])
+    duration = time.perf_counter() - start
+
+    print(
+        f"{len(latencies)} requests in {duration:.2f}s: {len(latencies) / duration:.1f} requests/sec, {len(errors)} errors"
+    )
+    print(
+        f"latency ms p50={percentile(latencies, 50):.1f} p90={percentile(latencies, 90):.1f} "
+        f"p99={percentile(latencies, 99):.1f}"
+    )
+    _, metrics = await http_request(reader, writer, "GET", "/metrics")
+    for name, batch_sizes in metrics["batch_sizes"].items():
+        print(f"{name} batch size mean={batch_sizes['mean']:.1f} p50={batch_sizes['p50']} p99={batch_sizes['p99']}")
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--endpoint", default="encode", choices=["encode", "decode", "interpolate", "sample"])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--n_requests", type=int, default=1_000)
+    parser.add_argument("--latent_size", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.new_event_loop().run_until_complete(load_test(args))
+
+
+if __name__ == "__main__":
+    main()
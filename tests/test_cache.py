@@ -0,0 +1,99 @@
+import threading
+import unittest
+import torch
+from torch import nn
+
+from transformer_vae.cache import CachedVAE, LRUCache
+from transformer_vae.model_outputs import DecodedLatents_Output
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_items=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(cache.stats()["hits"], 3)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_memory_bound(self):
+        cache = LRUCache(max_items=100, max_bytes=3 * 4 * 10)
+        for i in range(5):
+            cache.put(i, torch.zeros(10))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.n_bytes, 120)
+        cache.put("too big", torch.zeros(100))
+        self.assertNotIn("too big", cache)
+        self.assertEqual(len(cache), 3)
+
+    def test_threads(self):
+        cache = LRUCache(max_items=50)
+
+        def work(offset):
+            for i in range(1_000):
+                key = (offset + i) % 80
+                if cache.get(key) is None:
+                    cache.put(key, key)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        self.assertEqual(stats["hits"] + stats["misses"], 8_000)
+        self.assertEqual(stats["items"], 50)
+
+
+class CountingModel:
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.encoded, self.decoded = [], []
+
+    def encode_texts(self, texts, tokenizer, batch_size=64):
+        self.encoded += texts
+        return torch.tensor([[float(len(text)), 1.0] for text in texts])
+
+    def decode_latents(self, latents, tokenizer=None, batch_size=64, **generate_kwargs):
+        self.decoded.append(latents.size(0))
+        sequences = latents[:, :1].long().repeat(1, 3)
+        return DecodedLatents_Output(sequences=sequences, texts=[str(row) for row in sequences.tolist()])
+
+
+class QuantizableModel(CountingModel, nn.Module):
+    def __init__(self):
+        CountingModel.__init__(self)
+        nn.Module.__init__(self)
+        self.linear = nn.Linear(4, 4)
+        self.config = type("Config", (), {"to_json_string": lambda self: "{}"})()
+
+
+class CachedVAETests(unittest.TestCase):
+    def test_only_misses_are_run(self):
+        model = CountingModel()
+        cached = CachedVAE(model, tokenizer=None, fingerprint="abc")
+        first = cached.encode_texts(["a", "bb"])
+        second = cached.encode_texts(["bb", "ccc", "a"])
+        self.assertEqual(model.encoded, ["a", "bb", "ccc"])
+        self.assertTrue(torch.equal(second[0], first[1]))
+
+        cached.decode_latents(second, max_length=5)
+        cached.decode_latents(second[:2], max_length=5)
+        cached.decode_latents(second[:2], max_length=6)
+        cached.decode_latents(second[:2], max_length=6, do_sample=True)
+        self.assertEqual(model.decoded, [3, 2, 2])
+        stats = cached.stats()
+        self.assertEqual(stats["encode"]["hits"], 2)
+        self.assertEqual(stats["decode"]["hits"], 2)
+
+    def test_quantized_model_fingerprint(self):
+        model = QuantizableModel()
+        quantized = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        cached, quantized_cached = CachedVAE(model, tokenizer=None), CachedVAE(quantized, tokenizer=None)
+        self.assertNotEqual(cached.fingerprint, quantized_cached.fingerprint)
+        self.assertEqual(quantized_cached.fingerprint, CachedVAE(quantized, tokenizer=None).fingerprint)
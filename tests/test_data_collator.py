@@ -0,0 +1,55 @@
+import unittest
+import torch
+from transformers import AutoTokenizer
+
+from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding
+
+
+class DataCollatorTests(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = AutoTokenizer.from_pretrained("t5-small")
+        self.tokenizer.mask_token = self.tokenizer.unk_token
+        self.mask_id = self.tokenizer.unk_token_id
+
+    def test_special_ids_lookup(self):
+        collator = DataCollatorForLanguageAutoencoding(tokenizer=self.tokenizer, mlm_probability=0.15)
+        input_ids = torch.tensor([self.tokenizer("a sentence here").input_ids + [self.tokenizer.pad_token_id] * 2])
+        expected = self.tokenizer.get_special_tokens_mask(input_ids[0].tolist(), already_has_special_tokens=True)
+        self.assertEqual(collator.special_ids_lookup[input_ids][0].long().tolist(), expected)
+
+    def test_special_ids_lookup_matches_tokenizer(self):
+        # includes T5's `<extra_id_*>` sentinels, which the slow & fast tokenizers treat differently
+        for use_fast in [True, False]:
+            tokenizer = AutoTokenizer.from_pretrained("t5-small", use_fast=use_fast)
+            tokenizer.mask_token = tokenizer.unk_token
+            collator = DataCollatorForLanguageAutoencoding(tokenizer=tokenizer, mlm_probability=0.15)
+            vocab_ids = list(range(len(tokenizer)))
+            expected = tokenizer.get_special_tokens_mask(vocab_ids, already_has_special_tokens=True)
+            self.assertEqual(collator.special_ids_lookup.long().tolist(), expected)
+
+    def test_never_masks_special_tokens(self):
+        collator = DataCollatorForLanguageAutoencoding(tokenizer=self.tokenizer, mlm_probability=1.0)
+        input_ids = torch.full((64, 10), 100, dtype=torch.long)
+        input_ids[:, 5] = self.tokenizer.eos_token_id
+        input_ids[:, 6:] = self.tokenizer.pad_token_id
+        batch = collator([{"input_ids": row} for row in input_ids])
+        self.assertTrue(torch.equal(batch["input_ids"][:, 5:], input_ids[:, 5:]))
+        self.assertTrue((batch["labels"][:, 6:] == -100).all())
+        self.assertTrue(torch.equal(batch["labels"][:, :6], input_ids[:, :6]))
+        # most non-special tokens become the mask token, the rest are random words or unchanged
+        self.assertGreater((batch["input_ids"][:, :5] == self.mask_id).float().mean(), 0.7)
+
+    def test_mask_ratios(self):
+        torch.manual_seed(0)
+        collator = DataCollatorForLanguageAutoencoding(tokenizer=self.tokenizer, mlm_probability=0.5)
+        input_ids = torch.full((256, 256), 100, dtype=torch.long)
+        inputs, labels = collator.mask_tokens(input_ids.clone())
+        self.assertAlmostEqual((inputs == self.mask_id).float().mean().item(), 0.4, places=2)
+        self.assertAlmostEqual(((inputs != self.mask_id) & (inputs != 100)).float().mean().item(), 0.01, places=2)
+        self.assertTrue(torch.equal(labels, input_ids))
+
+    def test_no_masking(self):
+        collator = DataCollatorForLanguageAutoencoding(tokenizer=self.tokenizer, mlm_probability=0.0)
+        input_ids = torch.randint(3, 100, (4, 8))
+        batch = collator([{"input_ids": row} for row in input_ids])
+        self.assertTrue(torch.equal(batch["input_ids"], input_ids))
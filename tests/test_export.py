@@ -0,0 +1,92 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+import torch
+
+from transformer_vae.config import T5_VAE_Config
+from transformer_vae.export import export_graphs, graph_shapes
+from transformer_vae.model import T5_VAE_Model
+
+
+def eager_outputs(model, input_ids, decoder_input_ids):
+    latent = model.encode(input_ids)
+    with torch.no_grad():
+        decoder_outputs = model.transformer.decoder(
+            input_ids=decoder_input_ids, encoder_hidden_states=model.latent_to_encoding(latent), return_dict=True
+        )
+        logits = model.transformer.lm_head(
+            decoder_outputs.last_hidden_state * (model.config.transformer.d_model ** -0.5)
+        )
+    return latent, logits
+
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        config = T5_VAE_Config(
+            transformer_name="t5-small",
+            set_seq_size=8,
+            latent_size=32,
+            encoder_model="n-tokens",
+            decoder_model="n-tokens",
+            n_latent_tokens=2,
+        )
+        self.model = T5_VAE_Model(config).eval()
+        self.input_ids = torch.randint(2, 100, (3, 8))
+        self.decoder_input_ids = torch.randint(2, 100, (3, 4))
+        self.decoder_input_ids[:, 0] = self.model.decoder_start_token_id
+        self.shapes = graph_shapes(self.model, batch_size=3)
+
+    def empty_cache(self):
+        return torch.zeros(
+            self.shapes["n_layers"], 3, self.shapes["n_heads"], self.shapes["seq_size"], self.shapes["d_kv"]
+        )
+
+    def test_torchscript_matches_eager(self):
+        latent, logits = eager_outputs(self.model, self.input_ids, self.decoder_input_ids)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = export_graphs(self.model, tmp_dir, "torchscript")
+            encode, cross_cache, decode_step = [torch.jit.load(path) for path in paths]
+
+        traced_latent = encode(self.input_ids, self.input_ids.ne(0).long())
+        self.assertTrue(torch.allclose(traced_latent, latent, atol=1e-5))
+        # the cross-attention cache is made once & reused by every step
+        cross_keys, cross_values = cross_cache(traced_latent)
+        self.assertEqual(cross_keys.size(3), self.shapes["encoding_size"])
+        keys, values = self.empty_cache(), self.empty_cache()
+        for step in range(self.decoder_input_ids.size(1)):
+            step_logits, keys, values = decode_step(
+                self.decoder_input_ids[:, step : step + 1], torch.tensor(step), cross_keys, cross_values, keys, values
+            )
+            self.assertTrue(torch.allclose(step_logits, logits[:, step], atol=1e-4))
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime"), "Needs onnxruntime.")
+    def test_onnx_matches_eager(self):
+        import onnxruntime
+
+        latent, logits = eager_outputs(self.model, self.input_ids, self.decoder_input_ids)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = export_graphs(self.model, tmp_dir, "onnx")
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, "graph_shapes.json")))
+            encode, cross_cache, decode_step = [onnxruntime.InferenceSession(path) for path in paths]
+
+        (onnx_latent,) = encode.run(
+            None, {"input_ids": self.input_ids.numpy(), "attention_mask": self.input_ids.ne(0).long().numpy()}
+        )
+        self.assertTrue(torch.allclose(torch.from_numpy(onnx_latent), latent, atol=1e-5))
+        cross_keys, cross_values = cross_cache.run(None, {"latent": onnx_latent})
+        keys, values = self.empty_cache().numpy(), self.empty_cache().numpy()
+        for step in range(self.decoder_input_ids.size(1)):
+            step_logits, keys, values = decode_step.run(
+                None,
+                {
+                    "decoder_input_ids": self.decoder_input_ids[:, step : step + 1].numpy(),
+                    "step": torch.tensor(step).numpy(),
+                    "cross_keys": cross_keys,
+                    "cross_values": cross_values,
+                    "past_keys": keys,
+                    "past_values": values,
+                },
+            )
+            self.assertTrue(torch.allclose(torch.from_numpy(step_logits), logits[:, step], atol=1e-4))
@@ -0,0 +1,54 @@
+import unittest
+import torch
+
+from transformer_vae.config import T5_VAE_Config, Funnel_T5_VAE_Config, Funnel_gpt2_VAE_Config
+from transformer_vae.model import T5_VAE_Model, Funnel_T5_VAE_Model, Funnel_gpt2_VAE_Model
+
+
+class GenerationCacheTests(unittest.TestCase):
+    def assert_generate_uses_cache(self, model):
+        pasts = []
+        prepare_inputs = model.prepare_inputs_for_generation
+
+        def recording_prepare_inputs(input_ids, **kwargs):
+            inputs = prepare_inputs(input_ids, **kwargs)
+            pasts.append(inputs["past_key_values"])
+            return inputs
+
+        model.prepare_inputs_for_generation = recording_prepare_inputs
+        latent = torch.randn(2, model.config.latent_size)
+        # default arguments, nothing asks for the cache explicitly
+        model.generate(latent=latent, min_length=4, max_length=4)
+        self.assertTrue(model.config.use_cache)
+        self.assertIsNone(pasts[0])
+        self.assertGreater(len(pasts), 1)
+        self.assertTrue(all(past is not None for past in pasts[1:]))
+
+    def test_t5(self):
+        config = T5_VAE_Config(transformer_name="t5-small", set_seq_size=8, latent_size=32, n_latent_tokens=2)
+        self.assert_generate_uses_cache(T5_VAE_Model(config).eval())
+
+    def test_funnel_t5(self):
+        config = Funnel_T5_VAE_Config(
+            transformer_name="funnel-transformer/intermediate",
+            transformer_decoder_name="t5-base",
+            encoder_model="n-tokens",
+            decoder_model="n-tokens",
+            set_seq_size=8,
+            encoded_seq_size=2,
+            latent_size=8,
+            n_latent_tokens=8,
+        )
+        self.assert_generate_uses_cache(Funnel_T5_VAE_Model(config).eval())
+
+    def test_funnel_gpt2(self):
+        config = Funnel_gpt2_VAE_Config(
+            transformer_name="funnel-transformer/intermediate",
+            transformer_decoder_name="distilgpt2",
+            encoder_model="full-1st-token",
+            decoder_model="n-tokens",
+            set_seq_size=8,
+            latent_size=8,
+            n_latent_tokens=8,
+        )
+        self.assert_generate_uses_cache(Funnel_gpt2_VAE_Model(config).eval())
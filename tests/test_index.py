@@ -0,0 +1,94 @@
+import logging
+import os
+import tempfile
+import unittest
+import torch
+
+from transformer_vae.index import ExactIndex, IVFIndex, load_index
+from transformer_vae.latent_store import LatentStore, LatentStoreWriter
+
+logger = logging.getLogger()
+
+
+def clustered_latents(n_latents, latent_size, n_clusters=32, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centres = torch.randn(n_clusters, latent_size, generator=generator) * 3
+    assignments = torch.randint(n_clusters, (n_latents,), generator=generator)
+    return centres[assignments] + torch.randn(n_latents, latent_size, generator=generator)
+
+
+def brute_force(queries, latents, k):
+    return torch.cdist(queries, latents).topk(k, dim=1, largest=False).indices
+
+
+def recall(found, expected):
+    hits = sum(len(set(f) & set(e)) for f, e in zip(found.tolist(), expected.tolist()))
+    return hits / expected.numel()
+
+
+class ExactIndexTests(unittest.TestCase):
+    def test_matches_brute_force(self):
+        latents = clustered_latents(2_000, 16)
+        queries = clustered_latents(50, 16, seed=1)
+        index = ExactIndex(16, block_size=300)
+        # add incrementally
+        for chunk in latents.split(700):
+            index.add(chunk)
+        self.assertEqual(len(index), 2_000)
+        neighbours = index.search(queries, k=10)
+        self.assertEqual(recall(neighbours.row_ids, brute_force(queries, latents, 10)), 1.0)
+        self.assertTrue((neighbours.distances[:, 1:] >= neighbours.distances[:, :-1]).all())
+
+    def test_fewer_latents_than_k(self):
+        index = ExactIndex(4)
+        index.add(torch.randn(3, 4), row_ids=[7, 8, 9])
+        neighbours = index.search(torch.randn(2, 4), k=5)
+        self.assertEqual(sorted(neighbours.row_ids[0, :3].tolist()), [7, 8, 9])
+        self.assertEqual(neighbours.row_ids[0, 3:].tolist(), [-1, -1])
+
+
+class IVFIndexTests(unittest.TestCase):
+    def test_recall(self):
+        latents = clustered_latents(5_000, 16)
+        queries = clustered_latents(200, 16, seed=1)
+        expected = brute_force(queries, latents, 10)
+
+        index = IVFIndex(16, n_lists=64, n_probe=8)
+        index.train(latents[:2_000])
+        for chunk in latents.split(1_500):
+            index.add(chunk)
+        index_recall = recall(index.search(queries, k=10).row_ids, expected)
+        logger.info(f"IVF recall@10: {index_recall:.3f}")
+        self.assertGreater(index_recall, 0.9)
+
+        index.n_probe = 64
+        self.assertEqual(recall(index.search(queries, k=10).row_ids, expected), 1.0)
+
+    def test_add_before_train(self):
+        with self.assertRaises(ValueError):
+            IVFIndex(4, n_lists=2).add(torch.randn(3, 4))
+
+
+class SaveLoadTests(unittest.TestCase):
+    def test_round_trip_from_store(self):
+        latents = clustered_latents(500, 8)
+        queries = clustered_latents(20, 8, seed=1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with LatentStoreWriter(os.path.join(tmp_dir, "latents"), 8, shard_size=200) as writer:
+                writer.add(latents, row_ids=range(1_000, 1_500))
+            store = LatentStore(os.path.join(tmp_dir, "latents"))
+
+            exact = ExactIndex(8)
+            ivf = IVFIndex(8, n_lists=10, n_probe=3)
+            ivf.train(latents)
+            for index in [exact, ivf]:
+                index.add_store(store)
+                path = os.path.join(tmp_dir, "index.pt")
+                index.save(path)
+                loaded = load_index(path)
+                self.assertIsInstance(loaded, type(index))
+                self.assertTrue(torch.equal(loaded.search(queries).row_ids, index.search(queries).row_ids))
+            self.assertEqual(
+                exact.search(queries, k=1).row_ids.squeeze(1).tolist(),
+                (brute_force(queries, latents, 1).squeeze(1) + 1_000).tolist(),
+            )
@@ -0,0 +1,94 @@
+import unittest
+import torch
+
+from transformer_vae.config import T5_VAE_Config
+from transformer_vae.interpolation import bisect_paths, latent_grid, unique_steps
+from transformer_vae.model import T5_VAE_Model
+
+
+class LatentGridTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.start, self.end = torch.randn(5, 8), torch.randn(5, 8)
+
+    def test_linear(self):
+        grid = latent_grid(self.start, self.end, steps=4)
+        self.assertEqual(grid.shape, (5, 5, 8))
+        self.assertTrue(torch.allclose(grid[:, 0], self.start))
+        self.assertTrue(torch.allclose(grid[:, -1], self.end))
+        self.assertTrue(torch.allclose(grid[:, 2], (self.start + self.end) / 2))
+
+    def test_slerp(self):
+        end = self.end / self.end.norm(dim=1, keepdim=True) * self.start.norm(dim=1, keepdim=True)
+        grid = latent_grid(self.start, end, steps=4, method="slerp")
+        self.assertTrue(torch.allclose(grid[:, 0], self.start, atol=1e-5))
+        self.assertTrue(torch.allclose(grid[:, -1], end, atol=1e-5))
+        # equal norm ends stay on the sphere
+        self.assertTrue(torch.allclose(grid.norm(dim=2), self.start.norm(dim=1, keepdim=True).expand(5, 5), atol=1e-4))
+
+    def test_slerp_parallel_falls_back_to_linear(self):
+        grid = latent_grid(self.start, 2 * self.start, steps=2, method="slerp")
+        self.assertTrue(torch.allclose(grid[:, 1], 1.5 * self.start, atol=1e-5))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            latent_grid(self.start, self.end, steps=0)
+        with self.assertRaises(ValueError):
+            latent_grid(self.start, self.end, method="cubic")
+
+    def test_unique_steps(self):
+        self.assertEqual(unique_steps(["a", "a", "b", "a", "c", "c"]), [0, 2, 4])
+
+
+class BisectPathsTests(unittest.TestCase):
+    def test_finds_changes(self):
+        decodes = []
+
+        def decode(latents):
+            decodes.append(latents.size(0))
+            # 4 plateaus along the 1st dimension
+            return (latents[:, 0] * 4).floor().clamp(max=3).long().tolist()
+
+        start, end = torch.zeros(2, 3), torch.zeros(2, 3)
+        end[0, 0] = 1
+        paths, n_decodes = bisect_paths(start, end, decode, resolution=1 / 64)
+        self.assertEqual(sum(decodes), n_decodes)
+        self.assertEqual(list(paths[1].items()), [(0.0, 0), (1.0, 0)])
+        self.assertEqual(sorted(set(paths[0].values())), [0, 1, 2, 3])
+        self.assertEqual(list(paths[0].values()), sorted(paths[0].values()))
+        ratios = list(paths[0].keys())
+        self.assertEqual(ratios, sorted(ratios))
+        # changes are found to within the resolution
+        for boundary in [0.25, 0.5, 0.75]:
+            self.assertTrue(any(abs(ratio - boundary) <= 1 / 64 for ratio in ratios))
+        self.assertLess(n_decodes, 2 * 65)
+
+
+class ModelInterpolateTests(unittest.TestCase):
+    def test_interpolate(self):
+        torch.manual_seed(0)
+        config = T5_VAE_Config(transformer_name="t5-small", set_seq_size=8, latent_size=32, n_latent_tokens=2)
+        model = T5_VAE_Model(config).eval()
+        start, end = torch.randn(3, 32), torch.randn(3, 32)
+        result = model.interpolate(start, end, steps=4, method="slerp", batch_size=4, max_length=5)
+        self.assertEqual(result.latents.shape, (3, 5, 32))
+        self.assertEqual(result.sequences.shape[:2], (3, 5))
+        self.assertEqual(result.ratios.tolist(), [0.0, 0.25, 0.5, 0.75, 1.0])
+        for path, steps in zip(result.sequences, result.unique_steps):
+            self.assertEqual(steps[0], 0)
+            self.assertEqual(len(steps), len(set(map(tuple, path.tolist()))))
+        single = model.decode_latents(result.latents[1, 2:3], max_length=5).sequences[0]
+        self.assertTrue(torch.equal(result.sequences[1, 2, : single.size(0)], single))
+
+    def test_interpolate_adaptive(self):
+        torch.manual_seed(0)
+        config = T5_VAE_Config(transformer_name="t5-small", set_seq_size=8, latent_size=32, n_latent_tokens=2)
+        model = T5_VAE_Model(config).eval()
+        start, end = torch.randn(2, 32), torch.randn(2, 32)
+        result = model.interpolate_adaptive(start, end, resolution=1 / 8, batch_size=4, max_length=5)
+        self.assertEqual(result.n_uniform_decodes, 2 * 9)
+        self.assertEqual(result.n_decodes_saved, result.n_uniform_decodes - result.n_decodes)
+        self.assertEqual(result.n_decodes, sum(len(ratios) for ratios in result.ratios))
+        for ratios, sequences, change_ratios in zip(result.ratios, result.sequences, result.change_ratios):
+            self.assertEqual((ratios[0], ratios[-1], change_ratios[0]), (0.0, 1.0, 0.0))
+            self.assertEqual(len(change_ratios), 1 + sum(a != b for a, b in zip(sequences, sequences[1:])))
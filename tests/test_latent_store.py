@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import torch
+
+from transformer_vae.latent_store import LatentStore, LatentStoreWriter
+
+
+class LatentStoreTests(unittest.TestCase):
+    def test_write_read_append(self):
+        latents = torch.randn(25, 6)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with LatentStoreWriter(tmp_dir, 6, shard_size=10, fingerprint="abc") as writer:
+                writer.add(latents[:7])
+                writer.add(latents[7:20])
+            with LatentStoreWriter(tmp_dir, 6, shard_size=10, fingerprint="abc") as writer:
+                writer.add(latents[20:], row_ids=range(100, 105))
+
+            store = LatentStore(tmp_dir)
+            self.assertEqual(len(store), 25)
+            self.assertEqual(store.n_shards, 3)
+            self.assertEqual(store.fingerprint, "abc")
+            self.assertTrue(np.array_equal(store.numpy(), latents.numpy()))
+            self.assertEqual(store.row_ids().tolist(), list(range(20)) + list(range(100, 105)))
+            self.assertTrue(torch.equal(torch.from_numpy(store[13]), latents[13]))
+            self.assertTrue(torch.equal(store.shard_tensor(1), latents[10:20]))
+
+    def test_views_are_not_copies(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with LatentStoreWriter(tmp_dir, 4, dtype="float16") as writer:
+                writer.add(np.ones((3, 4), dtype=np.float32))
+            store = LatentStore(tmp_dir)
+            latents, _ = store.shard(0)
+            self.assertIsInstance(latents.base, np.memmap)
+            self.assertEqual(latents.dtype, np.float16)
+            self.assertEqual(store.shard_tensor(0).data_ptr(), latents.ctypes.data)
+
+    def test_mismatched_append(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with LatentStoreWriter(tmp_dir, 4, fingerprint="abc") as writer:
+                writer.add(np.zeros((2, 4)))
+            with self.assertRaises(ValueError):
+                LatentStoreWriter(tmp_dir, 4, fingerprint="other")
+
+    def test_last_shard_is_cut_to_its_rows(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with LatentStoreWriter(tmp_dir, 4, shard_size=1000) as writer:
+                writer.add(np.ones((3, 4)))
+            with LatentStoreWriter(tmp_dir, 4, shard_size=1000) as writer:
+                writer.add(np.zeros((2, 4)))
+            store = LatentStore(tmp_dir)
+            self.assertEqual([shard["n_rows"] for shard in store.manifest["shards"]], [3, 2])
+            self.assertEqual(np.load(os.path.join(tmp_dir, store.manifest["shards"][0]["latents"])).shape, (3, 4))
+            self.assertEqual(store.numpy().tolist(), [[1] * 4] * 3 + [[0] * 4] * 2)
+
+    def test_empty_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            LatentStoreWriter(tmp_dir, 4, dtype="float16").close()
+            store = LatentStore(tmp_dir)
+            self.assertEqual(len(store), 0)
+            self.assertEqual(store.numpy().shape, (0, 4))
+            self.assertEqual(store.numpy().dtype, np.float16)
+            self.assertEqual(store.row_ids().dtype, np.int64)
@@ -0,0 +1,147 @@
+import logging
+import os
+import tempfile
+import unittest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from transformer_vae.mmd import MMD_KERNELS, MMD_ESTIMATORS, GaussianKernel, compute_mmd, kernel_sum, all_gather_latents
+from transformer_vae.latent_queue import LatentQueue
+
+logger = logging.getLogger()
+
+
+def tiled_gaussian_mmd(x, y):
+    # The original `EncoderDecoderVAE._compute_kernel` implementation.
+    def kernel(a, b):
+        a_size, b_size, dim = a.shape[0], b.shape[0], a.shape[1]
+        tiled_a = a.view(a_size, 1, dim).repeat(1, b_size, 1)
+        tiled_b = b.view(1, b_size, dim).repeat(a_size, 1, 1)
+        return torch.exp(-torch.mean((tiled_a - tiled_b) ** 2, dim=2) / dim * 1.0)
+
+    return torch.mean(kernel(x, x)) + torch.mean(kernel(y, y)) - 2 * torch.mean(kernel(x, y))
+
+
+class KernelEngineTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.x = torch.randn(50, 16, dtype=torch.float64)
+        self.y = torch.rand(40, 16, dtype=torch.float64)
+
+    def test_gaussian_matches_tiled_kernel(self):
+        self.assertAlmostEqual(
+            compute_mmd(self.x, self.y, GaussianKernel()).item(), tiled_gaussian_mmd(self.x, self.y).item(), places=10
+        )
+
+    def test_blocks_match_full_kernel(self):
+        for kernel_class in MMD_KERNELS.values():
+            kernel = kernel_class()
+            self.assertAlmostEqual(
+                kernel_sum(self.x, self.y, kernel, block_size=7).item(), kernel_sum(self.x, self.y, kernel).item()
+            )
+
+    def test_mmd_is_zero_for_same_samples(self):
+        for kernel_class in MMD_KERNELS.values():
+            self.assertAlmostEqual(compute_mmd(self.x, self.x, kernel_class(), block_size=16).item(), 0.0, places=10)
+
+
+class ApproximateMMDTests(unittest.TestCase):
+    def test_approximation_error(self):
+        torch.manual_seed(0)
+        x = torch.randn(4_096, 8, dtype=torch.float64)
+        y = torch.randn(4_096, 8, dtype=torch.float64) * 0.5 + 0.5
+        for kernel_name, kernel_class in MMD_KERNELS.items():
+            kernel = kernel_class()
+            exact = MMD_ESTIMATORS["exact"](kernel, block_size=1_024)(x, y).item()
+            for estimator_name in ["linear", "block", "rff"]:
+                estimator = MMD_ESTIMATORS[estimator_name](kernel, n_features=4_096, estimator_block_size=64)
+                estimate = estimator(x, y).item()
+                relative_error = abs(estimate - exact) / exact
+                logger.info(f"{kernel_name} {estimator_name} MMD relative error: {relative_error:.4f}")
+                self.assertLess(relative_error, 0.15, f"{kernel_name} kernel with {estimator_name} estimator.")
+
+    def test_gradients_flow(self):
+        x = torch.randn(64, 8, requires_grad=True)
+        for estimator_class in MMD_ESTIMATORS.values():
+            x.grad = None
+            estimator_class(GaussianKernel(), n_features=128, estimator_block_size=16)(torch.randn(64, 8), x).backward()
+            self.assertTrue(x.grad.abs().sum() > 0)
+
+    def test_block_size_is_separate(self):
+        x, y = torch.randn(256, 8, dtype=torch.float64), torch.randn(256, 8, dtype=torch.float64)
+        kernel = GaussianKernel()
+        tiled = MMD_ESTIMATORS["block"](kernel, block_size=1_024)(x, y)
+        self.assertEqual(tiled.item(), MMD_ESTIMATORS["block"](kernel, estimator_block_size=32)(x, y).item())
+        self.assertNotEqual(tiled.item(), MMD_ESTIMATORS["block"](kernel, estimator_block_size=256)(x, y).item())
+
+
+class GroupedMMDTests(unittest.TestCase):
+    def test_grouped_matches_loop(self):
+        torch.manual_seed(0)
+        kernel = GaussianKernel()
+        estimator = MMD_ESTIMATORS["exact"](kernel)
+        for n_samples in [12, 14]:
+            x = torch.randn(n_samples, 6, dtype=torch.float64)
+            y = torch.rand(n_samples, 6, dtype=torch.float64)
+            looped = sum(compute_mmd(x[i : i + 4], y[i : i + 4], kernel) for i in range(0, n_samples, 4))
+            self.assertAlmostEqual(estimator.grouped(x, y, 4).item(), looped.item(), places=10)
+
+
+class LatentQueueTests(unittest.TestCase):
+    def test_ring_buffer(self):
+        queue = LatentQueue(n_batches=2)
+        self.assertEqual(queue.latents().size(0), 0)
+        for batch_size in [3, 2, 4]:
+            queue.add(torch.full((batch_size, 5), float(batch_size)))
+        # first batch sets capacity to 6, the last batch wraps around overwriting the oldest
+        self.assertEqual([row[0] for row in queue.latents().tolist()], [4.0, 4.0, 4.0, 2.0, 2.0, 4.0])
+        queue.add(torch.full((1, 5), 1.0))
+        queue.latents()
+        self.assertEqual(queue.queue.data_ptr(), queue.latents().data_ptr())
+
+        restored = LatentQueue(n_batches=2)
+        restored.load_state_dict(queue.state_dict())
+        self.assertTrue(torch.equal(restored.latents(), queue.latents()))
+        restored.add(torch.full((1, 5), 7.0))
+        queue.add(torch.full((1, 5), 7.0))
+        self.assertTrue(torch.equal(restored.latents(), queue.latents()))
+
+    def test_read_in_place_during_backward(self):
+        queue = LatentQueue(n_batches=3)
+        estimator = MMD_ESTIMATORS["exact"](GaussianKernel())
+        for batch_size in [4, 4, 3, 4]:
+            latent = torch.randn(batch_size, 5, requires_grad=True)
+            prev_latents = queue.latents()
+            combined = (latent, prev_latents) if prev_latents.size(0) else latent
+            loss = estimator(torch.randn(batch_size + prev_latents.size(0), 5), combined)
+            queue.add(latent)
+            loss.backward()
+        self.assertEqual(queue.latents().size(0), 12)
+
+
+def _rank_latent(rank):
+    return torch.arange((rank + 2) * 3, dtype=torch.float64).view(rank + 2, 3) + 100 * rank
+
+
+def _distributed_mmd_worker(rank, world_size, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    latent = _rank_latent(rank).requires_grad_()
+    gathered = all_gather_latents(latent)
+    all_latents = torch.cat([_rank_latent(i) for i in range(world_size)])
+    assert torch.equal(gathered.detach(), all_latents)
+
+    (gathered ** 2).sum().backward()
+    # only the local shard gets gradients, scaled for DDP's gradient averaging
+    assert torch.equal(latent.grad, 2 * latent.detach() * world_size)
+    dist.destroy_process_group()
+
+
+class DistributedMMDTests(unittest.TestCase):
+    def test_all_gather_latents(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mp.spawn(_distributed_mmd_worker, args=(3, os.path.join(tmp_dir, "init")), nprocs=3, join=True)
+
+    def test_no_op_without_process_group(self):
+        latent = torch.randn(4, 3)
+        self.assertIs(all_gather_latents(latent), latent)
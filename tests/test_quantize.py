@@ -0,0 +1,44 @@
+import tempfile
+import unittest
+import torch
+from torch import nn
+
+from transformer_vae.config import T5_VAE_Config
+from transformer_vae.model import T5_VAE_Model
+from transformer_vae.utils import checkpoint_fingerprint
+
+
+class QuantizeTests(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        config = T5_VAE_Config(transformer_name="t5-small", set_seq_size=8, latent_size=32, n_latent_tokens=2)
+        self.model = T5_VAE_Model(config).eval()
+        self.input_ids = torch.randint(2, 100, (3, 8))
+
+    def test_quantizes_linear_layers(self):
+        quantized = self.model.quantize()
+        self.assertIsInstance(self.model.vae.encoder.shrink_sequence, nn.Linear)
+        self.assertIsInstance(quantized.vae.encoder.shrink_sequence, torch.nn.quantized.dynamic.Linear)
+        self.assertIsInstance(quantized.vae.decoder.grow_sequence, torch.nn.quantized.dynamic.Linear)
+        self.assertIsInstance(
+            quantized.transformer.encoder.block[0].layer[0].SelfAttention.q, torch.nn.quantized.dynamic.Linear
+        )
+        latent, quantized_latent = self.model.encode(self.input_ids), quantized.encode(self.input_ids)
+        self.assertEqual(quantized_latent.shape, latent.shape)
+        self.assertLess((quantized_latent - latent).norm(dim=1).mean().item(), 0.5 * latent.norm(dim=1).mean().item())
+
+    def test_save_load_quantized(self):
+        quantized = self.model.quantize()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            quantized.save_quantized(tmp_dir)
+            loaded = T5_VAE_Model.from_quantized(tmp_dir)
+        self.assertTrue(torch.equal(loaded.encode(self.input_ids), quantized.encode(self.input_ids)))
+
+    def test_fingerprint_quantized(self):
+        quantized = self.model.quantize()
+        fingerprint = checkpoint_fingerprint(quantized)
+        self.assertEqual(fingerprint, checkpoint_fingerprint(quantized))
+        self.assertNotEqual(fingerprint, checkpoint_fingerprint(self.model))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            quantized.save_quantized(tmp_dir)
+            self.assertEqual(checkpoint_fingerprint(T5_VAE_Model.from_quantized(tmp_dir)), fingerprint)
@@ -0,0 +1,33 @@
+import pickle
+import tempfile
+import unittest
+
+from transformer_vae.sample_reader import MultilineSampleReader, index_samples
+
+
+class SampleReaderTests(unittest.TestCase):
+    def test_index_samples(self):
+        text = b"1\n<|endoftext|>\n2\n2\n <|endoftext|> \r\n\n<|endoftext|>\na <|endoftext|> b\n<|endoftext|>"
+        offsets = index_samples(text)
+        self.assertEqual([text[start:end].strip() for start, end in offsets], [b"1", b"2\n2", b"a <|endoftext|> b"])
+        self.assertEqual(index_samples(b"").shape, (0, 2))
+
+    def test_reader(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            reader = MultilineSampleReader("./tests/fixtures/multiline_max_len_4.txt", cache_dir=cache_dir)
+            self.assertEqual(len(reader), 9)
+            self.assertEqual(reader[1], "2\n2")
+            self.assertEqual(reader[-1], "999")
+            self.assertEqual(reader.texts(7, 20), ["8\n8", "999"])
+
+            # workers re-open the file & load the cached index
+            unpickled = pickle.loads(pickle.dumps(reader))
+            self.assertEqual(unpickled.texts(0, 3), ["1", "2\n2", "333"])
+            reader.close()
+            unpickled.close()
+
+    def test_empty_file(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            reader = MultilineSampleReader("./tests/fixtures/empty.txt", cache_dir=cache_dir)
+            self.assertEqual(len(reader), 0)
+            self.assertEqual(reader.texts(0, 10), [])
@@ -0,0 +1,50 @@
+import unittest
+import torch
+from transformers import AutoTokenizer
+
+from transformer_vae.data_collator import DynamicPaddingDataCollatorForLanguageAutoencoding
+from transformer_vae.sampler import LengthGroupedSampler, length_grouped_batches, padding_stats
+
+
+class LengthGroupedSamplerTests(unittest.TestCase):
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.lengths = torch.randint(1, 60, (1_003,), generator=generator).tolist()
+
+    def test_batches_group_lengths(self):
+        batches = length_grouped_batches(self.lengths, batch_size=8, mega_batch_mult=10)
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(len(self.lengths))))
+        self.assertTrue(all(len(batch) == 8 for batch in batches[:-1]))
+        self.assertEqual(len(batches[-1]), 3)
+        stats = padding_stats(self.lengths, batches, max_length=60)
+        unsorted_batches = [list(range(i, min(i + 8, 1_003))) for i in range(0, 1_003, 8)]
+        random_stats = padding_stats(self.lengths, unsorted_batches, max_length=60)
+        self.assertEqual(stats["tokens"], sum(self.lengths))
+        self.assertLess(stats["dynamic_pad_tokens"], random_stats["dynamic_pad_tokens"] / 4)
+        self.assertLess(random_stats["dynamic_pad_tokens"], random_stats["fixed_pad_tokens"])
+
+    def test_epochs_differ(self):
+        sampler = LengthGroupedSampler(self.lengths, batch_size=8, max_length=60)
+        first, second = list(sampler), list(sampler)
+        self.assertEqual(len(first), len(sampler))
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(first), sorted(second))
+        self.assertGreater(sampler.last_padding_stats["pad_token_reduction"], 0.5)
+
+
+class DynamicPaddingCollatorTests(unittest.TestCase):
+    def test_pads_to_longest(self):
+        tokenizer = AutoTokenizer.from_pretrained("t5-small")
+        tokenizer.mask_token = tokenizer.unk_token
+        collator = DynamicPaddingDataCollatorForLanguageAutoencoding(
+            tokenizer=tokenizer, mlm_probability=0.0, min_length=4
+        )
+        examples = [tokenizer(text, return_length=True) for text in ["a", "a b"]]
+        batch = collator(examples)
+        self.assertEqual(batch["input_ids"].shape, (2, 4))
+        self.assertEqual(
+            batch["attention_mask"].sum(dim=1).tolist(), [len(example["input_ids"]) for example in examples]
+        )
+        self.assertEqual(batch["labels"][0, -1].item(), -100)
+        long_examples = examples + [tokenizer("a b c d e f g", return_length=True)]
+        self.assertEqual(collator(long_examples)["input_ids"].size(1), len(long_examples[-1]["input_ids"]))
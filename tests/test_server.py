@@ -0,0 +1,131 @@
+import asyncio
+import json
+import time
+import unittest
+from types import SimpleNamespace
+
+from transformer_vae.server import Histogram, MicroBatcher, VAE_Server
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class MicroBatcherTests(unittest.TestCase):
+    def test_batches_concurrent_items(self):
+        batches = []
+
+        def double(items):
+            batches.append(list(items))
+            return [item * 2 for item in items]
+
+        async def submit_all():
+            batch_sizes = Histogram([1, 2, 4, 8])
+            batcher = MicroBatcher(double, max_batch_size=4, max_delay=0.05, batch_sizes=batch_sizes)
+            batcher.start()
+            results = await asyncio.gather(*[batcher.submit(i) for i in range(10)])
+            await batcher.stop()
+            return results, batch_sizes
+
+        results, batch_sizes = run(submit_all())
+        self.assertEqual(results, [i * 2 for i in range(10)])
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        self.assertEqual(batch_sizes.count, 3)
+
+    def test_delay_starts_at_submit(self):
+        def slow_first_batch(items):
+            if items == ["first"]:
+                time.sleep(0.3)
+            return items
+
+        async def submit():
+            loop = asyncio.get_event_loop()
+            batcher = MicroBatcher(slow_first_batch, max_batch_size=4, max_delay=0.2)
+            batcher.start()
+            first = asyncio.ensure_future(batcher.submit("first"))
+            await asyncio.sleep(0.25)
+            # queued behind the running batch, it has waited out its delay by the time that batch finishes
+            submitted_at = loop.time()
+            await batcher.submit("second")
+            waited = loop.time() - submitted_at
+            await first
+            await batcher.stop()
+            return waited
+
+        self.assertLess(run(submit()), 0.35)
+
+    def test_errors_reach_every_request(self):
+        def fail(items):
+            raise RuntimeError("bad batch")
+
+        async def submit():
+            batcher = MicroBatcher(fail, max_batch_size=2, max_delay=0.01)
+            batcher.start()
+            results = await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+            await batcher.stop()
+            return results
+
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in run(submit())))
+
+
+class HistogramTests(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram([1, 10, 100])
+        for value in [0.5] * 50 + [5] * 40 + [50] * 9 + [500]:
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(90), 10)
+        self.assertEqual(histogram.percentile(99), 100)
+        self.assertEqual(histogram.percentile(100), float("inf"))
+
+
+class ServerHTTPTests(unittest.TestCase):
+    def test_keep_alive_requests(self):
+        async def requests():
+            server = VAE_Server(model=None, tokenizer=None)
+            await server.start(port=0)
+            port = server._server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            responses = []
+            for method, path in [("GET", "/health"), ("POST", "/missing"), ("GET", "/metrics")]:
+                writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n".encode())
+                status = (await reader.readline()).split()[1]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line == b"\r\n":
+                        break
+                    key, value = line.decode().split(":", 1)
+                    headers[key.lower()] = value.strip()
+                body = await reader.readexactly(int(headers["content-length"]))
+                responses.append((int(status), json.loads(body)))
+            writer.close()
+            await server.close()
+            return responses
+
+        health, missing, metrics = run(requests())
+        self.assertEqual(health, (200, {"status": "ok"}))
+        self.assertEqual(missing[0], 404)
+        self.assertEqual(metrics[1]["requests"], {"/health": 1, "/metrics": 1})
+        self.assertEqual(metrics[1]["latency_ms"]["/health"]["count"], 1)
+
+    def test_invalid_requests_are_rejected_before_batching(self):
+        server = VAE_Server(model=SimpleNamespace(config=SimpleNamespace(latent_size=2)), tokenizer=None)
+        for path, request in [
+            ("/decode", {"latents": [[0.5, "a"]]}),
+            ("/decode", {"latents": [[0.5, float("nan")]]}),
+            ("/decode", {"latents": [[0.5, True]]}),
+            ("/decode", {"latents": [{"a": 1, "b": 2}]}),
+            ("/sample", {"n": -1}),
+            ("/sample", {"n": 10 ** 9}),
+            ("/sample", {"n": 1.5}),
+            ("/interpolate", {"start": [0, 1], "end": [1, 0], "steps": 0}),
+        ]:
+            # no batchers are started, so reaching one would fail with a 500
+            status, payload = run(server._respond("POST", path, json.dumps(request).encode()))
+            self.assertEqual(status, 400, payload)
+        self.assertEqual(server.metrics.errors["/decode"], 4)
@@ -0,0 +1,87 @@
+import tempfile
+import unittest
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+
+from transformer_vae.data_collator import (
+    DataCollatorForLanguageAutoencoding,
+    DynamicPaddingDataCollatorForLanguageAutoencoding,
+)
+from transformer_vae.token_store import TokenStore, TokenStoreWriter, token_dtype
+
+
+class TokenStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.rows = [[i + 1] * (i % 5 + 1) for i in range(23)]
+
+    def test_write_read(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with TokenStoreWriter(tmp_dir, seq_size=6, vocab_size=32_128, shard_size=10) as writer:
+                writer.add(self.rows[:7])
+                writer.add(self.rows[7:], n_tokens=[9] + [len(row) for row in self.rows[8:]])
+            store = TokenStore(tmp_dir)
+            self.assertEqual(len(store), 23)
+            self.assertEqual(len(store.manifest["shards"]), 3)
+            self.assertEqual(store.lengths().tolist(), [len(row) for row in self.rows])
+            self.assertEqual(store.n_tokens_histogram[9], 1)
+            self.assertEqual(store[12]["input_ids"].tolist(), [13, 13, 13, 0, 0, 0])
+            self.assertEqual(store[-1]["input_ids"].dtype, torch.int16)
+
+            trimmed = TokenStore(tmp_dir, trim=True)
+            self.assertEqual(trimmed[12]["input_ids"].tolist(), [13, 13, 13])
+            self.assertEqual(trimmed[12]["length"], 3)
+            with self.assertRaises(ValueError):
+                TokenStoreWriter(tmp_dir, seq_size=6, vocab_size=32_128)
+
+    def test_rows_are_views(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with TokenStoreWriter(tmp_dir, seq_size=4, vocab_size=50_257) as writer:
+                writer.add([[50_000, 1], [2]])
+            store = TokenStore(tmp_dir)
+            tokens, _ = store._shards[0]
+            self.assertIsInstance(tokens.base, np.memmap)
+            self.assertEqual(store[1]["input_ids"].data_ptr(), tokens[1].ctypes.data)
+            self.assertEqual(store[0]["input_ids"].tolist(), [50_000, 1, 0, 0])
+            with self.assertRaises(ValueError):
+                TokenStoreWriter(tmp_dir + "/long", seq_size=1, vocab_size=10).add([[1, 2]])
+
+    def test_empty_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            TokenStoreWriter(tmp_dir, seq_size=6, vocab_size=32_128).close()
+            store = TokenStore(tmp_dir)
+            self.assertEqual(len(store), 0)
+            self.assertEqual(store.lengths().shape, (0,))
+            self.assertEqual(store.lengths().dtype, np.int32)
+            self.assertEqual(store._column(0).shape, (0, 6))
+            self.assertEqual(store._column(0).dtype, np.int16)
+            with self.assertRaises(IndexError):
+                store[0]
+
+    def test_token_dtype(self):
+        self.assertEqual(token_dtype(32_128), "int16")
+        self.assertEqual(token_dtype(2 ** 15), "int16")
+        self.assertEqual(token_dtype(50_257), "int32")
+
+    def test_collators(self):
+        tokenizer = AutoTokenizer.from_pretrained("t5-small")
+        tokenizer.mask_token = tokenizer.unk_token
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with TokenStoreWriter(tmp_dir, seq_size=6, vocab_size=len(tokenizer)) as writer:
+                writer.add(self.rows[:3])
+            fixed = DataCollatorForLanguageAutoencoding(tokenizer=tokenizer, mlm_probability=0.0)
+            batch = fixed([TokenStore(tmp_dir)[i] for i in range(3)])
+            self.assertEqual(batch["input_ids"].dtype, torch.long)
+            self.assertEqual(batch["input_ids"].shape, (3, 6))
+            self.assertEqual(batch["attention_mask"].sum(dim=1).tolist(), [1, 2, 3])
+            # matches the mask of the same rows collated from a tokenized dataset
+            tokenized = [tokenizer.pad({"input_ids": row}, padding="max_length", max_length=6) for row in self.rows[:3]]
+            self.assertTrue(torch.equal(batch["attention_mask"], fixed(tokenized)["attention_mask"]))
+
+            dynamic = DynamicPaddingDataCollatorForLanguageAutoencoding(
+                tokenizer=tokenizer, mlm_probability=0.0, min_length=2
+            )
+            batch = dynamic([TokenStore(tmp_dir, trim=True)[i] for i in range(3)])
+            self.assertEqual(batch["input_ids"].tolist(), [[1, 0, 0], [2, 2, 0], [3, 3, 3]])
+            self.assertEqual(batch["attention_mask"].sum(dim=1).tolist(), [1, 2, 3])
+            self.assertEqual(batch["labels"][0].tolist(), [1, -100, -100])
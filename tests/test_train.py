@@ -1,10 +1,16 @@
+import collections
 import logging
+import os
 import sys
+import unittest
 from unittest.mock import patch
 import torch
+from datasets import Dataset
 from transformers.testing_utils import TestCasePlus, torch_device
 
-from transformer_vae.train import main
+from transformer_vae.train import length_histogram, length_stats, main
+from transformer_vae import encode, prepare
+from transformer_vae.latent_store import LatentStore
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -77,6 +83,38 @@ class TrainTests(TestCasePlus):
             result = main()
             self.assertAlmostEqual(result["epoch"], 2.0)
 
+    def test_train_multiline_txt(self):
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        testargs = f"""
+            train.py
+            --train_file ./tests/fixtures/multiline_max_len_4.txt
+            --validation_file ./tests/fixtures/multiline_max_len_4.txt
+            --multiline_samples
+            --preprocessing_batch_size 3
+            --preprocessing_num_workers 2
+            --do_train
+            --do_eval
+            --per_device_train_batch_size 5
+            --per_device_eval_batch_size 5
+            --num_train_epochs 2
+            --set_seq_size 5
+            --latent_size 2
+            --transformer_name t5-small
+            --output_dir {tmp_dir}
+            --overwrite_output_dir
+            """.split()
+
+        if torch.cuda.device_count() > 1:
+            # Skipping because there are not enough batches to train the model + would need a drop_last to work.
+            return
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            result = main()
+            self.assertAlmostEqual(result["epoch"], 2.0)
+
     def test_train_json(self):
         stream_handler = logging.StreamHandler(sys.stdout)
         logger.addHandler(stream_handler)
@@ -216,6 +254,129 @@ class TrainTests(TestCasePlus):
             result = main()
             self.assertAlmostEqual(result["epoch"], 2.0)
 
+    def test_train_n_tokens_dynamic_padding(self):
+        stream_handler = logging.StreamHandler(sys.stdout)
+        logger.addHandler(stream_handler)
+
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        testargs = f"""
+            train.py
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --validation_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --do_train
+            --do_eval
+            --per_device_train_batch_size 4
+            --per_device_eval_batch_size 4
+            --num_train_epochs 2
+            --set_seq_size 8
+            --encoder_model n-tokens
+            --decoder_model n-tokens
+            --n_latent_tokens 2
+            --latent_size 2
+            --transformer_type t5
+            --transformer_name t5-small
+            --output_dir {tmp_dir}
+            --overwrite_output_dir
+            """.split()
+
+        if torch.cuda.device_count() > 1:
+            # Skipping because there are not enough batches to train the model + would need a drop_last to work.
+            return
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            result = main()
+            self.assertAlmostEqual(result["epoch"], 2.0)
+
+    def test_train_chunked_preprocessing(self):
+        stream_handler = logging.StreamHandler(sys.stdout)
+        logger.addHandler(stream_handler)
+
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        testargs = f"""
+            train.py
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --validation_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --do_train
+            --do_eval
+            --per_device_train_batch_size 4
+            --per_device_eval_batch_size 4
+            --num_train_epochs 2
+            --set_seq_size 8
+            --encoder_model n-tokens
+            --decoder_model n-tokens
+            --n_latent_tokens 2
+            --no_dynamic_padding
+            --preprocessing_batch_size 2
+            --preprocessing_num_workers 2
+            --latent_size 2
+            --transformer_type t5
+            --transformer_name t5-small
+            --output_dir {tmp_dir}
+            --overwrite_output_dir
+            """.split()
+
+        if torch.cuda.device_count() > 1:
+            # Skipping because there are not enough batches to train the model + would need a drop_last to work.
+            return
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            result = main()
+            self.assertAlmostEqual(result["epoch"], 2.0)
+
+    def test_train_token_store(self):
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        prepare_args = f"""
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --validation_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --set_seq_size 8
+            --transformer_name t5-small
+            --token_store_dir {tmp_dir}/tokens
+            --shard_size 4
+            """.split()
+        manifests = prepare.main(prepare_args)
+        self.assertEqual(set(manifests.keys()), {"train", "validation"})
+
+        testargs = f"""
+            train.py
+            --token_store_dir {tmp_dir}/tokens
+            --do_train
+            --do_eval
+            --per_device_train_batch_size 4
+            --per_device_eval_batch_size 4
+            --num_train_epochs 2
+            --set_seq_size 8
+            --encoder_model n-tokens
+            --decoder_model n-tokens
+            --n_latent_tokens 2
+            --latent_size 2
+            --transformer_type t5
+            --transformer_name t5-small
+            --output_dir {tmp_dir}/model
+            --overwrite_output_dir
+            """.split()
+
+        if torch.cuda.device_count() > 1:
+            # Skipping because there are not enough batches to train the model + would need a drop_last to work.
+            return
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            result = main()
+            self.assertAlmostEqual(result["epoch"], 2.0)
+
+        testargs[testargs.index(f"{tmp_dir}/tokens")] = f"{tmp_dir}/missing"
+        with patch.object(sys, "argv", testargs):
+            with self.assertRaisesRegex(ValueError, "transformer_vae prepare"):
+                main()
+
     def test_train_mini_mmd_batch_size(self):
         stream_handler = logging.StreamHandler(sys.stdout)
         logger.addHandler(stream_handler)
@@ -250,6 +411,75 @@ class TrainTests(TestCasePlus):
             result = main()
             self.assertAlmostEqual(result["epoch"], 2.0)
 
+    def test_train_rff_mmd_estimator(self):
+        stream_handler = logging.StreamHandler(sys.stdout)
+        logger.addHandler(stream_handler)
+
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        testargs = f"""
+            train.py
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --validation_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --do_train
+            --do_eval
+            --per_device_train_batch_size 4
+            --per_device_eval_batch_size 4
+            --mmd_estimator rff
+            --mmd_kernel imq
+            --num_train_epochs 2
+            --set_seq_size 4
+            --latent_size 2
+            --transformer_type t5
+            --transformer_name t5-small
+            --output_dir {tmp_dir}
+            --overwrite_output_dir
+            """.split()
+
+        if torch.cuda.device_count() > 1:
+            # Skipping because there are not enough batches to train the model + would need a drop_last to work.
+            return
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            result = main()
+            self.assertAlmostEqual(result["epoch"], 2.0)
+
+    def test_train_previous_latent_codes(self):
+        stream_handler = logging.StreamHandler(sys.stdout)
+        logger.addHandler(stream_handler)
+
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        testargs = f"""
+            train.py
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --validation_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --do_train
+            --do_eval
+            --per_device_train_batch_size 3
+            --per_device_eval_batch_size 3
+            --n_previous_latent_codes 2
+            --num_train_epochs 2
+            --set_seq_size 4
+            --latent_size 2
+            --transformer_type t5
+            --transformer_name t5-small
+            --output_dir {tmp_dir}
+            --overwrite_output_dir
+            """.split()
+
+        if torch.cuda.device_count() > 1:
+            # Skipping because there are not enough batches to train the model + would need a drop_last to work.
+            return
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            result = main()
+            self.assertAlmostEqual(result["epoch"], 2.0)
+
     def test_train_python_syntax_seq_check(self):
         stream_handler = logging.StreamHandler(sys.stdout)
         logger.addHandler(stream_handler)
@@ -535,3 +765,67 @@ class TrainTests(TestCasePlus):
         with patch.object(sys, "argv", testargs):
             result = main()
             self.assertAlmostEqual(result["epoch"], 2.0)
+
+    def test_encode_latent_store(self):
+        stream_handler = logging.StreamHandler(sys.stdout)
+        logger.addHandler(stream_handler)
+
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        testargs = f"""
+            train.py
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --do_train
+            --per_device_train_batch_size 4
+            --num_train_epochs 1
+            --set_seq_size 4
+            --latent_size 2
+            --transformer_name t5-small
+            --output_dir {tmp_dir}
+            --overwrite_output_dir
+            """.split()
+
+        if torch_device != "cuda":
+            testargs.append("--no_cuda")
+
+        with patch.object(sys, "argv", testargs):
+            main()
+
+        encode_args = f"""
+            --train_file ./tests/fixtures/line_by_line_max_len_3.txt
+            --model_path {tmp_dir}
+            --transformer_name t5-small
+            --latent_store_dir {tmp_dir}/latents
+            --encode_batch_size 3
+            --shard_size 4
+            """.split()
+        manifest = encode.main(encode_args)
+
+        store = LatentStore(f"{tmp_dir}/latents")
+        self.assertEqual(len(store), manifest["n_rows"])
+        self.assertEqual(store.numpy().shape, (manifest["n_rows"], 2))
+
+        # re-running into the same store must say whether to replace it or add to it
+        with self.assertRaises(ValueError):
+            encode.main(encode_args)
+        self.assertEqual(encode.main(encode_args + ["--append"])["n_rows"], manifest["n_rows"])
+        self.assertEqual(encode.main(encode_args + ["--overwrite"])["n_rows"], manifest["n_rows"])
+        self.assertEqual(sorted(LatentStore(f"{tmp_dir}/latents").row_ids().tolist()), list(range(manifest["n_rows"])))
+
+
+class LengthStatsTests(TestCasePlus):
+    def test_length_stats(self):
+        stats = length_stats(collections.Counter({2: 5, 3: 3, 4: 1, 10: 1}), max_length=3)
+        self.assertEqual((stats["n_samples"], stats["max_length"], stats["n_truncated"]), (10, 10, 2))
+        self.assertEqual(stats["percentiles"], {50: 2, 90: 4, 95: 10, 99: 10, 100: 10})
+
+    def test_length_histogram_is_cached(self):
+        tmp_dir = self.get_auto_remove_tmp_dir()
+        dataset = Dataset.from_dict({"n_tokens": [1, 2, 2, 7]}).map(
+            lambda examples: examples, batched=True, cache_file_name=os.path.join(tmp_dir, "tokenized.arrow")
+        )
+        self.assertEqual(length_histogram(dataset, batch_size=3), {1: 1, 2: 2, 7: 1})
+        cache_path = os.path.join(tmp_dir, "tokenized_lengths.json")
+        with open(cache_path, "w") as f:
+            f.write('{"3": 4}')
+        self.assertEqual(length_histogram(dataset), {3: 4})
+        self.assertEqual(length_histogram(dataset, overwrite_cache=True), {1: 1, 2: 2, 7: 1})
@@ -1,4 +1,21 @@
-from transformer_vae.train import main
+import sys
+
+from transformer_vae import encode, export, prepare, quantize, server, train
+
+
+# `python -m transformer_vae <command> ...` runs a command, without one it trains a model
+COMMANDS = {
+    "train": train.main,
+    "prepare": prepare.main,
+    "encode": encode.main,
+    "serve": server.main,
+    "export": export.main,
+    "quantize": quantize.main,
+}
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        command = COMMANDS[sys.argv.pop(1)]
+    else:
+        command = train.main
+    command()
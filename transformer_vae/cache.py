@@ -0,0 +1,173 @@
+"""
+    LRU caches for repeated encode & decode calls, e.g. re-encoding the same seed texts while exploring a latent space.
+
+    cached = CachedVAE(model, tokenizer, max_items=10_000, max_bytes=512 * 2 ** 20)
+    latents = cached.encode_texts(["a poem", "another poem"])
+    texts = cached.decode_latents(latents, max_length=20).texts
+"""
+import collections
+import hashlib
+import threading
+
+import torch
+
+from transformer_vae.model_outputs import DecodedLatents_Output
+from transformer_vae.utils import checkpoint_fingerprint
+
+
+def _n_bytes(value):
+    """
+    Rough memory use of a cached value.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (tuple, list)):
+        return sum(_n_bytes(item) for item in value)
+    return 0 if value is None else 8
+
+
+def latent_key(latent):
+    """
+    Hash of a latent code's values, latents only match if they are bit-for-bit equal.
+    """
+    latent = latent.detach().cpu().contiguous()
+    return f"{latent.dtype}:{hashlib.sha1(latent.numpy().tobytes()).hexdigest()}"
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache bounded by its number of items & optionally their total size in bytes.
+
+    Keeps hit, miss & eviction counts, see `stats`.
+    """
+
+    def __init__(self, max_items=10_000, max_bytes=None):
+        if max_items < 1:
+            raise ValueError(f"Cache needs room for at least 1 item. Got: {max_items}")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = _n_bytes(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # would evict everything else & still not fit
+            return
+        with self._lock:
+            if key in self._items:
+                self.n_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.n_bytes += size
+            while len(self._items) > self.max_items or (self.max_bytes is not None and self.n_bytes > self.max_bytes):
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.n_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._items),
+                "bytes": self.n_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CachedVAE:
+    """
+    Wraps a Transformer-VAE's `encode_texts` & `decode_latents` with text -> latent & latent -> text LRU caches.
+
+    Keys include the checkpoint fingerprint so caches can be shared between models, decode keys also include the
+    generation arguments. Only the cache misses of each call are run through the model, together in one call.
+    Sampled generations (`do_sample=True`) are never cached.
+    """
+
+    def __init__(
+        self, model, tokenizer, max_items=10_000, max_bytes=None, fingerprint=None, encode_cache=None, decode_cache=None
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.fingerprint = fingerprint if fingerprint is not None else checkpoint_fingerprint(model)
+        self.encode_cache = encode_cache if encode_cache is not None else LRUCache(max_items, max_bytes)
+        self.decode_cache = decode_cache if decode_cache is not None else LRUCache(max_items, max_bytes)
+
+    def encode_texts(self, texts, batch_size=64):
+        """
+        Encode a list of texts into a `(n_texts, latent_size)` tensor of latent codes, see `encode_texts`.
+        """
+        keys = [(self.fingerprint, text) for text in texts]
+        latents = [self.encode_cache.get(key) for key in keys]
+        missing = [i for i, latent in enumerate(latents) if latent is None]
+        if missing:
+            new_latents = self.model.encode_texts([texts[i] for i in missing], self.tokenizer, batch_size=batch_size)
+            for i, latent in zip(missing, new_latents.cpu()):
+                latents[i] = latent.clone()
+                self.encode_cache.put(keys[i], latents[i])
+        return torch.stack(latents).to(self.model.device)
+
+    def decode_latents(self, latents, batch_size=64, **generate_kwargs):
+        """
+        Generate sequences from a `(n_latents, latent_size)` tensor of latent codes, see `decode_latents`.
+        """
+        if generate_kwargs.get("do_sample"):
+            return self.model.decode_latents(
+                latents, tokenizer=self.tokenizer, batch_size=batch_size, **generate_kwargs
+            )
+        # repr so unhashable arguments like `bad_words_ids` can be part of the key
+        generate_key = repr(sorted(generate_kwargs.items()))
+        keys = [(self.fingerprint, latent_key(latent), generate_key) for latent in latents]
+        decoded = [self.decode_cache.get(key) for key in keys]
+        missing = [i for i, item in enumerate(decoded) if item is None]
+        if missing:
+            outputs = self.model.decode_latents(
+                latents[missing], tokenizer=self.tokenizer, batch_size=batch_size, **generate_kwargs
+            )
+            texts = outputs.texts if outputs.texts is not None else [None] * len(missing)
+            for i, sequence, text in zip(missing, outputs.sequences.cpu(), texts):
+                decoded[i] = (sequence.clone(), text)
+                self.decode_cache.put(keys[i], decoded[i])
+
+        pad_token_id = generate_kwargs.get("pad_token_id")
+        if pad_token_id is None and self.tokenizer is not None:
+            pad_token_id = self.tokenizer.pad_token_id
+        pad_token_id = 0 if pad_token_id is None else pad_token_id
+        max_len = max(sequence.size(0) for sequence, _ in decoded)
+        sequences = torch.full((len(decoded), max_len), pad_token_id, dtype=torch.long)
+        for i, (sequence, _) in enumerate(decoded):
+            sequences[i, : sequence.size(0)] = sequence
+        texts = [text for _, text in decoded] if self.tokenizer is not None else None
+        return DecodedLatents_Output(sequences=sequences.to(latents.device), texts=texts)
+
+    def stats(self):
+        return {"encode": self.encode_cache.stats(), "decode": self.decode_cache.stats()}
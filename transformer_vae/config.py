@@ -5,11 +5,21 @@ from transformers.configuration_utils import PretrainedConfig
 from transformers import AutoConfig
 
 from transformer_vae.autoencoders import VAE_ENCODER_MODELS, VAE_DECODER_MODELS
+from transformer_vae.mmd import MMD_KERNELS, MMD_ESTIMATORS
 from transformer_vae.utils import assertEqual, assertIn
 
 logger = logging.getLogger(__name__)
 
 
+def load_transformer_config(saved_config, transformer_name, cache_dir=None):
+    """
+    Saved VAE configs store their transformer's config as a dict, only new configs load it by name.
+    """
+    if isinstance(saved_config, dict):
+        return AutoConfig.for_model(**saved_config)
+    return AutoConfig.from_pretrained(transformer_name, cache_dir=cache_dir)
+
+
 class Transformer_VAE_Config(PretrainedConfig):
     r"""
     This is the configuration class to store the configuration of :class:`~transformer_vae.T5_VAE_Model`.
@@ -43,8 +53,23 @@ class Transformer_VAE_Config(PretrainedConfig):
             Multiplied by global_step in a sigmoid, more gradually increase regulariser loss weight.
         reg_schedule_b (:obj:`float`, `optional`, defaults to 6.25):
             Added to global step in sigmoid, further delays increase in regulariser loss weight.
+        mmd_kernel (:obj:`str`, `optional`, defaults to gaussian):
+            Kernel used by the MMD regulariser, one of `transformer_vae.mmd.MMD_KERNELS`.
+        mmd_block_size (:obj:`int`, `optional`, defaults to 1,024):
+            Number of latent codes to compute kernel values for at once, bounds the regulariser's memory use.
+        mmd_estimator (:obj:`str`, `optional`, defaults to exact):
+            How to estimate the MMD, one of `transformer_vae.mmd.MMD_ESTIMATORS`.
+            The `linear`, `block` & `rff` estimators take linear time so can regularise against many more latent codes.
+        mmd_n_features (:obj:`int`, `optional`, defaults to 1,024):
+            Number of random Fourier features used by the `rff` MMD estimator.
+        mmd_estimator_block_size (:obj:`int`, `optional`, defaults to 32):
+            Number of latent codes in each block of the `block` MMD estimator, smaller blocks are cheaper but noisier.
+        distributed_mmd (:obj:`bool`, `optional`, defaults to False):
+            When training with `torch.distributed` compute the MMD regulariser on latent codes from every process.
         use_extra_logs (:obj:`bool`, `optional`, defaults to False):
             Store extra logs during each training inference.
+        debug_checks (:obj:`bool`, `optional`, defaults to False):
+            Run extra input checks during each inference, these read values back from the device so slow down training.
         *** End ***
     """
     model_type = "transformer_vae"
@@ -63,6 +88,12 @@ class Transformer_VAE_Config(PretrainedConfig):
         n_previous_latent_codes=0,
         use_reg_loss=True,
         mmd_batch_size=None,
+        mmd_kernel="gaussian",
+        mmd_block_size=1_024,
+        mmd_estimator="exact",
+        mmd_n_features=1_024,
+        mmd_estimator_block_size=32,
+        distributed_mmd=False,
         reg_schedule_k=0.0025,
         reg_schedule_b=6.25,
         skip_schedule_k=0.0006,
@@ -72,15 +103,21 @@ class Transformer_VAE_Config(PretrainedConfig):
         latent_dropout_schedule_k=0.0009,
         latent_dropout_schedule_b=11,
         use_extra_logs=False,
+        debug_checks=False,
         cache_dir=None,
         n_latent_tokens=None,
         **kwargs,
     ):
         assertIn(encoder_model, VAE_ENCODER_MODELS.keys(), "Unexpected VAE encoder.")
         assertIn(decoder_model, VAE_DECODER_MODELS.keys(), "Unexpected VAE decoder.")
+        assertIn(mmd_kernel, MMD_KERNELS.keys(), "Unexpected MMD kernel.")
+        assertIn(mmd_estimator, MMD_ESTIMATORS.keys(), "Unexpected MMD estimator.")
+        if mmd_batch_size:
+            assertEqual(mmd_estimator, "exact", "Can only use a smaller `mmd_batch_size` with the exact MMD estimator.")
 
+        transformer = kwargs.pop("transformer", None)
         super().__init__(**kwargs)
-        self.transformer = AutoConfig.from_pretrained(transformer_name, cache_dir=cache_dir)
+        self.transformer = load_transformer_config(transformer, transformer_name, cache_dir)
         self.transformer.decoder_start_token_id = decoder_start_token_id
         self.encoder_model = encoder_model
         self.decoder_model = decoder_model
@@ -90,6 +127,7 @@ class Transformer_VAE_Config(PretrainedConfig):
         if self.latent_size != latent_size:
             logger.warn(f'model dimension, latent_size & n_latent_tokens don\'t match. Now using latent_size={self.latent_size} from latent_size={latent_size}')
 
+        self.set_seq_size = set_seq_size
         self.padding_input = encoder_model != "1st-token"
         self.prepend_eos_token = False  # TODO manually check if adding a set 1st token improves performance
         if self.padding_input:
@@ -101,6 +139,12 @@ class Transformer_VAE_Config(PretrainedConfig):
         self.additional_latent_models = additional_latent_models
         self.n_previous_latent_codes = n_previous_latent_codes
         self.mmd_batch_size = mmd_batch_size
+        self.mmd_kernel = mmd_kernel
+        self.mmd_block_size = mmd_block_size
+        self.mmd_estimator = mmd_estimator
+        self.mmd_n_features = mmd_n_features
+        self.mmd_estimator_block_size = mmd_estimator_block_size
+        self.distributed_mmd = distributed_mmd
         self.use_reg_loss = use_reg_loss
         if not use_reg_loss:
             logger.warn("Regularisation loss is turned off, you are training an Autoencoder (not a VAE).")
@@ -113,8 +157,24 @@ class Transformer_VAE_Config(PretrainedConfig):
         self.latent_dropout_schedule_k = latent_dropout_schedule_k
         self.latent_dropout_schedule_b = latent_dropout_schedule_b
         self.use_extra_logs = use_extra_logs
+        self.debug_checks = debug_checks
         self.use_cache = getattr(self.transformer, "use_cache", False)
 
+    @property
+    def allows_dynamic_padding(self):
+        """
+        Whether inputs can be padded per batch rather than always to `set_seq_size`.
+        Needs a T5 encoder (Funnel encoders pool a fixed length) & a VAE encoder that doesn't flatten the whole sequence.
+        """
+        return self.transformer.model_type == "t5" and (not self.padding_input or self.encoder_model == "n-tokens")
+
+    @property
+    def min_seq_size(self):
+        """
+        Shortest input the VAE encoder can take, the n-tokens encoder needs at least `n_latent_tokens` tokens.
+        """
+        return self.n_latent_tokens if self.encoder_model == "n-tokens" else 1
+
     def to_dict(self):
         """
         Serializes this instance to a Python dictionary. Override the default `to_dict()` from `PretrainedConfig`.
@@ -148,9 +208,10 @@ class Funnel_VAE_Config(Transformer_VAE_Config):
             pooling_division = 2 ** (len(self.transformer.block_sizes) - 1)
             calc_encoded_seq_size = math.ceil(self.transformer.n_positions / pooling_division)
             if encoded_seq_size is None:
-                encoded_seq_size = calc_encoded_seq_size
+                self.encoded_seq_size = calc_encoded_seq_size
             else:
-                assert encoded_seq_size == calc_encoded_seq_size
+                self.encoded_seq_size = encoded_seq_size
+                assert self.encoded_seq_size == calc_encoded_seq_size
 
 
 class Funnel_T5_VAE_Config(Transformer_VAE_Config):
@@ -171,6 +232,7 @@ class Funnel_T5_VAE_Config(Transformer_VAE_Config):
         decoder_start_token_id=0,
         cache_dir=None,
         use_skip_connection=False,
+        transformer_decoder=None,
         **kwargs,
     ):
         super().__init__(
@@ -189,11 +251,13 @@ class Funnel_T5_VAE_Config(Transformer_VAE_Config):
             else:
                 self.encoded_seq_size = encoded_seq_size
                 assert self.encoded_seq_size == calc_encoded_seq_size
-        self.transformer_decoder = AutoConfig.from_pretrained(transformer_decoder_name, cache_dir=cache_dir)
+        self.transformer_decoder = load_transformer_config(transformer_decoder, transformer_decoder_name, cache_dir)
         self.transformer_decoder.decoder_start_token_id = decoder_start_token_id
         if self.padding_input:
             self.transformer_decoder.n_positions = self.transformer.n_positions
         assertEqual(self.transformer_decoder.model_type, "t5", "Need t5 model type for transformer_decoder.")
+        # Funnel configs have no `use_cache`, so generation follows the decoder's
+        self.use_cache = getattr(self.transformer_decoder, "use_cache", False)
         assertEqual(
             self.transformer.d_model,
             self.transformer_decoder.d_model,
@@ -232,6 +296,7 @@ class Funnel_gpt2_VAE_Config(Transformer_VAE_Config):
         transformer_decoder_name="distilgpt2",
         decoder_start_token_id=0,
         cache_dir=None,
+        transformer_decoder=None,
         **kwargs,
     ):
         super().__init__(
@@ -250,12 +315,13 @@ class Funnel_gpt2_VAE_Config(Transformer_VAE_Config):
             else:
                 self.encoded_seq_size = encoded_seq_size
                 assert self.encoded_seq_size == calc_encoded_seq_size
-        self.transformer_decoder = AutoConfig.from_pretrained(transformer_decoder_name, cache_dir=cache_dir)
+        self.transformer_decoder = load_transformer_config(transformer_decoder, transformer_decoder_name, cache_dir)
         self.transformer_decoder.add_cross_attention = True
         self.transformer_decoder.decoder_start_token_id = decoder_start_token_id
         if self.padding_input:
             self.transformer_decoder.n_positions = self.transformer.n_positions
         assertEqual(self.transformer_decoder.model_type, "gpt2", "Need gpt2 model type for transformer_decoder.")
+        self.use_cache = getattr(self.transformer_decoder, "use_cache", False)
         assertEqual(
             self.transformer.d_model,
             self.transformer_decoder.n_embd,
@@ -30,7 +30,7 @@ class NonPaddingDataCollatorForLanguageModeling(DataCollatorForLanguageModeling)
         # Handle dict or lists with proper padding and conversion to tensor.
         if isinstance(examples[0], (dict, BatchEncoding)):
             # CHANGES START
-            batch = self.tokenizer.pad(examples, padding=self.padding, return_attention_mask=False, return_tensors="pt")
+            batch = self._pad(examples)
             # CHANGES END
         else:
             batch = {"input_ids": _collate_batch(examples, self.tokenizer)}
@@ -48,6 +48,16 @@ class NonPaddingDataCollatorForLanguageModeling(DataCollatorForLanguageModeling)
             batch["labels"] = labels
         return batch
 
+    def _pad(self, examples):
+        if isinstance(examples[0]["input_ids"], torch.Tensor):
+            # already padded rows (e.g. from a `TokenStore`) are stacked rather than converted to lists & back
+            input_ids = torch.stack([example["input_ids"] for example in examples]).long()
+            # the same mask `tokenizer.pad` gives tokenized datasets, so pad positions aren't attended to
+            lengths = torch.tensor([example["length"] for example in examples])
+            attention_mask = (torch.arange(input_ids.size(1)).unsqueeze(0) < lengths.unsqueeze(1)).long()
+            return {"input_ids": input_ids, "attention_mask": attention_mask}
+        return self.tokenizer.pad(examples, padding=self.padding, return_attention_mask=False, return_tensors="pt")
+
 
 @dataclass
 class DataCollatorForLanguageAutoencoding(NonPaddingDataCollatorForLanguageModeling):
@@ -55,6 +65,14 @@ class DataCollatorForLanguageAutoencoding(NonPaddingDataCollatorForLanguageModel
     Same as MLM except we calculate a loss on non-masked tokens.
     """
 
+    def __post_init__(self):
+        super().__post_init__()
+        # special tokens are found by indexing this with token ids rather than checking each token in Python,
+        # it's filled by `get_special_tokens_mask` so each tokenizer keeps its own set of special tokens
+        vocab_ids = list(range(len(self.tokenizer)))
+        special_tokens_mask = self.tokenizer.get_special_tokens_mask(vocab_ids, already_has_special_tokens=True)
+        self.special_ids_lookup = torch.tensor(special_tokens_mask, dtype=torch.bool)
+
     def mask_tokens(
         self, inputs: torch.Tensor, special_tokens_mask: Optional[torch.Tensor] = None
     ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -62,30 +80,56 @@ class DataCollatorForLanguageAutoencoding(NonPaddingDataCollatorForLanguageModel
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
         labels = inputs.clone()
-        # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
-        probability_matrix = torch.full(labels.shape, self.mlm_probability)
+        # CHANGED line
+        # labels[~masked_indices] = -100  # We only compute loss on masked tokens
+        labels[labels == self.tokenizer.pad_token_id] = -100
+        if self.mlm_probability == 0:
+            return inputs, labels
+
         if special_tokens_mask is None:
-            special_tokens_mask = [
-                self.tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-            ]
-            special_tokens_mask = torch.tensor(special_tokens_mask, dtype=torch.bool)
+            special_tokens_mask = self.special_ids_lookup[inputs]
         else:
             special_tokens_mask = special_tokens_mask.bool()
 
-        probability_matrix.masked_fill_(special_tokens_mask, value=0.0)
-        masked_indices = torch.bernoulli(probability_matrix).bool()
-        # CHANGED line
-        # labels[~masked_indices] = -100  # We only compute loss on masked tokens
-        labels[labels == self.tokenizer.pad_token_id] = -100
+        # One uniform draw decides each token's noise, a token is masked if it falls below `self.mlm_probability`
+        # & the sub-range it falls in decides if it's replaced with [MASK], a random word or kept.
+        noise = torch.rand(labels.shape)
+        noise.masked_fill_(special_tokens_mask, 1.0)
 
         # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+        replaced_below = self.mlm_probability * 0.8
+        indices_replaced = noise < replaced_below
         inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
 
-        # 10% of the time, we replace masked input tokens with random word
-        indices_random = torch.bernoulli(torch.full(labels.shape, 0.1)).bool() & masked_indices & ~indices_replaced
-        random_words = torch.randint(len(self.tokenizer), labels.shape, dtype=torch.long)
-        inputs[indices_random] = random_words[indices_random]
+        # 10% of the remaining time, we replace masked input tokens with random word
+        indices_random = (noise >= replaced_below) & (noise < replaced_below + self.mlm_probability * 0.2 * 0.1)
+        random_words = torch.randint(len(self.tokenizer), (int(indices_random.sum()),), dtype=inputs.dtype)
+        inputs[indices_random] = random_words
 
-        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+        # The rest of the time we keep the masked input tokens unchanged
         return inputs, labels
+
+
+@dataclass
+class DynamicPaddingDataCollatorForLanguageAutoencoding(DataCollatorForLanguageAutoencoding):
+    """
+    Pads each batch to its own longest sequence (but at least `min_length`) rather than a fixed sequence size.
+
+    Use with unpadded tokenized datasets & a `transformer_vae.sampler.LengthGroupedSampler` so batches hold sequences
+    of similar lengths.
+    """
+
+    min_length: int = 1
+
+    def _pad(self, examples):
+        max_length = max(self.min_length, max(len(example["input_ids"]) for example in examples))
+        if isinstance(examples[0]["input_ids"], torch.Tensor):
+            input_ids = torch.full((len(examples), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros_like(input_ids)
+            for i, example in enumerate(examples):
+                input_ids[i, : len(example["input_ids"])] = example["input_ids"]
+                attention_mask[i, : len(example["input_ids"])] = 1
+            return {"input_ids": input_ids, "attention_mask": attention_mask}
+        examples = [{k: v for k, v in example.items() if k != "length"} for example in examples]
+        # unlike fixed size inputs, pad tokens now vary per batch so the attention mask is padded too
+        return self.tokenizer.pad(examples, padding="max_length", max_length=max_length, return_tensors="pt")
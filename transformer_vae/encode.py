@@ -0,0 +1,113 @@
+"""
+    Encode a whole dataset into a memory-mapped latent store.
+"""
+import logging
+import os
+import shutil
+import sys
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+from transformers import HfArgumentParser
+
+from transformer_vae.latent_store import LATENT_DTYPES, LatentStore, LatentStoreWriter
+from transformer_vae.shard_store import has_manifest
+from transformer_vae.train import (
+    ModelArguments,
+    DataTrainingArguments,
+    DEFAULT_TRANSFORMER_NAME,
+    get_datasets,
+    load_model_and_tokenizer,
+)
+from transformer_vae.utils import checkpoint_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EncodeArguments:
+    """
+    Arguments for where & how to store latent codes.
+    """
+
+    latent_store_dir: str = field(metadata={"help": "Directory to write the latent store to."})
+    overwrite: bool = field(default=False, metadata={"help": "Replace the latent store if it already exists."})
+    append: bool = field(
+        default=False,
+        metadata={"help": "Add to an existing latent store, skipping dataset rows it already holds (e.g. to resume)."},
+    )
+    split: str = field(default="train", metadata={"help": "Dataset split to encode."})
+    encode_batch_size: int = field(default=256, metadata={"help": "Number of texts to encode at once."})
+    latent_dtype: str = field(
+        default="float32", metadata={"help": f"Type to store latents as, one of {', '.join(LATENT_DTYPES.keys())}."}
+    )
+    shard_size: int = field(default=1_000_000, metadata={"help": "Maximum number of latent codes per shard."})
+    no_cuda: bool = field(default=False, metadata={"help": "Don't use CUDA even when it is available."})
+
+
+def get_args(args=None):
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, EncodeArguments))
+    if args is None and len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, encode_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, encode_args = parser.parse_args_into_dataclasses(args)
+
+    if model_args.transformer_name is None:
+        model_args.transformer_name = DEFAULT_TRANSFORMER_NAME[model_args.transformer_type]
+    if encode_args.overwrite and encode_args.append:
+        raise ValueError("Can't both `overwrite` & `append` to a latent store.")
+
+    return model_args, data_args, encode_args
+
+
+def main(args=None):
+    model_args, data_args, encode_args = get_args(args)
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    dataset = get_datasets(data_args)[encode_args.split]
+    if data_args.text_column is not None:
+        text_column_name = data_args.text_column
+    else:
+        text_column_name = "text" if "text" in dataset.column_names else dataset.column_names[0]
+
+    model, tokenizer = load_model_and_tokenizer(model_args)
+    device = torch.device("cuda" if torch.cuda.is_available() and not encode_args.no_cuda else "cpu")
+    model.to(device).eval()
+
+    stored_row_ids = np.zeros(0, dtype=np.int64)
+    if has_manifest(encode_args.latent_store_dir):
+        if encode_args.overwrite:
+            shutil.rmtree(encode_args.latent_store_dir)
+        elif encode_args.append:
+            stored_row_ids = np.unique(LatentStore(encode_args.latent_store_dir).row_ids())
+        else:
+            raise ValueError(
+                f"Latent store already exists, use `overwrite` to replace it or `append` to add to it. "
+                f"Got: {encode_args.latent_store_dir}"
+            )
+
+    with LatentStoreWriter(
+        encode_args.latent_store_dir,
+        model.config.latent_size,
+        dtype=encode_args.latent_dtype,
+        shard_size=encode_args.shard_size,
+        fingerprint=checkpoint_fingerprint(model),
+    ) as writer:
+        for start in range(0, len(dataset), encode_args.encode_batch_size):
+            texts = dataset[start : start + encode_args.encode_batch_size][text_column_name]
+            row_ids = np.arange(start, start + len(texts))
+            new_rows = ~np.isin(row_ids, stored_row_ids, assume_unique=True)
+            if not new_rows.any():
+                continue
+            texts = [text for text, is_new in zip(texts, new_rows) if is_new]
+            latents = model.encode_texts(texts, tokenizer, batch_size=encode_args.encode_batch_size)
+            writer.add(latents, row_ids=row_ids[new_rows])
+        logger.info(f"Stored {writer.manifest['n_rows']} latent codes in {encode_args.latent_store_dir}")
+
+    return writer.manifest
@@ -0,0 +1,299 @@
+"""
+    Export standalone encode, cross-attention cache & decode step graphs with TorchScript or ONNX, for inference
+    without the training code.
+
+    python -m transformer_vae export --model_path poet --export_dir poet_onnx --export_format onnx
+"""
+import json
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+
+import torch
+from torch import nn
+from transformers import HfArgumentParser
+
+from transformer_vae.train import ModelArguments, DEFAULT_TRANSFORMER_NAME, load_model_and_tokenizer
+
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_FORMATS = ["torchscript", "onnx"]
+
+
+class EncodeGraph(nn.Module):
+    """
+    `(input_ids, attention_mask) -> latent`, only the transformer encoder & the VAE's encoder.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.vae.encoder(self.model._encode_sequence(input_ids, attention_mask))
+
+
+def _t5_attention(attention, hidden_states, keys, values, position_bias):
+    """
+    T5 attention of `hidden_states` over precomputed `keys` & `values`, as in `T5Attention.forward`.
+    """
+    batch_size = hidden_states.size(0)
+    queries = attention.q(hidden_states).view(batch_size, -1, attention.n_heads, attention.key_value_proj_dim)
+    queries = queries.transpose(1, 2)
+    scores = torch.matmul(queries, keys.transpose(3, 2)) + position_bias
+    weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
+    return attention.o(torch.matmul(weights, values).transpose(1, 2).reshape(batch_size, -1, attention.inner_dim))
+
+
+def _t5_project(attention, hidden_states):
+    batch_size = hidden_states.size(0)
+    return [
+        projection(hidden_states).view(batch_size, -1, attention.n_heads, attention.key_value_proj_dim).transpose(1, 2)
+        for projection in (attention.k, attention.v)
+    ]
+
+
+def _t5_decoder(model):
+    decoder = getattr(model.transformer, "decoder", None)
+    if decoder is None or not hasattr(decoder, "block"):
+        raise NotImplementedError(
+            f"Can only export decode steps of models with T5 decoders. Got: {type(model).__name__}"
+        )
+    return decoder
+
+
+class CrossCacheGraph(nn.Module):
+    """
+    `latent -> (cross_keys, cross_values)`, run once per sequence before its decode steps.
+
+    The latent is decoded into the encoding the decoder attends to & every decoder layer's cross-attention keys &
+    values are projected from it, each output has shape `(n_layers, batch_size, n_heads, encoding_size, d_kv)`.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.decoder = _t5_decoder(model)
+
+    def forward(self, latent):
+        encoding = self.model.latent_to_encoding(latent)
+        all_keys, all_values = [], []
+        for block in self.decoder.block:
+            keys, values = _t5_project(block.layer[1].EncDecAttention, encoding)
+            all_keys.append(keys)
+            all_values.append(values)
+        return torch.stack(all_keys), torch.stack(all_values)
+
+
+class DecodeStepGraph(nn.Module):
+    """
+    `(decoder_input_ids, step, cross_keys, cross_values, past_keys, past_values) -> (logits, keys, values)`, one step
+    of a T5 decoder.
+
+    The token at position `step` is run through the decoder, attending to itself & the previous tokens' keys & values
+    in the self-attention cache & to the latent's cross-attention keys & values from `CrossCacheGraph`.
+    Returns the next token logits & the cache with this token's keys & values written at `step`.
+
+    All shapes are static, the cache `past_keys` & `past_values` is preallocated for `set_seq_size` tokens with
+    shape `(n_layers, batch_size, n_heads, set_seq_size, d_kv)`, positions after `step` are masked out.
+
+    NOTE: The decoder layers are run directly rather than through `T5Stack` as its `past_key_values` code path can't
+    be traced.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.decoder = _t5_decoder(model)
+        self.seq_size = model.config.transformer.n_positions
+        # relative position bias of every query position, the query at `step` uses row `step`
+        with torch.no_grad():
+            position_bias = self.decoder.block[0].layer[0].SelfAttention.compute_bias(self.seq_size, self.seq_size)
+        self.register_buffer("position_bias", position_bias.squeeze(0).transpose(0, 1).contiguous())
+        self.register_buffer("positions", torch.arange(self.seq_size))
+
+    def forward(self, decoder_input_ids, step, cross_keys, cross_values, past_keys, past_values):
+        step = step.view(())
+        is_step = (self.positions == step).view(1, 1, -1, 1)
+        # (1, n_heads, 1, seq_size) relative position bias & causal mask for the current token
+        position_bias = self.position_bias.index_select(0, step.view(1)).unsqueeze(2)
+        position_bias = position_bias + (self.positions > step).to(position_bias.dtype).view(1, 1, 1, -1) * -10_000.0
+
+        hidden_states = self.decoder.embed_tokens(decoder_input_ids)
+        all_keys, all_values = [], []
+        layers = zip(
+            self.decoder.block, past_keys.unbind(0), past_values.unbind(0), cross_keys.unbind(0), cross_values.unbind(0)
+        )
+        for block, layer_keys, layer_values, layer_cross_keys, layer_cross_values in layers:
+            self_attention = block.layer[0].SelfAttention
+            normed_hidden_states = block.layer[0].layer_norm(hidden_states)
+            keys, values = _t5_project(self_attention, normed_hidden_states)
+            keys = torch.where(is_step, keys, layer_keys)
+            values = torch.where(is_step, values, layer_values)
+            all_keys.append(keys)
+            all_values.append(values)
+            attention_output = _t5_attention(self_attention, normed_hidden_states, keys, values, position_bias)
+            hidden_states = hidden_states + attention_output
+
+            cross_attention = block.layer[1].EncDecAttention
+            normed_hidden_states = block.layer[1].layer_norm(hidden_states)
+            attention_output = _t5_attention(
+                cross_attention, normed_hidden_states, layer_cross_keys, layer_cross_values, 0.0
+            )
+            hidden_states = hidden_states + attention_output
+            hidden_states = block.layer[2](hidden_states)
+
+        sequence_output = self.decoder.final_layer_norm(hidden_states)[:, -1]
+        # Rescale output before projecting on vocab
+        sequence_output = sequence_output * (self.model.config.transformer.d_model ** -0.5)
+        return self.model.transformer.lm_head(sequence_output), torch.stack(all_keys), torch.stack(all_values)
+
+
+def graph_shapes(model, batch_size=1):
+    """
+    Shapes of the exported graphs, all sequence lengths are fixed by the model's `set_seq_size`.
+    """
+    decoder_config = model.transformer.decoder.config
+    with torch.no_grad():
+        encoding = model.latent_to_encoding(torch.zeros(1, model.config.latent_size, device=model.device))
+    return dict(
+        batch_size=batch_size,
+        seq_size=model.config.transformer.n_positions,
+        latent_size=model.config.latent_size,
+        encoding_size=encoding.size(1),
+        n_layers=len(model.transformer.decoder.block),
+        n_heads=decoder_config.num_heads,
+        d_kv=decoder_config.d_kv,
+        vocab_size=decoder_config.vocab_size,
+        decoder_start_token_id=model.decoder_start_token_id,
+        pad_token_id=model.config.transformer.pad_token_id,
+    )
+
+
+def example_inputs(shapes):
+    encode_inputs = (
+        torch.ones(shapes["batch_size"], shapes["seq_size"], dtype=torch.long),
+        torch.ones(shapes["batch_size"], shapes["seq_size"], dtype=torch.long),
+    )
+    cross_cache_inputs = (torch.zeros(shapes["batch_size"], shapes["latent_size"]),)
+    layer_heads = (shapes["n_layers"], shapes["batch_size"], shapes["n_heads"])
+    cross_cache_size = layer_heads + (shapes["encoding_size"], shapes["d_kv"])
+    cache_size = layer_heads + (shapes["seq_size"], shapes["d_kv"])
+    decode_inputs = (
+        torch.full((shapes["batch_size"], 1), shapes["decoder_start_token_id"], dtype=torch.long),
+        torch.zeros((), dtype=torch.long),
+        torch.zeros(cross_cache_size),
+        torch.zeros(cross_cache_size),
+        torch.zeros(cache_size),
+        torch.zeros(cache_size),
+    )
+    return encode_inputs, cross_cache_inputs, decode_inputs
+
+
+@torch.no_grad()
+def export_graphs(model, export_dir, export_format="torchscript", batch_size=1, opset_version=12):
+    """
+    Export `EncodeGraph`, `CrossCacheGraph` & `DecodeStepGraph` to `export_dir` along with their shapes in
+    `graph_shapes.json`. ONNX graphs keep the batch size dynamic, all other sizes are fixed.
+
+    Returns the paths of the encode, cross-attention cache & decode step graphs.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unexpected export format. Got: "{export_format}" Expected one of: {EXPORT_FORMATS}')
+    model = model.cpu().eval()
+    os.makedirs(export_dir, exist_ok=True)
+    shapes = graph_shapes(model, batch_size)
+    encode_inputs, cross_cache_inputs, decode_inputs = example_inputs(shapes)
+    encode_graph, cross_cache_graph, decode_step_graph = (
+        EncodeGraph(model),
+        CrossCacheGraph(model),
+        DecodeStepGraph(model),
+    )
+
+    extension = "pt" if export_format == "torchscript" else "onnx"
+    encode_path = os.path.join(export_dir, f"encode.{extension}")
+    cross_cache_path = os.path.join(export_dir, f"cross_cache.{extension}")
+    decode_step_path = os.path.join(export_dir, f"decode_step.{extension}")
+    if export_format == "torchscript":
+        torch.jit.trace(encode_graph, encode_inputs, check_trace=False).save(encode_path)
+        torch.jit.trace(cross_cache_graph, cross_cache_inputs, check_trace=False).save(cross_cache_path)
+        torch.jit.trace(decode_step_graph, decode_inputs, check_trace=False).save(decode_step_path)
+    else:
+        batch = {0: "batch_size"}
+        torch.onnx.export(
+            encode_graph,
+            encode_inputs,
+            encode_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["latent"],
+            dynamic_axes={"input_ids": batch, "attention_mask": batch, "latent": batch},
+            opset_version=opset_version,
+        )
+        cache = {1: "batch_size"}
+        torch.onnx.export(
+            cross_cache_graph,
+            cross_cache_inputs,
+            cross_cache_path,
+            input_names=["latent"],
+            output_names=["cross_keys", "cross_values"],
+            dynamic_axes={"latent": batch, "cross_keys": cache, "cross_values": cache},
+            opset_version=opset_version,
+        )
+        torch.onnx.export(
+            decode_step_graph,
+            decode_inputs,
+            decode_step_path,
+            input_names=["decoder_input_ids", "step", "cross_keys", "cross_values", "past_keys", "past_values"],
+            output_names=["logits", "keys", "values"],
+            dynamic_axes={
+                "decoder_input_ids": batch,
+                "cross_keys": cache,
+                "cross_values": cache,
+                "past_keys": cache,
+                "past_values": cache,
+                "logits": batch,
+                "keys": cache,
+                "values": cache,
+            },
+            opset_version=opset_version,
+        )
+    with open(os.path.join(export_dir, "graph_shapes.json"), "w") as f:
+        json.dump(shapes, f, indent=2)
+    return encode_path, cross_cache_path, decode_step_path
+
+
+@dataclass
+class ExportArguments:
+    """
+    Arguments for exporting a model.
+    """
+
+    export_dir: str = field(metadata={"help": "Directory to save the exported graphs to."})
+    export_format: str = field(default="torchscript", metadata={"help": f"One of {', '.join(EXPORT_FORMATS)}."})
+    export_batch_size: int = field(default=1, metadata={"help": "Batch size of the example inputs."})
+    opset_version: int = field(default=12, metadata={"help": "ONNX opset version."})
+
+
+def main(args=None):
+    parser = HfArgumentParser((ModelArguments, ExportArguments))
+    if args is None and len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, export_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, export_args = parser.parse_args_into_dataclasses(args)
+    if model_args.transformer_name is None:
+        model_args.transformer_name = DEFAULT_TRANSFORMER_NAME[model_args.transformer_type]
+
+    model, tokenizer = load_model_and_tokenizer(model_args)
+    paths = export_graphs(
+        model,
+        export_args.export_dir,
+        export_format=export_args.export_format,
+        batch_size=export_args.export_batch_size,
+        opset_version=export_args.opset_version,
+    )
+    tokenizer.save_pretrained(export_args.export_dir)
+    logger.info(f"Exported {', '.join(paths)}")
+    return paths
@@ -0,0 +1,300 @@
+"""
+    Nearest neighbour search over latent codes.
+"""
+from collections import namedtuple
+import torch
+
+from transformer_vae.mmd import pairwise_sq_dists
+
+
+Neighbours = namedtuple("Neighbours", ["distances", "row_ids"])
+
+
+def _merge_top_k(best, distances, row_ids, k):
+    """
+    Merge `(n_queries, n_candidates)` distances & row ids into the current best `k`.
+    """
+    distances = torch.cat((best.distances, distances), dim=1)
+    row_ids = torch.cat((best.row_ids, row_ids), dim=1)
+    top = distances.topk(min(k, distances.size(1)), dim=1, largest=False)
+    return Neighbours(top.values, row_ids.gather(1, top.indices))
+
+
+def _empty_neighbours(n_queries, device):
+    return Neighbours(
+        torch.zeros(n_queries, 0, device=device), torch.zeros(n_queries, 0, dtype=torch.long, device=device)
+    )
+
+
+def _pad_neighbours(neighbours, k):
+    """
+    Pad results with `inf` distances & `-1` row ids when there are fewer than `k` latents to search.
+    """
+    n_missing = k - neighbours.distances.size(1)
+    if n_missing <= 0:
+        return neighbours
+    return Neighbours(
+        torch.nn.functional.pad(neighbours.distances, (0, n_missing), value=float("inf")),
+        torch.nn.functional.pad(neighbours.row_ids, (0, n_missing), value=-1),
+    )
+
+
+def _search_block(queries, latents, row_ids, k, block_size):
+    best = _empty_neighbours(queries.size(0), queries.device)
+    for start in range(0, latents.size(0), block_size):
+        block = latents[start : start + block_size]
+        block_ids = row_ids[start : start + block_size].unsqueeze(0).expand(queries.size(0), -1)
+        best = _merge_top_k(best, pairwise_sq_dists(queries, block), block_ids, k)
+    return best
+
+
+def _nearest(latents, centroids, block_size):
+    return torch.cat(
+        [
+            pairwise_sq_dists(latents[start : start + block_size], centroids).argmin(1)
+            for start in range(0, latents.size(0), block_size)
+        ]
+    )
+
+
+def _as_latents(latents, device):
+    if not isinstance(latents, torch.Tensor):
+        latents = torch.as_tensor(latents)
+    return latents.to(device=device, dtype=torch.float32)
+
+
+class LatentIndex:
+    """
+    Base class for latent code indexes, searches by squared euclidean distance.
+
+    Latents are given with integer row ids (defaulting to the order they were added in), searches return the
+    row ids of the nearest latents.
+    """
+
+    def __init__(self, latent_size, block_size=16_384, device="cpu"):
+        self.latent_size = latent_size
+        self.block_size = block_size
+        self.device = torch.device(device)
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _row_ids(self, n_latents, row_ids):
+        if row_ids is None:
+            return torch.arange(self.n_rows, self.n_rows + n_latents, device=self.device)
+        row_ids = torch.as_tensor(row_ids, dtype=torch.long, device=self.device)
+        if row_ids.size(0) != n_latents:
+            raise ValueError(f"Need a row id for every latent. Got: {row_ids.size(0)} Expected: {n_latents}")
+        return row_ids
+
+    def add(self, latents, row_ids=None):
+        """
+        Add a `(n_latents, latent_size)` tensor or array of latent codes.
+        """
+        latents = _as_latents(latents, self.device)
+        if latents.dim() != 2 or latents.size(1) != self.latent_size:
+            raise ValueError(f"Latents must have shape (n_latents, {self.latent_size}). Got: {tuple(latents.size())}")
+        self._add(latents, self._row_ids(latents.size(0), row_ids))
+        self.n_rows += latents.size(0)
+
+    def add_store(self, store):
+        """
+        Add every latent code in a `transformer_vae.latent_store.LatentStore`, one shard at a time.
+        """
+        if store.latent_size != self.latent_size:
+            raise ValueError(
+                f"Latent store has a different latent size. Got: {store.latent_size} Expected: {self.latent_size}"
+            )
+        for index in range(store.n_shards):
+            latents, row_ids = store.shard(index)
+            self.add(latents, row_ids)
+
+    def _add(self, latents, row_ids):
+        raise NotImplementedError()
+
+    @torch.no_grad()
+    def search(self, latents, k=10):
+        """
+        Find the `k` nearest latent codes to each of a `(n_queries, latent_size)` batch of latents.
+        Returns `Neighbours` with `(n_queries, k)` squared distances & row ids, nearest first.
+        """
+        queries = _as_latents(latents, self.device)
+        return _pad_neighbours(self._search(queries, k), k)
+
+    def search_texts(self, texts, model, tokenizer, k=10, batch_size=64):
+        """
+        Find the `k` nearest latent codes to each text, as encoded by `model`.
+        """
+        return self.search(model.encode_texts(texts, tokenizer, batch_size=batch_size), k)
+
+    def _search(self, queries, k):
+        raise NotImplementedError()
+
+    def _init_kwargs(self):
+        return dict(latent_size=self.latent_size, block_size=self.block_size)
+
+    def state_dict(self):
+        return dict(n_rows=self.n_rows)
+
+    def load_state_dict(self, state):
+        self.n_rows = state["n_rows"]
+
+    def save(self, path):
+        torch.save(
+            dict(index_type=INDEX_TYPES_BY_CLASS[type(self)], init_kwargs=self._init_kwargs(), state=self.state_dict()),
+            path,
+        )
+
+
+class ExactIndex(LatentIndex):
+    """
+    Brute force search, compares each query against every latent `block_size` latents at a time.
+    """
+
+    def __init__(self, latent_size, block_size=16_384, device="cpu"):
+        super().__init__(latent_size, block_size=block_size, device=device)
+        self._latents = []
+        self._row_ids_list = []
+
+    def _consolidate(self):
+        if len(self._latents) > 1:
+            self._latents = [torch.cat(self._latents)]
+            self._row_ids_list = [torch.cat(self._row_ids_list)]
+
+    def _add(self, latents, row_ids):
+        self._latents.append(latents)
+        self._row_ids_list.append(row_ids)
+
+    def _search(self, queries, k):
+        if not self._latents:
+            return _empty_neighbours(queries.size(0), queries.device)
+        self._consolidate()
+        return _search_block(queries, self._latents[0], self._row_ids_list[0], k, self.block_size)
+
+    def state_dict(self):
+        self._consolidate()
+        state = super().state_dict()
+        state["latents"] = self._latents[0] if self._latents else None
+        state["row_ids"] = self._row_ids_list[0] if self._latents else None
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self._latents = [] if state["latents"] is None else [state["latents"].to(self.device)]
+        self._row_ids_list = [] if state["row_ids"] is None else [state["row_ids"].to(self.device)]
+
+
+class IVFIndex(LatentIndex):
+    """
+    Inverted file index, approximate search that only compares queries to latents in nearby clusters.
+
+    Must be trained with k-means on a sample of latents before adding any, each added latent is then stored in the
+    list of its nearest centroid. Searches compare each query against the latents of its `n_probe` nearest
+    centroids, raising `n_probe` trades speed for recall.
+
+    Args:
+        n_lists (:obj:`int`, `optional`, defaults to 100):
+            Number of k-means clusters, around `sqrt(n_latents)` works well.
+        n_probe (:obj:`int`, `optional`, defaults to 8):
+            Number of clusters to search per query.
+    """
+
+    def __init__(self, latent_size, n_lists=100, n_probe=8, block_size=16_384, device="cpu"):
+        super().__init__(latent_size, block_size=block_size, device=device)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self._lists = [(None, None)] * n_lists
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    @torch.no_grad()
+    def train(self, latents, n_iterations=20, seed=0):
+        """
+        Fit the coarse quantiser's centroids with k-means.
+        """
+        latents = _as_latents(latents, self.device)
+        if latents.size(0) < self.n_lists:
+            raise ValueError(
+                f"Need at least as many latents as lists to train. Got: {latents.size(0)} Expected: {self.n_lists}"
+            )
+        generator = torch.Generator().manual_seed(seed)
+        centroids = latents[torch.randperm(latents.size(0), generator=generator)[: self.n_lists].to(self.device)]
+        for _ in range(n_iterations):
+            assignments = _nearest(latents, centroids, self.block_size)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, latents)
+            counts = torch.bincount(assignments, minlength=self.n_lists).unsqueeze(1)
+            # empty clusters keep their previous centroid
+            centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        self.centroids = centroids
+
+    def _add(self, latents, row_ids):
+        if not self.is_trained:
+            raise ValueError("Train the index before adding latents.")
+        assignments = _nearest(latents, self.centroids, self.block_size)
+        order = assignments.argsort()
+        counts = torch.bincount(assignments, minlength=self.n_lists).tolist()
+        for list_index, (list_latents, list_row_ids) in enumerate(
+            zip(latents[order].split(counts), row_ids[order].split(counts))
+        ):
+            if list_latents.size(0) == 0:
+                continue
+            old_latents, old_row_ids = self._lists[list_index]
+            if old_latents is not None:
+                list_latents = torch.cat((old_latents, list_latents))
+                list_row_ids = torch.cat((old_row_ids, list_row_ids))
+            self._lists[list_index] = (list_latents, list_row_ids)
+
+    def _search(self, queries, k):
+        best = _empty_neighbours(queries.size(0), queries.device)
+        if not self.is_trained:
+            return best
+        n_probe = min(self.n_probe, self.n_lists)
+        probes = pairwise_sq_dists(queries, self.centroids).topk(n_probe, dim=1, largest=False).indices
+        distances = torch.full((queries.size(0), n_probe * k), float("inf"), device=queries.device)
+        row_ids = torch.full((queries.size(0), n_probe * k), -1, dtype=torch.long, device=queries.device)
+        # batch together the queries probing each list
+        for list_index in probes.unique().tolist():
+            list_latents, list_row_ids = self._lists[list_index]
+            if list_latents is None:
+                continue
+            query_rows, probe_rank = (probes == list_index).nonzero(as_tuple=True)
+            found = _search_block(queries[query_rows], list_latents, list_row_ids, k, self.block_size)
+            columns = probe_rank.unsqueeze(1) * k + torch.arange(found.distances.size(1), device=queries.device)
+            distances[query_rows.unsqueeze(1), columns] = found.distances
+            row_ids[query_rows.unsqueeze(1), columns] = found.row_ids
+        return _merge_top_k(best, distances, row_ids, k)
+
+    def _init_kwargs(self):
+        return dict(super()._init_kwargs(), n_lists=self.n_lists, n_probe=self.n_probe)
+
+    def state_dict(self):
+        return dict(super().state_dict(), centroids=self.centroids, lists=list(self._lists))
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.centroids = None if state["centroids"] is None else state["centroids"].to(self.device)
+        self._lists = [
+            (None, None) if latents is None else (latents.to(self.device), row_ids.to(self.device))
+            for latents, row_ids in state["lists"]
+        ]
+
+
+INDEX_TYPES = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+}
+INDEX_TYPES_BY_CLASS = {index_class: name for name, index_class in INDEX_TYPES.items()}
+
+
+def load_index(path, device="cpu"):
+    """
+    Load an index saved with `LatentIndex.save`.
+    """
+    saved = torch.load(path, map_location="cpu")
+    index = INDEX_TYPES[saved["index_type"]](device=device, **saved["init_kwargs"])
+    index.load_state_dict(saved["state"])
+    return index
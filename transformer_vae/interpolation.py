@@ -0,0 +1,133 @@
+"""
+    Interpolate between many pairs of latent codes at once.
+"""
+import math
+import torch
+
+from transformer_vae.utils import assertIn
+
+
+def _ratio_grid(ratios):
+    # `(n_steps,)` ratios are shared by every pair, `(n_pairs, n_steps)` ratios are per pair
+    return ratios.view(1, -1, 1) if ratios.dim() == 1 else ratios.unsqueeze(2)
+
+
+def linear(start_latents, end_latents, ratios):
+    """
+    Points along the straight lines from `start_latents` to `end_latents`.
+
+    Takes `(n_pairs, latent_size)` start & end latents & `(n_steps,)` or `(n_pairs, n_steps)` ratios,
+    returns `(n_pairs, n_steps, latent_size)`.
+    """
+    ratios = _ratio_grid(ratios)
+    return start_latents.unsqueeze(1) + ratios * (end_latents - start_latents).unsqueeze(1)
+
+
+def slerp(start_latents, end_latents, ratios, eps=1e-6):
+    """
+    Spherical interpolation, follows the great circle between each pair so points keep the norm expected of the prior.
+    Pairs that are (anti)parallel fall back to linear interpolation.
+    """
+    start_norms = start_latents.norm(dim=1, keepdim=True).clamp(min=eps)
+    end_norms = end_latents.norm(dim=1, keepdim=True).clamp(min=eps)
+    cos_omega = ((start_latents / start_norms) * (end_latents / end_norms)).sum(dim=1).clamp(-1, 1)
+    omega = torch.acos(cos_omega).view(-1, 1, 1)
+    sin_omega = torch.sin(omega)
+    ratios = _ratio_grid(ratios)
+    is_parallel = sin_omega.abs() < eps
+    safe_sin_omega = torch.where(is_parallel, torch.ones_like(sin_omega), sin_omega)
+    start_weights = torch.where(is_parallel, 1 - ratios, torch.sin((1 - ratios) * omega) / safe_sin_omega)
+    end_weights = torch.where(is_parallel, ratios, torch.sin(ratios * omega) / safe_sin_omega)
+    return start_weights * start_latents.unsqueeze(1) + end_weights * end_latents.unsqueeze(1)
+
+
+INTERPOLATION_METHODS = {"linear": linear, "slerp": slerp}
+
+
+def _check_latent_shapes(start_latents, end_latents):
+    if start_latents.shape != end_latents.shape:
+        raise ValueError(
+            f"Start & end latents must have the same shape. Got: {start_latents.shape} & {end_latents.shape}"
+        )
+
+
+def interpolation_ratios(steps, device=None, dtype=torch.float32):
+    """
+    `steps + 1` evenly spaced ratios from 0 to 1, so both ends of each path are included.
+    """
+    if steps < 1:
+        raise ValueError(f"Need at least 1 interpolation step. Got: {steps}")
+    return torch.linspace(0, 1, steps + 1, device=device, dtype=dtype)
+
+
+def latent_grid(start_latents, end_latents, steps=10, method="linear"):
+    """
+    Build the latent codes of every path in one `(n_pairs, steps + 1, latent_size)` tensor.
+    """
+    assertIn(method, INTERPOLATION_METHODS.keys(), "Unexpected interpolation method.")
+    _check_latent_shapes(start_latents, end_latents)
+    ratios = interpolation_ratios(steps, device=start_latents.device, dtype=start_latents.dtype)
+    return INTERPOLATION_METHODS[method](start_latents, end_latents, ratios)
+
+
+def unique_steps(path):
+    """
+    Indices of the first occurrence of each distinct item along a path, in path order.
+    """
+    seen, indices = set(), []
+    for i, item in enumerate(path):
+        if item not in seen:
+            seen.add(item)
+            indices.append(i)
+    return indices
+
+
+def uniform_decodes_for_resolution(resolution):
+    """
+    Decodes per path needed to sample as finely as bisecting down to `resolution`.
+    """
+    return 2 ** max(0, math.ceil(math.log2(1 / resolution))) + 1
+
+
+def bisect_paths(start_latents, end_latents, decode, resolution=1 / 64, method="linear", key=None):
+    """
+    Find where decodings change along each path from `start_latents` to `end_latents` by bisection.
+
+    `decode` maps a `(n, latent_size)` tensor of latent codes to a list of `n` decodings, these are compared by
+    `key(decoding)` (or just the decoding).
+    A segment is only split at its midpoint when its ends decode differently & it is longer than `resolution`.
+    Segments with matching ends are assumed to decode the same throughout, so a sequence that appears & disappears
+    between two equal decodings is missed.
+    Each round of midpoints across all paths is decoded in a single `decode` call.
+
+    Returns each path's decodings as a `{ratio: decoding}` dict sorted by ratio & the number of latent codes decoded.
+    """
+    assertIn(method, INTERPOLATION_METHODS.keys(), "Unexpected interpolation method.")
+    _check_latent_shapes(start_latents, end_latents)
+    key = key if key is not None else (lambda decoding: decoding)
+    n_pairs = start_latents.size(0)
+    ends = decode(torch.cat([start_latents, end_latents]))
+    paths = [{0.0: ends[i], 1.0: ends[n_pairs + i]} for i in range(n_pairs)]
+    n_decodes = 2 * n_pairs
+
+    segments = [(i, 0.0, 1.0) for i in range(n_pairs)]
+    while True:
+        segments = [
+            (i, low, high)
+            for i, low, high in segments
+            if high - low > resolution and key(paths[i][low]) != key(paths[i][high])
+        ]
+        if not segments:
+            break
+        pair_ids = torch.tensor([i for i, _, _ in segments], device=start_latents.device)
+        mids = [(low + high) / 2 for _, low, high in segments]
+        ratios = torch.tensor(mids, device=start_latents.device, dtype=start_latents.dtype).view(-1, 1)
+        latents = INTERPOLATION_METHODS[method](start_latents[pair_ids], end_latents[pair_ids], ratios)[:, 0]
+        n_decodes += len(segments)
+        next_segments = []
+        for (i, low, high), mid, decoding in zip(segments, mids, decode(latents)):
+            paths[i][mid] = decoding
+            next_segments += [(i, low, mid), (i, mid, high)]
+        segments = next_segments
+
+    return [dict(sorted(path.items())) for path in paths], n_decodes
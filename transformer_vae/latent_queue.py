@@ -0,0 +1,73 @@
+import torch
+from torch import nn
+
+
+class LatentQueue(nn.Module):
+    """
+    Fixed capacity ring buffer of latent codes from previous training steps, used for MMD regularisation.
+
+    Capacity is `n_batches` times the size of the first batch added, after which adding latents never reallocates.
+    Batches of any size can be added, the oldest latents get overwritten.
+
+    Latents are stored as module buffers so the queue is saved & restored with model checkpoints.
+
+    NOTE: `latents` returns a view of the queue which the MMD regulariser reads in place.
+    So added latents are only written to the queue on the next step (once the previous backward pass is done).
+    """
+
+    def __init__(self, n_batches):
+        super().__init__()
+        self.n_batches = n_batches
+        self.register_buffer("queue", torch.zeros(0, 0))
+        self.register_buffer("n_stored", torch.zeros((), dtype=torch.long))
+        self.register_buffer("next_index", torch.zeros((), dtype=torch.long))
+        # python copies of the counters avoid reading them back from the device
+        self._n_stored = 0
+        self._next_index = 0
+        self._pending = None
+
+    @property
+    def capacity(self):
+        return self.queue.size(0)
+
+    def latents(self):
+        self._flush()
+        return self.queue[: self._n_stored]
+
+    def add(self, latent):
+        self._flush()
+        self._pending = latent.detach()
+
+    def _flush(self):
+        if self._pending is None:
+            return
+        latent, self._pending = self._pending, None
+        if self.capacity == 0:
+            self.queue = latent.new_zeros(self.n_batches * latent.size(0), latent.size(1))
+        latent = latent[-self.capacity :].to(self.queue.dtype)
+
+        end_index = self._next_index + latent.size(0)
+        if end_index <= self.capacity:
+            self.queue[self._next_index : end_index] = latent
+        else:
+            n_before_wrap = self.capacity - self._next_index
+            self.queue[self._next_index :] = latent[:n_before_wrap]
+            self.queue[: end_index - self.capacity] = latent[n_before_wrap:]
+
+        self._next_index = end_index % self.capacity
+        self._n_stored = min(self._n_stored + latent.size(0), self.capacity)
+        self.next_index.fill_(self._next_index)
+        self.n_stored.fill_(self._n_stored)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self._flush()
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        queue = state_dict.get(prefix + "queue")
+        if queue is not None and queue.size() != self.queue.size():
+            self.queue = self.queue.new_zeros(queue.size())
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._pending = None
+        self._n_stored = int(self.n_stored)
+        self._next_index = int(self.next_index)
@@ -0,0 +1,114 @@
+"""
+    Append-only memory-mapped store of latent codes, for encoding whole datasets.
+"""
+import numpy as np
+import torch
+
+from transformer_vae.shard_store import ShardReader, ShardWriter, has_manifest, read_manifest
+
+
+LATENT_DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+def latent_columns(manifest):
+    """
+    `{name: (dtype, row_shape)}` of each column in a latent store's shards.
+    """
+    return {
+        "latents": (LATENT_DTYPES[manifest["dtype"]], (manifest["latent_size"],)),
+        "row_ids": (np.int64, ()),
+    }
+
+
+class LatentStoreWriter(ShardWriter):
+    """
+    Writes latent codes into fixed size `.npy` shards in `path`, listed with their row ids in a json manifest.
+
+    Rows are written straight into memory-mapped shards so latents never need to be held in memory.
+    Opening a writer on an existing store appends new shards after the existing ones, these must use the same
+    checkpoint fingerprint & latent size.
+
+    Args:
+        path (:obj:`str`):
+            Directory to store the shards & manifest in.
+        latent_size (:obj:`int`):
+            Size of the latent codes.
+        dtype (:obj:`str`, `optional`, defaults to "float32"):
+            Type to store latents as, one of `LATENT_DTYPES`.
+        shard_size (:obj:`int`, `optional`, defaults to 1,000,000):
+            Maximum number of latent codes in each shard.
+        fingerprint (:obj:`str`, `optional`):
+            Identifies the checkpoint that made the latents, see `transformer_vae.utils.checkpoint_fingerprint`.
+    """
+
+    def __init__(self, path, latent_size, dtype="float32", shard_size=1_000_000, fingerprint=None):
+        if dtype not in LATENT_DTYPES:
+            raise ValueError(f'Unexpected latent dtype. Got: "{dtype}" Expected one of: {list(LATENT_DTYPES)}')
+        if has_manifest(path):
+            manifest = read_manifest(path)
+            for key, value in [("latent_size", latent_size), ("dtype", dtype), ("fingerprint", fingerprint)]:
+                if manifest[key] != value:
+                    raise ValueError(
+                        f"Can't append to a latent store with a different {key}. "
+                        f'Got: "{value}" Expected: "{manifest[key]}"'
+                    )
+        else:
+            manifest = dict(latent_size=latent_size, dtype=dtype, fingerprint=fingerprint, n_rows=0, shards=[])
+        super().__init__(path, manifest, shard_size)
+
+    def columns(self):
+        return latent_columns(self.manifest)
+
+    def add(self, latents, row_ids=None):
+        """
+        Append a `(batch_size, latent_size)` tensor or array of latent codes.
+        Row ids default to counting up from the number of rows already stored.
+        """
+        if isinstance(latents, torch.Tensor):
+            latents = latents.detach().cpu().numpy()
+        if latents.ndim != 2 or latents.shape[1] != self.manifest["latent_size"]:
+            raise ValueError(
+                f'Latents must have shape (batch_size, {self.manifest["latent_size"]}). Got: {tuple(latents.shape)}'
+            )
+        if row_ids is None:
+            row_ids = np.arange(self.manifest["n_rows"], self.manifest["n_rows"] + len(latents))
+        self._add_rows(latents=latents, row_ids=np.asarray(row_ids, dtype=np.int64))
+
+
+class LatentStore(ShardReader):
+    """
+    Reads a store made by `LatentStoreWriter`, each shard is a `(latents, row_ids)` pair.
+
+    Shards are memory-mapped copy-on-write so returned arrays & tensors are views of the files,
+    nothing is read until it is used & writes to them never reach the disk.
+    """
+
+    def columns(self):
+        return latent_columns(self.manifest)
+
+    @property
+    def latent_size(self):
+        return self.manifest["latent_size"]
+
+    @property
+    def fingerprint(self):
+        return self.manifest["fingerprint"]
+
+    def shard_tensor(self, index):
+        """
+        A zero-copy tensor view of a shard's latents.
+        """
+        return torch.from_numpy(self._shards[index][0])
+
+    def __getitem__(self, index):
+        (latents, _), row = self._locate(index)
+        return latents[row]
+
+    def numpy(self):
+        """
+        All latents as one array, only a view if the store has a single shard (otherwise they are concatenated).
+        """
+        return self._column(0)
+
+    def row_ids(self):
+        return self._column(1)
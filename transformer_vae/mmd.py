@@ -0,0 +1,326 @@
+"""
+    Kernels & estimators for the MMD-VAE regularisation loss.
+"""
+import math
+import torch
+import torch.distributed as dist
+
+
+def pairwise_sq_dists(x, y):
+    """
+    Squared euclidean distances between every row of `x` & every row of `y`, shape `(..., x_size, y_size)`.
+
+    Uses `|x|^2 + |y|^2 - 2 x.y` so no `(x_size, y_size, dim)` tensor is ever made.
+    Leading dimensions are treated as a batch.
+    """
+    x_sq = x.pow(2).sum(-1).unsqueeze(-1)
+    y_sq = y.pow(2).sum(-1).unsqueeze(-2)
+    return (x_sq + y_sq - 2 * x @ y.transpose(-1, -2)).clamp(min=0)
+
+
+def paired_sq_dists(x, y):
+    """
+    Squared euclidean distances between matching rows of `x` & `y`.
+    """
+    return (x - y).pow(2).sum(-1)
+
+
+class GaussianKernel:
+    """
+    The original MMD-VAE kernel `exp(-mean((x - y)^2) / dim)`.
+
+    Kernels also sample frequencies from their spectral distribution so they can be approximated with random
+    Fourier features, `kernel(x, y) ~= weight * mean(cos(w.(x - y)))`.
+    """
+
+    weight = 1.0
+
+    def __call__(self, sq_dists, dim):
+        return torch.exp(-sq_dists / (dim * dim))
+
+    def sample_frequencies(self, n_features, dim, device=None, dtype=None):
+        return torch.randn(dim, n_features, device=device, dtype=dtype) * (math.sqrt(2.0) / dim)
+
+
+class IMQKernel:
+    """
+    Inverse multiquadratic kernel `C / (C + |x - y|^2)` with `C = 2 * dim * scale` as used in WAE-MMD.
+    Has heavier tails than the Gaussian kernel so still gives useful gradients for latents far from the prior.
+    """
+
+    weight = 1.0
+
+    def __init__(self, scale=1.0):
+        self.scale = scale
+
+    def __call__(self, sq_dists, dim):
+        c = 2.0 * dim * self.scale
+        return c / (c + sq_dists)
+
+    def sample_frequencies(self, n_features, dim, device=None, dtype=None):
+        # `C / (C + r^2)` is a mixture of Gaussian kernels `exp(-t r^2)` with `t ~ Exponential(C)`
+        c = 2.0 * dim * self.scale
+        rates = torch.empty(n_features, device=device, dtype=dtype).exponential_(c)
+        return torch.randn(dim, n_features, device=device, dtype=dtype) * (2 * rates).sqrt()
+
+
+class MultiScaleIMQKernel:
+    """
+    Sum of IMQ kernels over a range of scales, avoids having to tune the kernel scale.
+    """
+
+    def __init__(self, scales=(0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)):
+        self.kernels = [IMQKernel(scale) for scale in scales]
+        self.weight = float(len(self.kernels))
+
+    def __call__(self, sq_dists, dim):
+        return sum(kernel(sq_dists, dim) for kernel in self.kernels)
+
+    def sample_frequencies(self, n_features, dim, device=None, dtype=None):
+        # each feature samples from one of the (equally weighted) kernels
+        chosen = torch.randint(len(self.kernels), (n_features,)).tolist()
+        counts = [chosen.count(i) for i in range(len(self.kernels))]
+        return torch.cat(
+            [
+                kernel.sample_frequencies(count, dim, device=device, dtype=dtype)
+                for kernel, count in zip(self.kernels, counts)
+            ],
+            dim=1,
+        )
+
+
+MMD_KERNELS = {
+    "gaussian": GaussianKernel,
+    "imq": IMQKernel,
+    "multi-scale": MultiScaleIMQKernel,
+}
+
+
+def _parts(x):
+    return tuple(x) if isinstance(x, (tuple, list)) else (x,)
+
+
+def _n_samples(x):
+    return sum(part.size(0) for part in _parts(x))
+
+
+def _concat(x):
+    parts = _parts(x)
+    return parts[0] if len(parts) == 1 else torch.cat(parts)
+
+
+def kernel_sum(x, y, kernel, block_size=None):
+    """
+    Sum of `kernel(x_i, y_j)` over all pairs of rows.
+
+    `x` & `y` may be tuples of tensors which are treated as if concatenated, without copying them.
+    Rows of `x` are processed `block_size` at a time so at most a `(block_size, y_size)` kernel matrix is held.
+    """
+    total = None
+    for x_part in _parts(x):
+        dim = x_part.size(1)
+        part_block_size = block_size or x_part.size(0)
+        for start in range(0, x_part.size(0), part_block_size):
+            x_block = x_part[start : start + part_block_size]
+            for y_part in _parts(y):
+                block_total = kernel(pairwise_sq_dists(x_block, y_part), dim).sum()
+                total = block_total if total is None else total + block_total
+    return total
+
+
+def compute_mmd(x, y, kernel, block_size=None):
+    """
+    Biased (V-statistic) estimate of the squared MMD between samples `x` & `y`.
+    """
+    x_size, y_size = _n_samples(x), _n_samples(y)
+    return (
+        kernel_sum(x, x, kernel, block_size) / (x_size * x_size)
+        + kernel_sum(y, y, kernel, block_size) / (y_size * y_size)
+        - 2 * kernel_sum(x, y, kernel, block_size) / (x_size * y_size)
+    )
+
+
+class MMDEstimator:
+    """
+    Estimates the squared MMD between 2 equally sized samples using `kernel`.
+    Samples may be given as tuples of tensors to avoid concatenating them.
+
+    Args:
+        kernel: One of `MMD_KERNELS`.
+        block_size (:obj:`int`, `optional`):
+            Number of latent codes to compare at once, bounds memory use.
+        n_features (:obj:`int`, `optional`):
+            Number of random features to use for kernel approximations.
+        estimator_block_size (:obj:`int`, `optional`):
+            Number of samples in each block of the `block` estimator.
+    """
+
+    def __init__(self, kernel, block_size=None, n_features=None, estimator_block_size=None):
+        self.kernel = kernel
+        self.block_size = block_size
+        self.n_features = n_features
+        self.estimator_block_size = estimator_block_size
+
+    def __call__(self, x, y):
+        raise NotImplementedError()
+
+    def grouped(self, x, y, group_size):
+        """
+        Sum of the MMDs between consecutive groups of `group_size` samples.
+        """
+        raise NotImplementedError()
+
+
+class ExactMMD(MMDEstimator):
+    """
+    Quadratic time estimate, compares every pair of latent codes.
+    """
+
+    def __call__(self, x, y):
+        return compute_mmd(x, y, self.kernel, self.block_size)
+
+    def _masked_kernel_sums(self, a, b, mask):
+        kernel = self.kernel(pairwise_sq_dists(a, b), a.size(-1))
+        return torch.einsum("gi,gij,gj->g", mask, kernel, mask)
+
+    def grouped(self, x, y, group_size):
+        """
+        Computes all groups in one batched operation over a `(groups, group_size, dim)` tensor.
+        If the number of samples isn't divisible by `group_size` the last group is padded & masked out.
+        """
+        n_samples, dim = x.size()
+        n_groups = -(-n_samples // group_size)
+        n_padding = n_groups * group_size - n_samples
+        mask = torch.ones(n_groups * group_size, device=x.device, dtype=x.dtype)
+        if n_padding:
+            x = torch.cat((x, x.new_zeros(n_padding, dim)))
+            y = torch.cat((y, y.new_zeros(n_padding, dim)))
+            mask[n_samples:] = 0
+        x = x.view(n_groups, group_size, dim)
+        y = y.view(n_groups, group_size, dim)
+        mask = mask.view(n_groups, group_size)
+
+        group_sizes_sq = mask.sum(1).pow(2)
+        return (
+            (
+                self._masked_kernel_sums(x, x, mask)
+                + self._masked_kernel_sums(y, y, mask)
+                - 2 * self._masked_kernel_sums(x, y, mask)
+            )
+            / group_sizes_sq
+        ).sum()
+
+
+class LinearMMD(MMDEstimator):
+    """
+    Linear time unbiased estimate from Gretton et al. 2012, only compares consecutive pairs of samples.
+    Cheapest estimate but has the highest variance.
+    """
+
+    def __call__(self, x, y):
+        x, y = _concat(x), _concat(y)
+        n = (min(x.size(0), y.size(0)) // 2) * 2
+        if n < 2:
+            raise ValueError(f"Need at least 2 samples for a linear MMD estimate. Got: {n}")
+        x1, x2, y1, y2 = x[0:n:2], x[1:n:2], y[0:n:2], y[1:n:2]
+        dim = x.size(1)
+        return (
+            self.kernel(paired_sq_dists(x1, x2), dim)
+            + self.kernel(paired_sq_dists(y1, y2), dim)
+            - self.kernel(paired_sq_dists(x1, y2), dim)
+            - self.kernel(paired_sq_dists(x2, y1), dim)
+        ).mean()
+
+
+class BlockMMD(MMDEstimator):
+    """
+    Block estimate from Zaremba et al. 2013, averages unbiased estimates over blocks of `estimator_block_size` samples.
+    Linear in the number of samples while having far lower variance than `LinearMMD`.
+    """
+
+    def __call__(self, x, y):
+        x, y = _concat(x), _concat(y)
+        dim = x.size(1)
+        block_size = min(self.estimator_block_size or 32, x.size(0), y.size(0))
+        n_blocks = min(x.size(0), y.size(0)) // block_size
+        if block_size < 2:
+            raise ValueError(f"Need blocks of at least 2 samples for a block MMD estimate. Got: {block_size}")
+        n = n_blocks * block_size
+        x = x[:n].view(n_blocks, block_size, dim)
+        y = y[:n].view(n_blocks, block_size, dim)
+
+        k_xx = self.kernel(pairwise_sq_dists(x, x), dim)
+        k_yy = self.kernel(pairwise_sq_dists(y, y), dim)
+        k_xy = self.kernel(pairwise_sq_dists(x, y), dim)
+        within = block_size * (block_size - 1)
+        block_mmds = (
+            (k_xx.sum((1, 2)) - k_xx.diagonal(dim1=1, dim2=2).sum(1)) / within
+            + (k_yy.sum((1, 2)) - k_yy.diagonal(dim1=1, dim2=2).sum(1)) / within
+            - 2 * k_xy.mean((1, 2))
+        )
+        return block_mmds.mean()
+
+
+class RandomFeatureMMD(MMDEstimator):
+    """
+    Approximates the kernel with `n_features` random Fourier features (Rahimi & Recht 2007).
+    The MMD is then the distance between the mean feature vectors of each sample, linear in the number of samples.
+    Frequencies are resampled every call so the kernel approximation error averages out over training.
+    """
+
+    def _mean_features(self, x, frequencies, phases):
+        total = sum(torch.cos(part @ frequencies + phases).sum(0) for part in _parts(x))
+        return total * math.sqrt(2.0 / frequencies.size(1)) / _n_samples(x)
+
+    def __call__(self, x, y):
+        n_features = self.n_features or 1_024
+        first = _parts(x)[0]
+        frequencies = self.kernel.sample_frequencies(n_features, first.size(1), device=first.device, dtype=first.dtype)
+        phases = torch.rand(n_features, device=first.device, dtype=first.dtype) * (2 * math.pi)
+        mean_diff = self._mean_features(x, frequencies, phases) - self._mean_features(y, frequencies, phases)
+        return self.kernel.weight * mean_diff.pow(2).sum()
+
+
+MMD_ESTIMATORS = {
+    "exact": ExactMMD,
+    "linear": LinearMMD,
+    "block": BlockMMD,
+    "rff": RandomFeatureMMD,
+}
+
+
+class _AllGatherWithLocalGrad(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, tensor):
+        world_size, rank = dist.get_world_size(), dist.get_rank()
+        local_size = torch.tensor([tensor.size(0)], device=tensor.device)
+        sizes = [torch.zeros_like(local_size) for _ in range(world_size)]
+        dist.all_gather(sizes, local_size)
+        sizes = [int(size) for size in sizes]
+
+        # all_gather needs equal sized tensors so pad to the largest batch
+        padded = tensor.new_zeros((max(sizes),) + tensor.shape[1:])
+        padded[: tensor.size(0)] = tensor
+        gathered = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded)
+
+        ctx.start = sum(sizes[:rank])
+        ctx.size = tensor.size(0)
+        ctx.world_size = world_size
+        return torch.cat([shard[:size] for shard, size in zip(gathered, sizes)])
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # DDP averages gradients over ranks so scale them to match the gradient of the global loss
+        return grad_output[ctx.start : ctx.start + ctx.size] * ctx.world_size
+
+
+def all_gather_latents(latent):
+    """
+    Concatenate latent codes from every process so the MMD is computed on the global batch.
+    Gradients only flow back through this process's latent codes.
+    Batch sizes may differ between processes.
+    """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return latent
+    return _AllGatherWithLocalGrad.apply(latent)
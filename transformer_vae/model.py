@@ -1,7 +1,9 @@
 """
     Base transformer-VAE model.
 """
+import copy
 import logging
+import os
 import pdb
 import torch
 from torch import nn
@@ -12,8 +14,24 @@ from transformers.modeling_outputs import BaseModelOutput
 from transformers.models.funnel.modeling_funnel import upsample
 
 from transformer_vae.autoencoders import VAE_ENCODER_MODELS, VAE_DECODER_MODELS
-from transformer_vae.model_outputs import BaseVAE_Output, BaseTransformerVAE_Output
+from transformer_vae.mmd import MMD_KERNELS, MMD_ESTIMATORS, all_gather_latents
+from transformer_vae.latent_queue import LatentQueue
+from transformer_vae.model_outputs import (
+    BaseVAE_Output,
+    BaseTransformerVAE_Output,
+    DecodedLatents_Output,
+    Interpolation_Output,
+    AdaptiveInterpolation_Output,
+)
+from transformer_vae.interpolation import (
+    bisect_paths,
+    interpolation_ratios,
+    latent_grid,
+    uniform_decodes_for_resolution,
+    unique_steps,
+)
 from transformer_vae.config import Transformer_VAE_Config
+from transformer_vae.utils import MetricsAccumulator, sigmoid
 
 from transformer_vae.config import T5_VAE_Config, Funnel_VAE_Config, Funnel_T5_VAE_Config, Funnel_gpt2_VAE_Config
 
@@ -21,15 +39,16 @@ from transformer_vae.config import T5_VAE_Config, Funnel_VAE_Config, Funnel_T5_V
 logger = logging.getLogger(__name__)
 
 
+QUANTIZED_WEIGHTS_NAME = "quantized_model.bin"
+
+
 class EncoderDecoderVAE(nn.Module):
     """
     An MMD-VAE used with encoder-decoder models.
     Encodes all token encodings into a single latent & spits them back out.
     """
 
-    batch_size = None
-
-    def __init__(self, encoder, decoder, use_n_previous_latent_codes=0, smaller_mmd_batch_size=None, use_reg_loss=True, use_latent_dropout=False, latent_dropout_schedule_k=0.0009, latent_dropout_schedule_b=11, max_latent_dropout_rate=0.9):
+    def __init__(self, encoder, decoder, use_n_previous_latent_codes=0, smaller_mmd_batch_size=None, use_reg_loss=True, use_latent_dropout=False, latent_dropout_schedule_k=0.0009, latent_dropout_schedule_b=11, max_latent_dropout_rate=0.9, mmd_kernel="gaussian", mmd_block_size=None, mmd_estimator="exact", mmd_n_features=None, mmd_estimator_block_size=None, distributed_mmd=False):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
@@ -37,14 +56,20 @@ class EncoderDecoderVAE(nn.Module):
         self.smaller_mmd_batch_size = smaller_mmd_batch_size
         if smaller_mmd_batch_size:
             assert use_n_previous_latent_codes == 0, "Can't use smaller mmd batch size AND use previous latent codes."
-        self.prev_latents = None
-        self.prev_latents_index = 0
+        self.latent_queue = LatentQueue(use_n_previous_latent_codes) if use_n_previous_latent_codes else None
         self.use_reg_loss = use_reg_loss
         self.use_latent_dropout = use_latent_dropout
         self.latent_dropout_schedule_k = latent_dropout_schedule_k
         self.latent_dropout_schedule_b = latent_dropout_schedule_b
         assert max_latent_dropout_rate < 1, "Must not dropout all latent tokens."
         self.max_latent_dropout_rate = max_latent_dropout_rate
+        self.mmd_estimator = MMD_ESTIMATORS[mmd_estimator](
+            MMD_KERNELS[mmd_kernel](),
+            block_size=mmd_block_size,
+            n_features=mmd_n_features,
+            estimator_block_size=mmd_estimator_block_size,
+        )
+        self.distributed_mmd = distributed_mmd
 
     def _model_forward(self, encoding, latent=None, global_step=None):
         latent_dropout = 0
@@ -60,9 +85,9 @@ class EncoderDecoderVAE(nn.Module):
         if global_step is None:
             return 0
         # edit using https://www.desmos.com/calculator/mqzxhecfxz
-        return self.max_latent_dropout_rate * torch.sigmoid(
-            torch.tensor(global_step * self.latent_dropout_schedule_k - self.latent_dropout_schedule_b)
-        ).item()
+        return self.max_latent_dropout_rate * sigmoid(
+            global_step * self.latent_dropout_schedule_k - self.latent_dropout_schedule_b
+        )
 
     def forward(
         self,
@@ -73,84 +98,38 @@ class EncoderDecoderVAE(nn.Module):
         if input_encoding is None and latent is None:
             raise ValueError("Both `input_encoding` and `latent` sent to VAE are Null.")
         recon_encoding, latent, latent_dropout = self._model_forward(input_encoding, latent=latent, global_step=global_step)
-        if self.use_reg_loss:
+        if self.use_reg_loss and input_encoding is not None:
             # TODO is this even valid with 90% dropout?
             reg_loss = self._regularliser_loss(latent)
             # latent[latent != 0].view(latent.size(0), -1) if self.use_latent_dropout and global_step else latent
         else:
-            reg_loss = torch.tensor(0, device=latent.device)
+            reg_loss = latent.new_zeros(())
         return BaseVAE_Output(latent=latent, reconstructed_encoding=recon_encoding, reg_loss=reg_loss, latent_dropout=latent_dropout)
 
-    @staticmethod
-    def _compute_kernel(x, y):
-        x_size = x.shape[0]
-        y_size = y.shape[0]
-        dim = x.shape[1]
-
-        tiled_x = x.view(x_size, 1, dim).repeat(1, y_size, 1)
-        tiled_y = y.view(1, y_size, dim).repeat(x_size, 1, 1)
-
-        return torch.exp(-torch.mean((tiled_x - tiled_y) ** 2, dim=2) / dim * 1.0)
-
     def _compute_mmd(self, x, y):
-        x_kernel = self._compute_kernel(x, x)
-        y_kernel = self._compute_kernel(y, y)
-        xy_kernel = self._compute_kernel(x, y)
-        return torch.mean(x_kernel) + torch.mean(y_kernel) - 2 * torch.mean(xy_kernel)
-
-    def _get_combined_latents(self, latent):
-        if self.prev_latents is None:
-            # if no previous latents use this call to get the training batch size
-            assert len(latent.size()) == 2
-            self.batch_size = latent.size(0)
-            self.prev_latents = torch.zeros(
-                (self.batch_size * self.use_n_previous_latent_codes, latent.size(1)), device=latent.device
-            )
-            # start by setting all previous to the first latent
-            for i in range(self.use_n_previous_latent_codes):
-                self.prev_latents[i * self.batch_size : (i + 1) * self.batch_size] = latent.detach()
-        # update prev_latents to include new latents, overwriting the oldest ones
-        return torch.cat((latent, self.prev_latents), 0)
-
-    def _update_prev_latents(self, latent):
-        if latent.size(0) < self.batch_size:
-            logger.warn(
-                f"Latent call has inconsistant batch size, skipping update previous latents. Expected: {self.batch_size} Got: {latent.size(0)}"
-            )
-            return None
-        self.prev_latents[
-            self.prev_latents_index * self.batch_size : (self.prev_latents_index + 1) * self.batch_size
-        ] = latent.detach()
-        self.prev_latents_index += 1
-        if self.prev_latents_index >= self.use_n_previous_latent_codes:
-            self.prev_latents_index = 0
+        return self.mmd_estimator(x, y)
 
     def _using_prev_latents(self):
         return self.training and self.use_n_previous_latent_codes > 0
 
     def _regularliser_loss(self, latent):
+        if self.training and self.distributed_mmd:
+            latent = all_gather_latents(latent)
         if self.training and self.smaller_mmd_batch_size:
-            batch_size = latent.size(0)
-            if batch_size // self.smaller_mmd_batch_size != batch_size / self.smaller_mmd_batch_size:
-                return self._batch_of_regularliser_loss(latent)
-            all_latents = latent.view(
-                latent.size(0) // self.smaller_mmd_batch_size, self.smaller_mmd_batch_size, latent.size(1)
-            )
-            total = torch.tensor(0.0, device=latent.device)
-            for latent_batch in all_latents:
-                total += self._batch_of_regularliser_loss(latent_batch)
-            return total
+            true_samples = torch.randn_like(latent)
+            return self.mmd_estimator.grouped(true_samples, latent, self.smaller_mmd_batch_size)
         return self._batch_of_regularliser_loss(latent)
 
     def _batch_of_regularliser_loss(self, latent):
-        if self._using_prev_latents():
-            combined_latent = self._get_combined_latents(latent)
-        else:
-            combined_latent = latent
-        true_samples = torch.randn(combined_latent.size()).to(combined_latent.device)
+        if not self._using_prev_latents():
+            return self._compute_mmd(torch.randn_like(latent), latent)
+        prev_latents = self.latent_queue.latents()
+        combined_latent = (latent, prev_latents) if prev_latents.size(0) else latent
+        true_samples = torch.randn(
+            latent.size(0) + prev_latents.size(0), latent.size(1), device=latent.device, dtype=latent.dtype
+        )
         result = self._compute_mmd(true_samples, combined_latent)
-        if self._using_prev_latents():
-            self._update_prev_latents(latent)
+        self.latent_queue.add(latent)
         return result
 
 
@@ -183,22 +162,16 @@ class Transformer_VAE_Base_Model(PreTrainedModel):
             weights.
     """
     base_model_prefix = "transformer"
+    # checkpoints from before latent queues were saved
+    authorized_missing_keys = [r"vae\.latent_queue\."]
     # config_class # impliment this!
     global_step = None
-    _calls_since_last_log = 0
-    latest_logs = {
-        "decoder_ce": 0,
-        "seq_accuracy": 0,
-        "token_accuracy": 0,
-        "reg_loss_w": 0,
-        "skip_conn_w": 0,
-        "latent_dropout": 0,
-        "reg_loss": 0,
-    }
-    _last_logs: Dict[str, float] = {}
+    log_keys = ["decoder_ce", "seq_accuracy", "token_accuracy", "reg_loss_w", "skip_conn_w", "latent_dropout", "reg_loss"]
 
     def __init__(self, config: Transformer_VAE_Config):
         super().__init__(config=config)
+        self._logs = MetricsAccumulator(self.log_keys)
+        self.decoder_start_token_id = config.transformer.decoder_start_token_id
 
         if config.transformer.model_type == "t5":
             self.transformer = AutoModelForSeq2SeqLM.from_config(config.transformer)
@@ -217,6 +190,12 @@ class Transformer_VAE_Base_Model(PreTrainedModel):
             self.config.latent_dropout_schedule_k,
             self.config.latent_dropout_schedule_b,
             self.config.max_latent_dropout_rate,
+            mmd_kernel=self.config.mmd_kernel,
+            mmd_block_size=self.config.mmd_block_size,
+            mmd_estimator=self.config.mmd_estimator,
+            mmd_n_features=self.config.mmd_n_features,
+            mmd_estimator_block_size=self.config.mmd_estimator_block_size,
+            distributed_mmd=self.config.distributed_mmd,
         )
 
     def get_input_embeddings(self):
@@ -236,22 +215,17 @@ class Transformer_VAE_Base_Model(PreTrainedModel):
         if self.global_step is None or not self.config.use_reg_loss:
             return 0
         # edit using https://www.desmos.com/calculator/mqzxhecfxz
-        return torch.sigmoid(
-            torch.tensor(self.global_step * self.config.reg_schedule_k - self.config.reg_schedule_b)
-        ).item()
+        return sigmoid(self.global_step * self.config.reg_schedule_k - self.config.reg_schedule_b)
 
     def _skip_conn_schedule(self):
         if self.global_step is None:
             return 0
         # edit using https://www.desmos.com/calculator/wfzduw7ioa
-        return 1 - torch.sigmoid(
-            torch.tensor(self.global_step * self.config.skip_schedule_k - self.config.skip_schedule_b)
-        ).item()
+        return 1 - sigmoid(self.global_step * self.config.skip_schedule_k - self.config.skip_schedule_b)
 
     def _update_logs(self, **logs):
-        self._calls_since_last_log += 1
-        for k, v in logs.items():
-            self.latest_logs[k] = self.latest_logs.get(k, 0) + v
+        # logs are kept on device, only read in `get_latest_logs`
+        self._logs.add(**logs)
 
     def get_latest_logs(self):
         """
@@ -260,30 +234,258 @@ class Transformer_VAE_Base_Model(PreTrainedModel):
         Logs are normalised by the number of training inferences since the last log.
         """
         assert self.config.use_extra_logs
-        if self._calls_since_last_log < 1:
-            return {}
-
-        result = dict(self.latest_logs)
-        for k, v in result.items():
-            value_increase = v - self._last_logs.get(k, 0)
-            result[k] = value_increase / self._calls_since_last_log
-
-        self._last_logs = dict(self.latest_logs)
-        self._calls_since_last_log = 0
+        return self._logs.pop_means()
 
-        return result
-
-    def prepare_inputs_for_generation(self, input_ids: torch.LongTensor, latent=None, **kwargs) -> Dict[str, Any]:
+    def prepare_inputs_for_generation(
+        self, input_ids: torch.LongTensor, latent=None, past=None, **kwargs
+    ) -> Dict[str, Any]:
         """
         Should only be generating text from latent codes.
+
+        Once the decoder returns its cached keys & values only the last token is needed as input.
         """
         assert (
             latent is not None
         ), "Generation with Transformer-VAE's expects to be given a latent code to generate from."
-        for rm_key in ["past", "attention_mask"]:
-            if rm_key in kwargs:
-                del kwargs[rm_key]
-        return {"decoder_input_ids": input_ids, "latent": latent, **kwargs}
+        if "attention_mask" in kwargs:
+            del kwargs["attention_mask"]
+        if past is not None:
+            input_ids = input_ids[:, -1:]
+        return {"decoder_input_ids": input_ids, "latent": latent, "past_key_values": past, **kwargs}
+
+    def _upsample_encoding(self, reconstructed_encoding):
+        """
+        Converts the VAE's reconstructed encoding into the hidden states the decoder attends to.
+        """
+        return reconstructed_encoding
+
+    def latent_to_encoding(self, latent):
+        """
+        Decode latent codes into the hidden states the transformer decoder attends to.
+        """
+        return self._upsample_encoding(self.vae.decoder(latent))
+
+    def _vae_forward(self, encoder_outputs, latent, encoder_hidden_states=None):
+        """
+        Runs the VAE, returning its outputs & the hidden states for the decoder to attend to.
+        If these hidden states are already given (as in `generate`) the VAE is skipped.
+        """
+        if encoder_hidden_states is not None:
+            return BaseVAE_Output(latent=latent, reg_loss=encoder_hidden_states.new_zeros(())), encoder_hidden_states
+        vae_outputs = self.vae(
+            input_encoding=encoder_outputs.last_hidden_state if encoder_outputs else None, latent=latent, global_step=self.global_step
+        )
+        return vae_outputs, self._upsample_encoding(vae_outputs.reconstructed_encoding)
+
+    def _encode_sequence(self, input_ids, attention_mask):
+        """
+        Runs the transformer encoder, returning the token encodings the VAE compresses into a latent.
+        """
+        raise NotImplementedError()
+
+    @torch.no_grad()
+    def encode(self, input_ids, attention_mask=None):
+        """
+        Encode a batch of token ids into `(batch_size, latent_size)` latent codes.
+
+        Only the transformer encoder & the VAE's encoder are run, the decoder & regularisation loss are skipped.
+        """
+        if attention_mask is None:
+            attention_mask = input_ids.ne(self.config.transformer.pad_token_id).long()
+        return self.vae.encoder(self._encode_sequence(input_ids, attention_mask))
+
+    def tokenize_texts(self, texts, tokenizer):
+        """
+        Tokenize a batch of texts into tensors on the model's device, padded as the model expects.
+        """
+        padding_kwargs = (
+            dict(padding="max_length", max_length=self.config.transformer.n_positions)
+            if self.config.padding_input
+            else dict(padding="longest")
+        )
+        return tokenizer(texts, truncation=True, return_tensors="pt", **padding_kwargs).to(self.device)
+
+    @torch.no_grad()
+    def encode_texts(self, texts, tokenizer, batch_size=64):
+        """
+        Encode a list of texts into a `(n_texts, latent_size)` tensor of latent codes, `batch_size` texts at a time.
+        """
+        latents = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenize_texts(texts[start : start + batch_size], tokenizer)
+            latents.append(self.encode(inputs["input_ids"], inputs["attention_mask"]))
+        return torch.cat(latents)
+
+    @torch.no_grad()
+    def generate(self, input_ids=None, latent=None, **model_kwargs):
+        """
+        Generate sequences from latent codes, see `transformers.generation_utils.GenerationMixin.generate`.
+
+        The latent's reconstructed encoding is the same for every generated token so it is computed once here
+        & passed to each decoding step as `encoder_hidden_states`.
+        """
+        if latent is not None and model_kwargs.get("encoder_hidden_states") is None:
+            model_kwargs["encoder_hidden_states"] = self.latent_to_encoding(latent)
+        return super().generate(input_ids=input_ids, latent=latent, **model_kwargs)
+
+    @torch.no_grad()
+    def decode_latents(self, latents, tokenizer=None, batch_size=64, **generate_kwargs):
+        """
+        Generate sequences from a `(n_latents, latent_size)` tensor of latent codes.
+
+        Latent codes are decoded in batches of `batch_size`, extra keyword arguments are passed to `generate`.
+        Returns a :class:`~transformer_vae.model_outputs.DecodedLatents_Output`, with texts if given a `tokenizer`.
+        """
+        pad_token_id = tokenizer.pad_token_id if tokenizer is not None else self.config.transformer.pad_token_id
+        pad_token_id = 0 if pad_token_id is None else pad_token_id
+        generate_kwargs.setdefault("pad_token_id", pad_token_id)
+        chunks = []
+        for latent_batch in latents.split(batch_size):
+            start_ids = torch.full(
+                (latent_batch.size(0), 1), self.decoder_start_token_id, dtype=torch.long, device=latent_batch.device
+            )
+            chunks.append(
+                self.generate(
+                    input_ids=start_ids, latent=latent_batch, bos_token_id=self.decoder_start_token_id, **generate_kwargs
+                )
+            )
+        max_len = max(chunk.size(1) for chunk in chunks)
+        sequences = torch.cat([nn.functional.pad(chunk, (0, max_len - chunk.size(1)), value=pad_token_id) for chunk in chunks])
+        texts = tokenizer.batch_decode(sequences, skip_special_tokens=True) if tokenizer is not None else None
+        return DecodedLatents_Output(sequences=sequences, texts=texts)
+
+    @torch.no_grad()
+    def interpolate(
+        self, start_latents, end_latents, steps=10, method="linear", tokenizer=None, batch_size=64, **generate_kwargs
+    ):
+        """
+        Decode sequences along paths between pairs of `(n_pairs, latent_size)` start & end latent codes.
+
+        Every path has `steps + 1` points including its ends, using `method` ("linear" or "slerp") from
+        `transformer_vae.interpolation.INTERPOLATION_METHODS`.
+        The whole grid of latent codes is built at once & decoded `batch_size` latents at a time, so many short paths
+        decode as efficiently as a few long ones.
+        Returns a :class:`~transformer_vae.model_outputs.Interpolation_Output` with each path's distinct sequences.
+        """
+        latent_size = self.config.latent_size
+        latents = latent_grid(start_latents.view(-1, latent_size), end_latents.view(-1, latent_size), steps, method)
+        n_pairs, n_steps = latents.shape[:2]
+        decoded = self.decode_latents(
+            latents.view(n_pairs * n_steps, -1), tokenizer=tokenizer, batch_size=batch_size, **generate_kwargs
+        )
+        sequences = decoded.sequences.view(n_pairs, n_steps, -1)
+        texts = unique_texts = None
+        if decoded.texts is not None:
+            texts = [decoded.texts[i * n_steps : (i + 1) * n_steps] for i in range(n_pairs)]
+            path_unique_steps = [unique_steps(path) for path in texts]
+            unique_texts = [[path[i] for i in indices] for path, indices in zip(texts, path_unique_steps)]
+        else:
+            path_unique_steps = [unique_steps(map(tuple, path.tolist())) for path in sequences]
+        return Interpolation_Output(
+            ratios=interpolation_ratios(steps, device=latents.device, dtype=latents.dtype),
+            latents=latents,
+            sequences=sequences,
+            unique_steps=path_unique_steps,
+            texts=texts,
+            unique_texts=unique_texts,
+        )
+
+    @torch.no_grad()
+    def interpolate_adaptive(
+        self,
+        start_latents,
+        end_latents,
+        resolution=1 / 64,
+        method="linear",
+        tokenizer=None,
+        batch_size=64,
+        **generate_kwargs,
+    ):
+        """
+        Find every distinct sequence along paths between pairs of latent codes, decoding only where the sequence changes.
+
+        Each path is recursively bisected, a segment is only split when its ends decode differently (comparing texts
+        if given a `tokenizer`) until it is no longer than `resolution`, see `transformer_vae.interpolation.bisect_paths`.
+        Most of a path decodes to a few long plateaus so this needs far fewer decodes than uniform sampling.
+        Returns a :class:`~transformer_vae.model_outputs.AdaptiveInterpolation_Output` with the decodes saved.
+        """
+        pad_token_id = generate_kwargs.get("pad_token_id", tokenizer.pad_token_id if tokenizer is not None else None)
+        pad_token_id = self.config.transformer.pad_token_id if pad_token_id is None else pad_token_id
+
+        def decode(latents):
+            decoded = self.decode_latents(latents, tokenizer=tokenizer, batch_size=batch_size, **generate_kwargs)
+            sequences = []
+            for sequence in decoded.sequences.tolist():
+                # sequences are padded to the longest in their batch, remove it to compare across batches
+                while len(sequence) > 1 and sequence[-1] == pad_token_id:
+                    sequence.pop()
+                sequences.append(sequence)
+            texts = decoded.texts if decoded.texts is not None else [None] * len(sequences)
+            return list(zip(sequences, texts))
+
+        def key(decoding):
+            sequence, text = decoding
+            return tuple(sequence) if text is None else text
+
+        latent_size = self.config.latent_size
+        start_latents, end_latents = start_latents.view(-1, latent_size), end_latents.view(-1, latent_size)
+        paths, n_decodes = bisect_paths(start_latents, end_latents, decode, resolution=resolution, method=method, key=key)
+
+        change_ratios = []
+        for path in paths:
+            ratios = list(path.keys())
+            change_ratios.append(
+                [ratio for j, ratio in enumerate(ratios) if j == 0 or key(path[ratio]) != key(path[ratios[j - 1]])]
+            )
+        n_uniform_decodes = len(paths) * uniform_decodes_for_resolution(resolution)
+        texts = change_texts = None
+        if tokenizer is not None:
+            texts = [[text for _, text in path.values()] for path in paths]
+            change_texts = [[path[ratio][1] for ratio in ratios] for path, ratios in zip(paths, change_ratios)]
+        return AdaptiveInterpolation_Output(
+            ratios=[list(path.keys()) for path in paths],
+            sequences=[[sequence for sequence, _ in path.values()] for path in paths],
+            change_ratios=change_ratios,
+            n_decodes=n_decodes,
+            n_uniform_decodes=n_uniform_decodes,
+            n_decodes_saved=n_uniform_decodes - n_decodes,
+            texts=texts,
+            change_texts=change_texts,
+        )
+
+    def quantize(self, inplace=False):
+        """
+        Dynamically quantize the model's `nn.Linear` layers to int8 for CPU inference.
+
+        This covers the transformer's attention & feed-forward layers along with the VAE's bottleneck layers
+        (e.g. `LatentEncoder.shrink_sequence` & `LatentDecoder.grow_sequence`), embeddings & layer norms stay fp32.
+        Weights are stored as int8 & activations are quantized on the fly so no calibration data is needed.
+
+        NOTE: gpt2 decoders use `transformers.Conv1D` layers which are left in fp32.
+        """
+        model = self if inplace else copy.deepcopy(self)
+        model.cpu().eval()
+        return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def save_quantized(self, save_directory):
+        """
+        Save a quantized model's config & weights, reload it with `from_quantized`.
+
+        Quantized weights can't be loaded by `from_pretrained` so they are saved separately as `QUANTIZED_WEIGHTS_NAME`.
+        """
+        os.makedirs(save_directory, exist_ok=True)
+        self.config.save_pretrained(save_directory)
+        torch.save(self.state_dict(), os.path.join(save_directory, QUANTIZED_WEIGHTS_NAME))
+
+    @classmethod
+    def from_quantized(cls, save_directory):
+        """
+        Load a model saved with `save_quantized`, the model is rebuilt from its config & quantized before loading.
+        """
+        config = cls.config_class.from_pretrained(save_directory)
+        model = cls(config).quantize(inplace=True)
+        model.load_state_dict(torch.load(os.path.join(save_directory, QUANTIZED_WEIGHTS_NAME), map_location="cpu"))
+        return model
 
     def forward(
         self,
@@ -331,10 +533,18 @@ class T5_VAE_Model(Transformer_VAE_Base_Model):
         # replace possible -100 values in labels by `pad_token_id`
         shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
 
-        assert torch.all(shifted_input_ids >= 0).item(), "Verify that `shifted_input_ids` has only positive values"
+        if self.config.debug_checks:
+            assert torch.all(shifted_input_ids >= 0).item(), "Verify that `shifted_input_ids` has only positive values"
 
         return shifted_input_ids
 
+    def _encode_sequence(self, input_ids, attention_mask):
+        if self.config.prepend_eos_token:
+            input_ids = self._shift_input_right(input_ids)
+        return self.transformer.encoder(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True
+        ).last_hidden_state
+
     def forward(
         self,
         input_ids=None,
@@ -343,6 +553,8 @@ class T5_VAE_Model(Transformer_VAE_Base_Model):
         encoder_outputs=None,
         decoder_input_ids=None,
         latent=None,
+        encoder_hidden_states=None,
+        past_key_values=None,
         use_cache=None,
         return_dict=True,
         **unused_kwargs
@@ -366,9 +578,7 @@ class T5_VAE_Model(Transformer_VAE_Base_Model):
                 attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
             )
 
-        vae_outputs = self.vae(
-            input_encoding=encoder_outputs.last_hidden_state if encoder_outputs else None, latent=latent, global_step=self.global_step
-        )
+        vae_outputs, encoder_hidden_states = self._vae_forward(encoder_outputs, latent, encoder_hidden_states)
 
         if labels is not None and decoder_input_ids is None:
             # get decoder inputs from shifting lm labels to the right
@@ -376,7 +586,8 @@ class T5_VAE_Model(Transformer_VAE_Base_Model):
 
         decoder_outputs = self.transformer.decoder(
             input_ids=decoder_input_ids,
-            encoder_hidden_states=vae_outputs.reconstructed_encoding,
+            encoder_hidden_states=encoder_hidden_states,
+            past_key_values=past_key_values,
             use_cache=use_cache,
             return_dict=True,
         )
@@ -387,17 +598,31 @@ class T5_VAE_Model(Transformer_VAE_Base_Model):
         sequence_output = sequence_output * (self.config.transformer.d_model ** -0.5)
         lm_logits = self.transformer.lm_head(sequence_output)
 
-        decoder_ce = torch.tensor(0.0, device=lm_logits.device)
+        decoder_ce = lm_logits.new_zeros(())
+        seq_accuracy = lm_logits.new_zeros(())
+        token_accuracy = lm_logits.new_zeros(())
         if labels is not None:
             loss_fct = nn.CrossEntropyLoss(ignore_index=-100)
             decoder_ce = loss_fct(lm_logits.view(-1, lm_logits.size(-1)), labels.view(-1))
             # TODO(thom): Add z_loss https://github.com/tensorflow/mesh/blob/fa19d69eafc9a482aff0b59ddd96b025c0cb207d/mesh_tensorflow/layers.py#L666
+            chosen_tokens = torch.argmax(lm_logits, 2)
+            pad_tokens = (labels == -100).int()
+            correct_tokens = (chosen_tokens == labels).int() + pad_tokens
+            seq_accuracy = (torch.min(correct_tokens, dim=1).values.sum() / labels.size(0)).detach()
+            num_pad_tokens = pad_tokens.sum()
+            token_accuracy = ((correct_tokens.sum() - num_pad_tokens) / (labels.numel() - num_pad_tokens)).detach()
 
         reg_loss_w = self._regulariser_loss_weight_schedule()
         loss = decoder_ce + vae_outputs.reg_loss * reg_loss_w
 
         if self.training and self.config.use_extra_logs:
-            self._update_logs(decoder_ce=decoder_ce.item(), reg_loss=vae_outputs.reg_loss.item(), reg_loss_w=reg_loss_w)
+            self._update_logs(
+                decoder_ce=decoder_ce,
+                seq_accuracy=seq_accuracy,
+                token_accuracy=token_accuracy,
+                reg_loss=vae_outputs.reg_loss,
+                reg_loss_w=reg_loss_w,
+            )
 
         return BaseTransformerVAE_Output(
             loss=loss,
@@ -412,7 +637,8 @@ class T5_VAE_Model(Transformer_VAE_Base_Model):
             latent=vae_outputs.latent,
             reg_loss=vae_outputs.reg_loss,
             decoder_ce=decoder_ce,
-            accuracy=None,
+            seq_accuracy=seq_accuracy,
+            token_accuracy=token_accuracy,
         )
 
 
@@ -420,6 +646,13 @@ class Funnel_VAE_Model_Base(Transformer_VAE_Base_Model):
     def get_input_embeddings(self):
         return self.transformer.funnel.embeddings.word_embeddings
 
+    def _encode_sequence(self, input_ids, attention_mask):
+        if self.config.prepend_eos_token:
+            raise NotImplementedError()
+        return self._get_encoder_outputs(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=True
+        ).last_hidden_state
+
     def _get_encoder_outputs(
         self,
         input_ids=None,
@@ -482,6 +715,43 @@ class Funnel_VAE_Model(Funnel_VAE_Model_Base):
     """
     config_class = Funnel_VAE_Config
 
+    def _decode(self, encoder_hidden_states):
+        initial_encoding_size = (
+            encoder_hidden_states.size(0),
+            self.config.transformer.n_positions,
+            self.config.transformer.d_model,
+        )
+        decoder_outputs = self.transformer.funnel.decoder(
+            final_hidden=encoder_hidden_states,
+            # Don't allow for residual connections, instead just send an empty tensor.
+            first_block_hidden=torch.zeros(initial_encoding_size, device=encoder_hidden_states.device),
+            return_dict=True,
+        )
+        return decoder_outputs, self.transformer.lm_head(decoder_outputs.last_hidden_state)
+
+    @torch.no_grad()
+    def decode_latents(
+        self, latents, tokenizer=None, batch_size=64, do_sample=False, temperature=1.0, max_length=None, **unused_kwargs
+    ):
+        """
+        Decode a `(n_latents, latent_size)` tensor of latent codes without `generate`.
+
+        The Funnel decoder predicts every position at once so each batch of `batch_size` latent codes takes a single
+        forward pass, taking the most likely token at each position or sampling them when `do_sample` is set.
+        Returns a :class:`~transformer_vae.model_outputs.DecodedLatents_Output`, with texts if given a `tokenizer`.
+        """
+        chunks = []
+        for latent_batch in latents.split(batch_size):
+            _, logits = self._decode(self.latent_to_encoding(latent_batch))
+            if do_sample:
+                probs = nn.functional.softmax(logits / temperature, dim=-1)
+                chunks.append(torch.multinomial(probs.view(-1, probs.size(-1)), 1).view(logits.size()[:-1]))
+            else:
+                chunks.append(logits.argmax(-1))
+        sequences = torch.cat(chunks)[:, :max_length]
+        texts = tokenizer.batch_decode(sequences, skip_special_tokens=True) if tokenizer is not None else None
+        return DecodedLatents_Output(sequences=sequences, texts=texts)
+
     def forward(
         self,
         input_ids=None,
@@ -490,13 +760,14 @@ class Funnel_VAE_Model(Funnel_VAE_Model_Base):
         encoder_outputs=None,
         decoder_input_ids=None,
         latent=None,
+        encoder_hidden_states=None,
         return_dict=True,
         **unused_kwargs
     ):
         assert return_dict, "Need return_dict=True, using tuple's is not implimented"
 
         if input_ids is not None:
-            if decoder_input_ids is not None and input_ids.equal(decoder_input_ids) is False:
+            if self.config.debug_checks and decoder_input_ids is not None and input_ids.equal(decoder_input_ids) is False:
                 raise ValueError(
                     "`input_ids` and `decoder_input_ids` do not match. Funnel-VAE can only reproduce its input sequence."
                 )
@@ -517,27 +788,10 @@ class Funnel_VAE_Model(Funnel_VAE_Model_Base):
                 attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
             )
 
-        vae_outputs = self.vae(
-            input_encoding=encoder_outputs.last_hidden_state if encoder_outputs else None, latent=latent, global_step=self.global_step
-        )
+        vae_outputs, encoder_hidden_states = self._vae_forward(encoder_outputs, latent, encoder_hidden_states)
+        decoder_outputs, prediction_logits = self._decode(encoder_hidden_states)
 
-        initial_encoding_size = (
-            vae_outputs.reconstructed_encoding.size(0),
-            self.config.transformer.n_positions,
-            self.config.transformer.d_model,
-        )
-
-        decoder_outputs = self.transformer.funnel.decoder(
-            final_hidden=vae_outputs.reconstructed_encoding,
-            # Don't allow for residual connections, instead just send an empty tensor.
-            first_block_hidden=torch.zeros(initial_encoding_size, device=vae_outputs.reconstructed_encoding.device),
-            return_dict=True,
-        )
-
-        last_hidden_state = decoder_outputs.last_hidden_state
-        prediction_logits = self.transformer.lm_head(last_hidden_state)
-
-        decoder_ce = torch.tensor(0.0, device=prediction_logits.device)
+        decoder_ce = prediction_logits.new_zeros(())
         if labels is not None:
             loss_fct = nn.CrossEntropyLoss()  # -100 index = padding token
             decoder_ce = loss_fct(prediction_logits.view(-1, self.config.transformer.vocab_size), labels.view(-1))
@@ -546,7 +800,7 @@ class Funnel_VAE_Model(Funnel_VAE_Model_Base):
         loss = decoder_ce + vae_outputs.reg_loss * reg_loss_w
 
         if self.training and self.config.use_extra_logs:
-            self._update_logs(decoder_ce=decoder_ce.item(), reg_loss=vae_outputs.reg_loss.item(), reg_loss_w=reg_loss_w)
+            self._update_logs(decoder_ce=decoder_ce, reg_loss=vae_outputs.reg_loss, reg_loss_w=reg_loss_w)
 
         return BaseTransformerVAE_Output(
             loss=loss,
@@ -586,6 +840,18 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
             self.decoder_start_token_id is not None
         ), "`self.config.transformer_decoder.decoder_start_token_id` has to be defined. In T5 it is usually set to the pad_token_id. See T5 docs for more information"
 
+    def _upsample_encoding(self, reconstructed_encoding):
+        # TODO allow more options here, specifically allow an extra encoder block after upsampling
+        if not self.config.padding_input:
+            return reconstructed_encoding
+        return upsample(
+            reconstructed_encoding,
+            stride=2 ** (len(self.config.transformer.block_sizes) - 1),
+            target_len=self.config.transformer_decoder.n_positions,
+            separate_cls=self.config.transformer.separate_cls,
+            truncate_seq=self.config.transformer.truncate_seq,
+        )
+
     def _shift_right(self, input_ids):
         decoder_start_token_id = self.config.transformer_decoder.decoder_start_token_id
         pad_token_id = self.config.transformer_decoder.pad_token_id
@@ -599,7 +865,8 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
         # replace possible -100 values in labels by `pad_token_id`
         shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
 
-        assert torch.all(shifted_input_ids >= 0).item(), "Verify that `shifted_input_ids` has only positive values"
+        if self.config.debug_checks:
+            assert torch.all(shifted_input_ids >= 0).item(), "Verify that `shifted_input_ids` has only positive values"
 
         return shifted_input_ids
 
@@ -611,6 +878,8 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
         encoder_outputs=None,
         decoder_input_ids=None,
         latent=None,
+        encoder_hidden_states=None,
+        past_key_values=None,
         use_cache=None,
         return_dict=True,
         **unused_kwargs
@@ -619,7 +888,7 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
         use_cache = use_cache if use_cache is not None else self.config.use_cache
 
         if input_ids is not None:
-            if decoder_input_ids is not None and input_ids.equal(decoder_input_ids) is False:
+            if self.config.debug_checks and decoder_input_ids is not None and input_ids.equal(decoder_input_ids) is False:
                 raise ValueError(
                     "`input_ids` and `decoder_input_ids` do not match. Funnel-VAE can only reproduce its input sequence."
                 )
@@ -640,21 +909,7 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
                 attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
             )
 
-        vae_outputs = self.vae(
-            input_encoding=encoder_outputs.last_hidden_state if encoder_outputs else None, latent=latent, global_step=self.global_step
-        )
-
-        # TODO allow more options here, specifically allow an extra encoder block after upsampling
-        if self.config.padding_input:
-            upsampled_encoding = upsample(
-                vae_outputs.reconstructed_encoding,
-                stride=2 ** (len(self.config.transformer.block_sizes) - 1),
-                target_len=self.config.transformer_decoder.n_positions,
-                separate_cls=self.config.transformer.separate_cls,
-                truncate_seq=self.config.transformer.truncate_seq,
-            )
-        else:
-            upsampled_encoding = vae_outputs.reconstructed_encoding
+        vae_outputs, upsampled_encoding = self._vae_forward(encoder_outputs, latent, encoder_hidden_states)
 
         skip_conn_w = 0
         if encoder_outputs and self.config.use_skip_connection:
@@ -672,7 +927,11 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
             decoder_input_ids = self._shift_right(labels) if labels is not None else None
 
         decoder_outputs = self.transformer.decoder(
-            input_ids=decoder_input_ids, encoder_hidden_states=upsampled_encoding, use_cache=use_cache, return_dict=True
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=upsampled_encoding,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            return_dict=True,
         )
 
         sequence_output = decoder_outputs.last_hidden_state
@@ -681,9 +940,9 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
         sequence_output = sequence_output * (self.config.transformer.d_model ** -0.5)
         lm_logits = self.transformer.lm_head(sequence_output)
 
-        decoder_ce = torch.tensor(0.0, device=lm_logits.device)
-        seq_accuracy = torch.tensor(0.0, device=lm_logits.device)
-        token_accuracy = torch.tensor(0.0, device=lm_logits.device)
+        decoder_ce = lm_logits.new_zeros(())
+        seq_accuracy = lm_logits.new_zeros(())
+        token_accuracy = lm_logits.new_zeros(())
         if labels is not None:
             loss_fct = nn.CrossEntropyLoss(ignore_index=-100)
             decoder_ce = loss_fct(lm_logits.view(-1, lm_logits.size(-1)), labels.view(-1))
@@ -699,7 +958,7 @@ class Funnel_T5_VAE_Model(Funnel_VAE_Model_Base):
 
         if self.training and self.config.use_extra_logs:
             self._update_logs(
-                decoder_ce=decoder_ce.item(), seq_accuracy=seq_accuracy, token_accuracy=token_accuracy, reg_loss=vae_outputs.reg_loss.item(),
+                decoder_ce=decoder_ce, seq_accuracy=seq_accuracy, token_accuracy=token_accuracy, reg_loss=vae_outputs.reg_loss,
                 reg_loss_w=reg_loss_w, skip_conn_w=skip_conn_w, latent_dropout=vae_outputs.latent_dropout
             )
 
@@ -741,6 +1000,21 @@ class Funnel_gpt2_VAE_Model(Funnel_VAE_Model_Base):
             self.decoder_start_token_id is not None
         ), "`self.config.transformer_decoder.bos_token_id` has to be defined."
 
+    def _upsample_encoding(self, reconstructed_encoding):
+        # TODO allow more options here
+        if not self.config.padding_input:
+            return reconstructed_encoding
+        if getattr(self.config, "use_skip_connection", False):
+            # TODO use skip connections like in the O.G. Funnel model
+            raise NotImplementedError()
+        return upsample(
+            reconstructed_encoding,
+            stride=2 ** (len(self.config.transformer.block_sizes) - 1),
+            target_len=self.config.transformer_decoder.n_positions,
+            separate_cls=self.config.transformer.separate_cls,
+            truncate_seq=self.config.transformer.truncate_seq,
+        )
+
     def _shift_right(self, input_ids):
         shifted_input_ids = input_ids.new_zeros(input_ids.shape)
         shifted_input_ids[..., 1:] = input_ids[..., :-1].clone()
@@ -755,6 +1029,8 @@ class Funnel_gpt2_VAE_Model(Funnel_VAE_Model_Base):
         encoder_outputs=None,
         decoder_input_ids=None,
         latent=None,
+        encoder_hidden_states=None,
+        past_key_values=None,
         use_cache=None,
         return_dict=True,
         **unused_kwargs
@@ -763,7 +1039,7 @@ class Funnel_gpt2_VAE_Model(Funnel_VAE_Model_Base):
         use_cache = use_cache if use_cache is not None else self.config.use_cache
 
         if input_ids is not None:
-            if decoder_input_ids is not None and input_ids.equal(decoder_input_ids) is False:
+            if self.config.debug_checks and decoder_input_ids is not None and input_ids.equal(decoder_input_ids) is False:
                 raise ValueError(
                     "`input_ids` and `decoder_input_ids` do not match. Funnel-VAE can only reproduce its input sequence."
                 )
@@ -784,24 +1060,7 @@ class Funnel_gpt2_VAE_Model(Funnel_VAE_Model_Base):
                 attentions=encoder_outputs[2] if len(encoder_outputs) > 2 else None,
             )
 
-        vae_outputs = self.vae(
-            input_encoding=encoder_outputs.last_hidden_state if encoder_outputs else None, latent=latent, global_step=self.global_step
-        )
-
-        # TODO allow more options here
-        if self.config.padding_input:
-            upsampled_encoding = upsample(
-                vae_outputs.reconstructed_encoding,
-                stride=2 ** (len(self.config.transformer.block_sizes) - 1),
-                target_len=self.config.transformer_decoder.n_positions,
-                separate_cls=self.config.transformer.separate_cls,
-                truncate_seq=self.config.transformer.truncate_seq,
-            )
-            if self.config.use_skip_connections:
-                # TODO use skip connections like in the O.G. Funnel model
-                raise NotImplementedError()
-        else:
-            upsampled_encoding = vae_outputs.reconstructed_encoding
+        vae_outputs, upsampled_encoding = self._vae_forward(encoder_outputs, latent, encoder_hidden_states)
 
         # Now using gpt2 decoder
 
@@ -823,14 +1082,18 @@ class Funnel_gpt2_VAE_Model(Funnel_VAE_Model_Base):
             encoder_hidden_states=upsampled_encoding,
             attention_mask=attention_mask,
             labels=labels,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
             return_dict=True
         )
 
         reg_loss_w = self._regulariser_loss_weight_schedule()
-        loss = decoder_outputs.loss + vae_outputs.reg_loss * reg_loss_w
+        loss = None
+        if decoder_outputs.loss is not None:
+            loss = decoder_outputs.loss + vae_outputs.reg_loss * reg_loss_w
 
         if self.training and self.config.use_extra_logs:
-            self._update_logs(decoder_ce=decoder_outputs.loss.item(), reg_loss=vae_outputs.reg_loss.item(), reg_loss_w=reg_loss_w)
+            self._update_logs(decoder_ce=decoder_outputs.loss, reg_loss=vae_outputs.reg_loss, reg_loss_w=reg_loss_w)
 
         return BaseTransformerVAE_Output(
             loss=loss,
@@ -61,3 +61,81 @@ class BaseTransformerVAE_Output(ModelOutput):
     decoder_ce: Optional[torch.FloatTensor] = None
     seq_accuracy: Optional[torch.FloatTensor] = None
     token_accuracy: Optional[torch.FloatTensor] = None
+
+
+@dataclass
+class DecodedLatents_Output(ModelOutput):
+    """
+    Sequences decoded from a batch of latent codes.
+
+    Args:
+        sequences (:obj:`torch.LongTensor` of shape :obj:`(n_latents, sequence_length)`):
+            Generated token ids, padded to the longest sequence.
+        texts (:obj:`List[str]`, `optional`, returned when a tokenizer is provided):
+            Decoded text of each sequence.
+    """
+
+    sequences: torch.LongTensor = None
+    texts: Optional[List[str]] = None
+
+
+@dataclass
+class Interpolation_Output(ModelOutput):
+    """
+    Sequences decoded along paths between pairs of latent codes.
+
+    Args:
+        ratios (:obj:`torch.FloatTensor` of shape :obj:`(n_steps,)`):
+            How far along each path every step is, from 0 at the start latent to 1 at the end latent.
+        latents (:obj:`torch.FloatTensor` of shape :obj:`(n_pairs, n_steps, latent_size)`):
+            Latent codes along each path.
+        sequences (:obj:`torch.LongTensor` of shape :obj:`(n_pairs, n_steps, sequence_length)`):
+            Generated token ids for every latent code, padded to the longest sequence.
+        unique_steps (:obj:`List[List[int]]`):
+            For each path, the steps where a new sequence first appears.
+        texts (:obj:`List[List[str]]`, `optional`, returned when a tokenizer is provided):
+            Decoded text of every step of each path.
+        unique_texts (:obj:`List[List[str]]`, `optional`, returned when a tokenizer is provided):
+            Distinct texts along each path, in path order.
+    """
+
+    ratios: torch.FloatTensor = None
+    latents: torch.FloatTensor = None
+    sequences: torch.LongTensor = None
+    unique_steps: List[List[int]] = None
+    texts: Optional[List[List[str]]] = None
+    unique_texts: Optional[List[List[str]]] = None
+
+
+@dataclass
+class AdaptiveInterpolation_Output(ModelOutput):
+    """
+    Sequences found by bisecting paths between pairs of latent codes.
+
+    Args:
+        ratios (:obj:`List[List[float]]`):
+            For each path, the ratios that were decoded in increasing order, from 0 at the start latent to 1 at the end.
+        sequences (:obj:`List[List[List[int]]]`):
+            Generated token ids at each decoded ratio, without padding.
+        change_ratios (:obj:`List[List[float]]`):
+            For each path, the ratios where a new sequence starts.
+        n_decodes (:obj:`int`):
+            Number of latent codes decoded.
+        n_uniform_decodes (:obj:`int`):
+            Number of latent codes uniform sampling would decode at the same resolution.
+        n_decodes_saved (:obj:`int`):
+            Decodes saved over uniform sampling.
+        texts (:obj:`List[List[str]]`, `optional`, returned when a tokenizer is provided):
+            Decoded text at each decoded ratio.
+        change_texts (:obj:`List[List[str]]`, `optional`, returned when a tokenizer is provided):
+            Distinct texts in the order they appear along each path.
+    """
+
+    ratios: List[List[float]] = None
+    sequences: List[List[List[int]]] = None
+    change_ratios: List[List[float]] = None
+    n_decodes: int = None
+    n_uniform_decodes: int = None
+    n_decodes_saved: int = None
+    texts: Optional[List[List[str]]] = None
+    change_texts: Optional[List[List[str]]] = None
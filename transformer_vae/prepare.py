@@ -0,0 +1,95 @@
+"""
+    Tokenize a dataset once into memory-mapped token shards, train on them with `--token_store_dir`.
+"""
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+
+from transformers import HfArgumentParser
+
+from transformer_vae.token_store import TokenStoreWriter
+from transformer_vae.train import (
+    ModelArguments,
+    DataTrainingArguments,
+    DEFAULT_TRANSFORMER_NAME,
+    get_datasets,
+    load_tokenizer,
+    tokenize_samples,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PrepareArguments:
+    """
+    Arguments for how to store token shards, they are written to `--token_store_dir`.
+    """
+
+    shard_size: int = field(default=1_000_000, metadata={"help": "Maximum number of rows per shard."})
+
+
+def get_args(args=None):
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, PrepareArguments))
+    if args is None and len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, prepare_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, prepare_args = parser.parse_args_into_dataclasses(args)
+
+    if model_args.transformer_name is None:
+        model_args.transformer_name = DEFAULT_TRANSFORMER_NAME[model_args.transformer_type]
+    if data_args.token_store_dir is None:
+        raise ValueError("Need a `token_store_dir` to write token shards to.")
+    if not model_args.set_seq_size:
+        raise ValueError("Token shards hold fixed width rows, `set_seq_size` must be given.")
+
+    return model_args, data_args, prepare_args
+
+
+def main(args=None):
+    model_args, data_args, prepare_args = get_args(args)
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    datasets = get_datasets(data_args)
+    tokenizer = load_tokenizer(model_args)
+
+    manifests = {}
+    for split, dataset in datasets.items():
+        if data_args.text_column is not None:
+            text_column_name = data_args.text_column
+        else:
+            text_column_name = "text" if "text" in dataset.column_names else dataset.column_names[0]
+
+        def tokenize_function(examples):
+            input_ids, n_tokens = tokenize_samples(tokenizer, examples[text_column_name])
+            return {"input_ids": input_ids, "n_tokens": n_tokens}
+
+        tokenized = dataset.map(
+            tokenize_function,
+            batched=True,
+            batch_size=data_args.preprocessing_batch_size,
+            writer_batch_size=data_args.preprocessing_batch_size,
+            num_proc=data_args.preprocessing_num_workers,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=not data_args.overwrite_cache,
+        )
+        with TokenStoreWriter(
+            os.path.join(data_args.token_store_dir, split),
+            seq_size=tokenizer.model_max_length,
+            vocab_size=len(tokenizer),
+            pad_token_id=tokenizer.pad_token_id,
+            shard_size=prepare_args.shard_size,
+        ) as writer:
+            for start in range(0, len(tokenized), data_args.preprocessing_batch_size):
+                batch = tokenized[start : start + data_args.preprocessing_batch_size]
+                writer.add(batch["input_ids"], n_tokens=batch["n_tokens"])
+        logger.info(f"Stored {writer.manifest['n_rows']} {split} rows in {data_args.token_store_dir}")
+        manifests[split] = writer.manifest
+
+    return manifests
@@ -0,0 +1,134 @@
+"""
+    Quantize a model to int8 for CPU inference & report how far it drifts from the fp32 model on a validation set.
+
+    python -m transformer_vae quantize --model_path poet --dataset_name poems --quantized_dir poet_int8
+"""
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+
+import torch
+from transformers import HfArgumentParser
+
+from transformer_vae.train import (
+    ModelArguments,
+    DataTrainingArguments,
+    DEFAULT_TRANSFORMER_NAME,
+    get_datasets,
+    load_model_and_tokenizer,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+REPORT_NAME = "quantization_report.json"
+
+
+@torch.no_grad()
+def _reconstruct(model, inputs):
+    """
+    Teacher-forced reconstruction of a batch, returns its latent codes, number of correct tokens & number of tokens.
+    """
+    labels = inputs["input_ids"].masked_fill(inputs["attention_mask"] == 0, -100)
+    outputs = model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"], labels=labels)
+    predictions = outputs.logits.argmax(dim=-1)
+    labels = labels[:, : predictions.size(1)]
+    is_token = labels != -100
+    return outputs.latent, (predictions.eq(labels) & is_token).sum().item(), is_token.sum().item()
+
+
+@torch.no_grad()
+def compare_to_fp32(model, quantized_model, texts, tokenizer, batch_size=32):
+    """
+    Compare a quantized model against its fp32 original on `texts`.
+
+    Latent drift measures how far the quantized latent codes move from the fp32 ones, reconstruction token accuracy
+    is measured with teacher forcing for both models.
+    """
+    model.eval()
+    quantized_model.eval()
+    totals = dict(fp32=[0, 0, 0.0], int8=[0, 0, 0.0])
+    distances, relative_distances, cosine_similarities, max_abs_diff = [], [], [], 0.0
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start : start + batch_size]
+        latents = []
+        for name, reconstruct_model in [("fp32", model), ("int8", quantized_model)]:
+            inputs = reconstruct_model.tokenize_texts(batch, tokenizer)
+            batch_start = time.perf_counter()
+            latent, n_correct, n_tokens = _reconstruct(reconstruct_model, inputs)
+            totals[name][0] += n_correct
+            totals[name][1] += n_tokens
+            totals[name][2] += time.perf_counter() - batch_start
+            latents.append(latent.float().cpu())
+
+        fp32_latent, int8_latent = latents
+        distance = (int8_latent - fp32_latent).norm(dim=1)
+        distances.append(distance)
+        relative_distances.append(distance / fp32_latent.norm(dim=1).clamp(min=1e-12))
+        cosine_similarities.append(torch.nn.functional.cosine_similarity(int8_latent, fp32_latent, dim=1))
+        max_abs_diff = max(max_abs_diff, (int8_latent - fp32_latent).abs().max().item())
+
+    distances, relative_distances = torch.cat(distances), torch.cat(relative_distances)
+    return {
+        "n_texts": len(texts),
+        "latent_drift": {
+            "mean_l2": distances.mean().item(),
+            "max_l2": distances.max().item(),
+            "mean_relative_l2": relative_distances.mean().item(),
+            "max_abs_diff": max_abs_diff,
+            "mean_cosine_similarity": torch.cat(cosine_similarities).mean().item(),
+        },
+        "token_accuracy": {name: n_correct / max(n_tokens, 1) for name, (n_correct, n_tokens, _) in totals.items()},
+        "seconds": {name: seconds for name, (_, _, seconds) in totals.items()},
+    }
+
+
+@dataclass
+class QuantizeArguments:
+    """
+    Arguments for quantizing a model.
+    """
+
+    quantized_dir: str = field(metadata={"help": "Directory to save the quantized model to."})
+    n_eval_samples: int = field(
+        default=1_000, metadata={"help": "Number of validation texts to compare fp32 & int8 on."}
+    )
+    eval_batch_size: int = field(default=32, metadata={"help": "Number of texts to run at once when comparing."})
+
+
+def main(args=None):
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, QuantizeArguments))
+    if args is None and len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, quantize_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, quantize_args = parser.parse_args_into_dataclasses(args)
+    if model_args.transformer_name is None:
+        model_args.transformer_name = DEFAULT_TRANSFORMER_NAME[model_args.transformer_type]
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    dataset = get_datasets(data_args)[data_args.validation_name]
+    if data_args.text_column is not None:
+        text_column_name = data_args.text_column
+    else:
+        text_column_name = "text" if "text" in dataset.column_names else dataset.column_names[0]
+    texts = dataset[: quantize_args.n_eval_samples][text_column_name]
+
+    model, tokenizer = load_model_and_tokenizer(model_args)
+    model.cpu().eval()
+    quantized_model = model.quantize()
+    report = compare_to_fp32(model, quantized_model, texts, tokenizer, batch_size=quantize_args.eval_batch_size)
+
+    quantized_model.save_quantized(quantize_args.quantized_dir)
+    tokenizer.save_pretrained(quantize_args.quantized_dir)
+    with open(os.path.join(quantize_args.quantized_dir, REPORT_NAME), "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Saved int8 model to {quantize_args.quantized_dir}: {json.dumps(report)}")
+    return report
@@ -0,0 +1,115 @@
+"""
+    Random access to the samples of a text file that separates them with lines holding only `<|endoftext|>`.
+"""
+import array
+import hashlib
+import mmap
+import os
+import re
+import numpy as np
+
+
+DEFAULT_SEPARATOR = "<|endoftext|>"
+
+
+def samples_cache_dir():
+    datasets_cache = os.getenv(
+        "HF_DATASETS_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "datasets")
+    )
+    return os.path.join(datasets_cache, "multiline_samples")
+
+
+def file_fingerprint(path, separator=DEFAULT_SEPARATOR):
+    """
+    Changes whenever the file at `path` is modified or split with a different separator.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}:{separator}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def index_samples(buffer, separator=DEFAULT_SEPARATOR):
+    """
+    Byte offsets `[start, end)` of each non-blank sample in `buffer`, as an `(n_samples, 2)` array.
+
+    The regex scans `buffer` in place, so passing a memory map indexes a file without reading it into memory.
+    """
+    pattern = re.compile(rb"^[ \t]*" + re.escape(separator.encode()) + rb"[ \t]*\r?$\n?", re.MULTILINE)
+    offsets = array.array("q")
+    start = 0
+    for match in pattern.finditer(buffer):
+        if buffer[start : match.start()].strip():
+            offsets.extend((start, match.start()))
+        start = match.end()
+    if buffer[start:].strip():
+        offsets.extend((start, len(buffer)))
+    return np.frombuffer(offsets, dtype=np.int64).reshape(-1, 2)
+
+
+class MultilineSampleReader:
+    """
+    Memory-maps a text file & indexes the byte offsets of its samples, so any sample is read without the rest of the file.
+
+    Indexes are cached in `cache_dir` under the file's fingerprint, so each file is only scanned once.
+    Readers can be pickled to worker processes, each re-opens the memory map rather than copying it.
+
+    Args:
+        path (:obj:`str`):
+            Text file with samples separated by lines holding only `separator`.
+        separator (:obj:`str`, `optional`, defaults to "<|endoftext|>"):
+            Line separating samples, surrounding whitespace is ignored.
+        cache_dir (:obj:`str`, `optional`):
+            Directory to cache sample indexes in, defaults to a folder in the datasets cache.
+    """
+
+    def __init__(self, path, separator=DEFAULT_SEPARATOR, cache_dir=None):
+        self.path = path
+        self.separator = separator
+        self.cache_dir = cache_dir if cache_dir is not None else samples_cache_dir()
+        self.fingerprint = file_fingerprint(path, separator)
+        self._open()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, f"{self.fingerprint}.npy")
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        # empty files can't be memory-mapped
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.path) else b""
+        if os.path.exists(self.index_path):
+            self.offsets = np.load(self.index_path, mmap_mode="r")
+            return
+        self.offsets = index_samples(self._mmap, self.separator)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = os.path.join(self.cache_dir, f"{self.fingerprint}.{os.getpid()}.tmp.npy")
+        np.save(tmp_path, self.offsets)
+        os.replace(tmp_path, self.index_path)
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["_file", "_mmap", "offsets"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index]
+        return self._mmap[start:end].decode("utf-8").strip()
+
+    def texts(self, start, end):
+        """
+        Samples `start` to `end` (exclusive) as a list of strings.
+        """
+        return [self[i] for i in range(start, min(end, len(self)))]
@@ -0,0 +1,74 @@
+"""
+    Batch together sequences of similar lengths so dynamically padded batches hold few pad tokens.
+"""
+import logging
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+def length_grouped_batches(lengths, batch_size, mega_batch_mult=50, generator=None):
+    """
+    Randomly split indices into mega-batches of `mega_batch_mult` batches, sort each by length & split them into
+    batches. Batches are then shuffled so lengths vary between steps, the only smaller batch stays last.
+    """
+    indices = torch.randperm(len(lengths), generator=generator).tolist()
+    mega_batch_size = batch_size * mega_batch_mult
+    batches = []
+    for start in range(0, len(indices), mega_batch_size):
+        mega_batch = sorted(indices[start : start + mega_batch_size], key=lambda i: lengths[i], reverse=True)
+        batches += [mega_batch[i : i + batch_size] for i in range(0, len(mega_batch), batch_size)]
+    last_batch = [batches.pop()] if batches and len(batches[-1]) < batch_size else []
+    order = torch.randperm(len(batches), generator=generator).tolist()
+    return [batches[i] for i in order] + last_batch
+
+
+def padding_stats(lengths, batches, max_length, min_length=1):
+    """
+    Count the pad tokens in `batches` padded to their longest sequence vs padding every sequence to `max_length`.
+    """
+    n_tokens = sum(lengths[i] for batch in batches for i in batch)
+    fixed_padding = max_length * sum(len(batch) for batch in batches) - n_tokens
+    dynamic_padding = sum(max(min_length, max(lengths[i] for i in batch)) * len(batch) for batch in batches) - n_tokens
+    return {
+        "tokens": n_tokens,
+        "fixed_pad_tokens": fixed_padding,
+        "dynamic_pad_tokens": dynamic_padding,
+        "pad_token_reduction": 1 - dynamic_padding / fixed_padding if fixed_padding else 0.0,
+    }
+
+
+class LengthGroupedSampler(Sampler):
+    """
+    Samples indices so that each run of `batch_size` indices holds sequences of similar lengths.
+
+    Every epoch logs how many pad tokens dynamic padding needs compared to padding everything to `max_length`.
+    """
+
+    def __init__(self, lengths, batch_size, max_length=None, min_length=1, mega_batch_mult=50, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_length = max_length if max_length is not None else max(lengths)
+        self.min_length = min_length
+        self.mega_batch_mult = mega_batch_mult
+        self.seed = seed
+        self.epoch = 0
+        self.last_padding_stats = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        batches = length_grouped_batches(self.lengths, self.batch_size, self.mega_batch_mult, generator)
+        self.last_padding_stats = padding_stats(self.lengths, batches, self.max_length, self.min_length)
+        logger.info(
+            f"Epoch pad tokens: {self.last_padding_stats['dynamic_pad_tokens']:,} with dynamic padding vs "
+            f"{self.last_padding_stats['fixed_pad_tokens']:,} padding to {self.max_length} "
+            f"({self.last_padding_stats['pad_token_reduction']:.1%} fewer)."
+        )
+        return iter([i for batch in batches for i in batch])
@@ -0,0 +1,456 @@
+"""
+    Asynchronous HTTP server for Transformer-VAE models that batches together concurrent requests.
+
+    Run with `python -m transformer_vae serve --model_path <checkpoint>`, all endpoints take & return json:
+
+    - `POST /encode` `{"texts": [...]}` -> `{"latents": [...]}`
+    - `POST /decode` `{"latents": [...]}` -> `{"texts": [...]}`
+    - `POST /interpolate` `{"start": text or latent, "end": text or latent, "steps": 10, "method": "linear"}`
+      -> `{"latents": [...], "texts": [...]}`, method is "linear" or "slerp"
+    - `POST /sample` `{"n": 1}` -> `{"latents": [...], "texts": [...]}`
+    - `GET /metrics` latency histograms, batch sizes & throughput counters.
+"""
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import torch
+from transformers import HfArgumentParser
+
+from transformer_vae.interpolation import latent_grid
+from transformer_vae.train import ModelArguments, DEFAULT_TRANSFORMER_NAME, load_model_and_tokenizer
+
+
+logger = logging.getLogger(__name__)
+
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000, 2_000, 5_000, 10_000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, the last bucket holds values above all the bucket bounds.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket holding the given percentile, `inf` if above every bucket.
+        """
+        if self.count == 0:
+            return None
+        target = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("inf",), self.counts)},
+        }
+
+
+class ServerMetrics:
+    """
+    Per-endpoint latency histograms & request counters plus per-batcher batch sizes.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.latency_ms = collections.defaultdict(Histogram)
+        self.batch_sizes = collections.defaultdict(lambda: Histogram(BATCH_SIZE_BUCKETS))
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.items = collections.Counter()
+
+    def to_dict(self):
+        uptime = time.time() - self.start_time
+        return {
+            "uptime_seconds": uptime,
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "items": dict(self.items),
+            "requests_per_second": {k: v / uptime for k, v in self.requests.items()},
+            "items_per_second": {k: v / uptime for k, v in self.items.items()},
+            "latency_ms": {k: v.to_dict() for k, v in self.latency_ms.items()},
+            "batch_sizes": {k: v.to_dict() for k, v in self.batch_sizes.items()},
+        }
+
+
+class MicroBatcher:
+    """
+    Collects items submitted by concurrent requests & processes them together.
+
+    `process_batch` is given a list of items & must return a list of results in the same order.
+    A batch is run once it has `max_batch_size` items or its first item has waited `max_delay` seconds since it was
+    submitted, so items queued behind a running batch don't wait for a fresh delay.
+    Batches are run one at a time on `executor`, new items are queued for the next batch meanwhile.
+    """
+
+    def __init__(self, process_batch, max_batch_size=32, max_delay=0.005, executor=None, batch_sizes=None):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self.batch_sizes = batch_sizes
+        self._queue = None
+        self._full = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.put_nowait((item, future, loop.time()))
+        if self._queue.qsize() >= self.max_batch_size:
+            self._full.set()
+        return await future
+
+    async def submit_many(self, items):
+        return list(await asyncio.gather(*[self.submit(item) for item in items]))
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        remaining_delay = batch[0][2] + self.max_delay - asyncio.get_event_loop().time()
+        if remaining_delay > 0 and self._queue.qsize() + 1 < self.max_batch_size:
+            try:
+                # waiting on an event is safe to time out, unlike `Queue.get`
+                await asyncio.wait_for(self._full.wait(), remaining_delay)
+            except asyncio.TimeoutError:
+                pass
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if self._queue.qsize() < self.max_batch_size:
+            self._full.clear()
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            if self.batch_sizes is not None:
+                self.batch_sizes.observe(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, [item for item, _, _ in batch])
+            except Exception as e:
+                logger.exception("Failed to process batch.")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+
+class VAE_Server:
+    """
+    Serves a Transformer-VAE model over HTTP, see the module docstring for endpoints.
+
+    Tokenization runs on a pool of `tokenizer_threads` threads while the model runs on a single thread, so
+    requests are tokenized while the previous batch is on the model.
+
+    Args:
+        model: A `Transformer_VAE_Base_Model` in eval mode.
+        tokenizer: The model's tokenizer.
+        max_batch_size (:obj:`int`, `optional`, defaults to 32):
+            Most texts or latents to run through the model at once.
+        max_batch_delay (:obj:`float`, `optional`, defaults to 0.005):
+            Most seconds to wait for more requests before running a batch.
+        tokenizer_threads (:obj:`int`, `optional`, defaults to 4):
+            Number of threads to tokenize requests on.
+        max_request_samples (:obj:`int`, `optional`, defaults to 256):
+            Most latents a `/sample` or `/interpolate` request can ask for.
+        generate_kwargs (:obj:`dict`, `optional`):
+            Keyword arguments for `decode_latents`.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size=32,
+        max_batch_delay=0.005,
+        tokenizer_threads=4,
+        max_request_samples=256,
+        generate_kwargs=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.tokenizer_threads = tokenizer_threads
+        self.max_request_samples = max_request_samples
+        self.generate_kwargs = generate_kwargs or {}
+        self.metrics = ServerMetrics()
+        self.routes = {
+            ("POST", "/encode"): self.encode,
+            ("POST", "/decode"): self.decode,
+            ("POST", "/interpolate"): self.interpolate,
+            ("POST", "/sample"): self.sample,
+            ("GET", "/metrics"): self.get_metrics,
+            ("GET", "/health"): self.health,
+        }
+        self._server = None
+
+    @property
+    def latent_size(self):
+        return self.model.config.latent_size
+
+    @property
+    def pad_token_id(self):
+        return self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+    def _tokenize(self, texts):
+        return self.tokenizer(texts, truncation=True, max_length=self.model.config.transformer.n_positions)["input_ids"]
+
+    def _encode_batch(self, token_ids):
+        lengths = torch.tensor([len(ids) for ids in token_ids])
+        seq_len = self.model.config.transformer.n_positions if self.model.config.padding_input else int(lengths.max())
+        input_ids = torch.full((len(token_ids), seq_len), self.pad_token_id, dtype=torch.long)
+        for i, ids in enumerate(token_ids):
+            input_ids[i, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask = (torch.arange(seq_len).unsqueeze(0) < lengths.unsqueeze(1)).long()
+        return self.model.encode(input_ids.to(self.model.device), attention_mask.to(self.model.device)).tolist()
+
+    def _decode_batch(self, latents):
+        latents = torch.tensor(latents, dtype=torch.float32, device=self.model.device)
+        return self.model.decode_latents(
+            latents, tokenizer=self.tokenizer, batch_size=latents.size(0), **self.generate_kwargs
+        ).texts
+
+    async def _encode_texts(self, texts):
+        token_ids = await asyncio.get_event_loop().run_in_executor(self._tokenizer_pool, self._tokenize, texts)
+        return await self._encoder.submit_many(token_ids)
+
+    async def _to_latent(self, text_or_latent):
+        if isinstance(text_or_latent, str):
+            return (await self._encode_texts([text_or_latent]))[0]
+        if not isinstance(text_or_latent, list) or len(text_or_latent) != self.latent_size:
+            raise ValueError(f"Latents must be lists of {self.latent_size} numbers. Got: {text_or_latent!r}")
+        # checked before submitting, a latent that fails in the batch would fail every request batched with it
+        for value in text_or_latent:
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError(f"Latents must only hold finite numbers. Got: {value!r}")
+        return [float(value) for value in text_or_latent]
+
+    def _n_samples(self, name, value):
+        if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= self.max_request_samples:
+            raise ValueError(f"`{name}` must be an integer from 1 to {self.max_request_samples}. Got: {value!r}")
+        return value
+
+    async def encode(self, request):
+        texts = request["texts"]
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            raise ValueError("`texts` must be a list of strings.")
+        self.metrics.items["encode"] += len(texts)
+        return {"latents": await self._encode_texts(texts)}
+
+    async def decode(self, request):
+        latents = [await self._to_latent(latent) for latent in request["latents"]]
+        self.metrics.items["decode"] += len(latents)
+        return {"texts": await self._decoder.submit_many(latents)}
+
+    async def interpolate(self, request):
+        start, end = await asyncio.gather(self._to_latent(request["start"]), self._to_latent(request["end"]))
+        steps = self._n_samples("steps", request.get("steps", 10))
+        grid = latent_grid(torch.tensor([start]), torch.tensor([end]), steps, request.get("method", "linear"))
+        latents = grid[0].tolist()
+        self.metrics.items["interpolate"] += len(latents)
+        return {"latents": latents, "texts": await self._decoder.submit_many(latents)}
+
+    async def sample(self, request):
+        n_samples = self._n_samples("n", request.get("n", 1))
+        latents = torch.randn(n_samples, self.latent_size).tolist()
+        self.metrics.items["sample"] += n_samples
+        return {"latents": latents, "texts": await self._decoder.submit_many(latents)}
+
+    async def get_metrics(self, request):
+        return self.metrics.to_dict()
+
+    async def health(self, request):
+        return {"status": "ok"}
+
+    async def _respond(self, method, path, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            return 404, {"error": f"No endpoint for {method} {path}"}
+        self.metrics.requests[path] += 1
+        start = time.perf_counter()
+        try:
+            request = json.loads(body) if body else {}
+            status, payload = 200, await handler(request)
+        except (KeyError, ValueError, TypeError) as e:
+            self.metrics.errors[path] += 1
+            status, payload = 400, {"error": f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            logger.exception(f"Failed to handle {method} {path}")
+            self.metrics.errors[path] += 1
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        self.metrics.latency_ms[path].observe((time.perf_counter() - start) * 1_000)
+        return status, payload
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            # keep-alive, handle requests until the client closes the connection
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode("latin-1").split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self._respond(method, path.split("?")[0], body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8000):
+        self._tokenizer_pool = ThreadPoolExecutor(self.tokenizer_threads)
+        # torch ops from 1 thread at a time, they are already parallelised internally
+        self._model_pool = ThreadPoolExecutor(1)
+        self._encoder = MicroBatcher(
+            self._encode_batch,
+            self.max_batch_size,
+            self.max_batch_delay,
+            executor=self._model_pool,
+            batch_sizes=self.metrics.batch_sizes["encode"],
+        )
+        self._decoder = MicroBatcher(
+            self._decode_batch,
+            self.max_batch_size,
+            self.max_batch_delay,
+            executor=self._model_pool,
+            batch_sizes=self.metrics.batch_sizes["decode"],
+        )
+        self._encoder.start()
+        self._decoder.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Serving on http://{host}:{port}")
+        return self._server
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._encoder.stop()
+        await self._decoder.stop()
+        self._tokenizer_pool.shutdown()
+        self._model_pool.shutdown()
+
+
+@dataclass
+class ServeArguments:
+    """
+    Arguments for serving a model.
+    """
+
+    host: str = field(default="127.0.0.1", metadata={"help": "Address to serve on."})
+    port: int = field(default=8000, metadata={"help": "Port to serve on."})
+    max_batch_size: int = field(
+        default=32, metadata={"help": "Most texts or latents to run through the model at once."}
+    )
+    max_batch_delay_ms: float = field(
+        default=5.0, metadata={"help": "Most milliseconds to wait for more requests before running a batch."}
+    )
+    tokenizer_threads: int = field(default=4, metadata={"help": "Number of threads to tokenize requests on."})
+    max_request_samples: int = field(
+        default=256, metadata={"help": "Most latents a `/sample` or `/interpolate` request can ask for."}
+    )
+    generate_min_len: int = field(default=1, metadata={"help": "The minimum length of decoded sequences."})
+    generate_max_len: int = field(default=20, metadata={"help": "The maximum length of decoded sequences."})
+    no_cuda: bool = field(default=False, metadata={"help": "Don't use CUDA even when it is available."})
+
+
+def main(args=None):
+    parser = HfArgumentParser((ModelArguments, ServeArguments))
+    if args is None and len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, serve_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, serve_args = parser.parse_args_into_dataclasses(args)
+    if model_args.transformer_name is None:
+        model_args.transformer_name = DEFAULT_TRANSFORMER_NAME[model_args.transformer_type]
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    model, tokenizer = load_model_and_tokenizer(model_args)
+    device = torch.device("cuda" if torch.cuda.is_available() and not serve_args.no_cuda else "cpu")
+    model.to(device).eval()
+
+    server = VAE_Server(
+        model,
+        tokenizer,
+        max_batch_size=serve_args.max_batch_size,
+        max_batch_delay=serve_args.max_batch_delay_ms / 1_000,
+        tokenizer_threads=serve_args.tokenizer_threads,
+        max_request_samples=serve_args.max_request_samples,
+        generate_kwargs=dict(min_length=serve_args.generate_min_len, max_length=serve_args.generate_max_len),
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.start(serve_args.host, serve_args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
@@ -0,0 +1,166 @@
+"""
+    Memory-mapped `.npy` shards of fixed width rows listed in a json manifest, shared by the latent & token stores.
+"""
+import json
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def has_manifest(path):
+    return os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+class ShardWriter:
+    """
+    Writes rows straight into memory-mapped shards of at most `shard_size` rows, so they are never all held in memory.
+
+    Each shard has one `.npy` file per column, subclasses give these as `{name: (dtype, row_shape)}` in `columns`.
+    Readers only see rows written before `close` writes the manifest, this also cuts the last shard down to its rows.
+
+    Args:
+        path (:obj:`str`):
+            Directory to store the shards & manifest in.
+        manifest (:obj:`dict`):
+            Store manifest, new shards are listed after any in its "shards".
+        shard_size (:obj:`int`):
+            Maximum number of rows in each shard.
+    """
+
+    def __init__(self, path, manifest, shard_size):
+        self.path = path
+        self.manifest = manifest
+        self.shard_size = shard_size
+        os.makedirs(path, exist_ok=True)
+        self._shard = None
+        self._columns = None
+        self._n_in_shard = 0
+
+    def columns(self):
+        raise NotImplementedError()
+
+    def _open_shard(self):
+        index = len(self.manifest["shards"])
+        self._shard = dict(n_rows=0)
+        self._columns = {}
+        for name, (dtype, row_shape) in self.columns().items():
+            self._shard[name] = f"{name}-{index:05d}.npy"
+            self._columns[name] = open_memmap(
+                os.path.join(self.path, self._shard[name]),
+                mode="w+",
+                dtype=dtype,
+                shape=(self.shard_size,) + tuple(row_shape),
+            )
+        self.manifest["shards"].append(self._shard)
+        self._n_in_shard = 0
+
+    def _close_shard(self):
+        if self._columns is None:
+            return
+        for name, column in self._columns.items():
+            column.flush()
+            if self._n_in_shard < self.shard_size:
+                # the shard was preallocated to `shard_size` rows, so copy its rows into a file of the right size
+                path = os.path.join(self.path, self._shard[name])
+                with open(path + ".tmp", "wb") as f:
+                    np.save(f, column[: self._n_in_shard])
+                os.replace(path + ".tmp", path)
+        self._columns = None
+
+    def _add_rows(self, **columns):
+        """
+        Append equal length arrays of rows for every column, starting new shards as they fill up.
+        """
+        n_rows = len(next(iter(columns.values())))
+        start = 0
+        while start < n_rows:
+            if self._columns is None or self._n_in_shard == self.shard_size:
+                self._close_shard()
+                self._open_shard()
+            end = start + min(n_rows - start, self.shard_size - self._n_in_shard)
+            for name, rows in columns.items():
+                self._columns[name][self._n_in_shard : self._n_in_shard + end - start] = rows[start:end]
+            self._n_in_shard += end - start
+            self._shard["n_rows"] = self._n_in_shard
+            self.manifest["n_rows"] += end - start
+            start = end
+
+    def close(self):
+        """
+        Flush the open shard & write the manifest, readers only see rows written before this.
+        """
+        self._close_shard()
+        manifest_path = os.path.join(self.path, MANIFEST_NAME)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShardReader:
+    """
+    Reads a store made by a `ShardWriter`, subclasses give its columns as `{name: (dtype, row_shape)}` in `columns`.
+
+    Shards are memory-mapped copy-on-write so returned arrays & tensors are views of the files,
+    nothing is read until it is used & writes to them never reach the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = read_manifest(path)
+        self._shards = [
+            tuple(np.load(os.path.join(path, shard[name]), mmap_mode="c")[: shard["n_rows"]] for name in self.columns())
+            for shard in self.manifest["shards"]
+        ]
+        self._offsets = np.cumsum([0] + [shard["n_rows"] for shard in self.manifest["shards"]])
+
+    def columns(self):
+        raise NotImplementedError()
+
+    def __len__(self):
+        return self.manifest["n_rows"]
+
+    @property
+    def n_shards(self):
+        return len(self._shards)
+
+    def shard(self, index):
+        """
+        NumPy views of a shard's columns.
+        """
+        return self._shards[index]
+
+    def _locate(self, index):
+        """
+        The shard & row within it of row `index`.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Store index out of range. Got: {index} Store size: {len(self)}")
+        shard_index = int(np.searchsorted(self._offsets, index, side="right")) - 1
+        return self._shards[shard_index], index - self._offsets[shard_index]
+
+    def _column(self, column_index):
+        """
+        A column of every shard as one array, only a view if the store has a single shard.
+        """
+        if self.n_shards == 1:
+            return self._shards[0][column_index]
+        if self.n_shards == 0:
+            dtype, row_shape = list(self.columns().values())[column_index]
+            return np.zeros((0,) + tuple(row_shape), dtype=dtype)
+        return np.concatenate([shard[column_index] for shard in self._shards])
@@ -0,0 +1,129 @@
+"""
+    Memory-mapped shards of pre-tokenized text, so repeated training runs skip loading & tokenizing their dataset.
+"""
+import collections
+import numpy as np
+import torch
+
+from transformer_vae.shard_store import ShardReader, ShardWriter, has_manifest
+
+
+# torch has no uint16 tensors, so vocabularies that fit in int16 use it to keep rows viewable as tensors
+TOKEN_DTYPES = {"int16": np.int16, "int32": np.int32}
+
+
+def token_dtype(vocab_size):
+    """
+    Smallest of `TOKEN_DTYPES` that can hold every token id.
+    """
+    return "int16" if vocab_size <= np.iinfo(np.int16).max + 1 else "int32"
+
+
+def token_columns(manifest):
+    """
+    `{name: (dtype, row_shape)}` of each column in a token store's shards.
+    """
+    return {
+        "tokens": (TOKEN_DTYPES[manifest["dtype"]], (manifest["seq_size"],)),
+        "lengths": (np.int32, ()),
+    }
+
+
+class TokenStoreWriter(ShardWriter):
+    """
+    Writes rows of token ids padded to `seq_size` into `.npy` shards in `path`, along with each row's length.
+
+    Shards & a histogram of the untruncated sample lengths are listed in a json manifest.
+
+    Args:
+        path (:obj:`str`):
+            Directory to store the shards & manifest in, must not already hold a token store.
+        seq_size (:obj:`int`):
+            Number of tokens in each row, longer rows raise an error.
+        vocab_size (:obj:`int`):
+            Size of the tokenizer's vocabulary, decides the dtype of the shards.
+        pad_token_id (:obj:`int`, `optional`, defaults to 0):
+            Token id to pad rows with.
+        shard_size (:obj:`int`, `optional`, defaults to 1,000,000):
+            Maximum number of rows in each shard.
+    """
+
+    def __init__(self, path, seq_size, vocab_size, pad_token_id=0, shard_size=1_000_000):
+        if has_manifest(path):
+            raise ValueError(f"Can't overwrite an existing token store. Got: {path}")
+        manifest = dict(
+            seq_size=seq_size,
+            vocab_size=vocab_size,
+            dtype=token_dtype(vocab_size),
+            pad_token_id=pad_token_id,
+            n_rows=0,
+            shards=[],
+        )
+        super().__init__(path, manifest, shard_size)
+        self.n_tokens_histogram = collections.Counter()
+
+    def columns(self):
+        return token_columns(self.manifest)
+
+    def add(self, input_ids, n_tokens=None):
+        """
+        Append a list of token id lists, optionally with each sample's untruncated number of tokens.
+        """
+        seq_size = self.manifest["seq_size"]
+        lengths = np.array([len(row) for row in input_ids], dtype=np.int32)
+        if len(lengths) and lengths.max() > seq_size:
+            raise ValueError(f"Rows must have at most {seq_size} tokens. Got: {lengths.max()}")
+        self.n_tokens_histogram.update(n_tokens if n_tokens is not None else lengths.tolist())
+        tokens = np.full(
+            (len(input_ids), seq_size), self.manifest["pad_token_id"], dtype=TOKEN_DTYPES[self.manifest["dtype"]]
+        )
+        for i, row in enumerate(input_ids):
+            tokens[i, : len(row)] = row
+        self._add_rows(tokens=tokens, lengths=lengths)
+
+    def close(self):
+        self.manifest["n_tokens_histogram"] = dict(sorted(self.n_tokens_histogram.items()))
+        super().close()
+
+
+class TokenStore(ShardReader, torch.utils.data.Dataset):
+    """
+    Serves the rows of a store made by `TokenStoreWriter` as `{"input_ids": tensor}` samples.
+
+    Shards are memory-mapped copy-on-write & each row is a zero-copy tensor view of its shard, so opening a store
+    reads nothing & rows are only read when collated.
+    Samples include each row's unpadded "length" so collators can build its attention mask, with `trim=True` rows are
+    also cut to their length for dynamic padding.
+    """
+
+    def __init__(self, path, trim=False):
+        super().__init__(path)
+        self.trim = trim
+
+    def columns(self):
+        return token_columns(self.manifest)
+
+    @property
+    def seq_size(self):
+        return self.manifest["seq_size"]
+
+    @property
+    def n_tokens_histogram(self):
+        """
+        Number of samples with each untruncated length.
+        """
+        return collections.Counter({int(length): n for length, n in self.manifest["n_tokens_histogram"].items()})
+
+    def lengths(self):
+        """
+        Length of every row (after truncation), as one array.
+        """
+        return self._column(1)
+
+    def __getitem__(self, index):
+        (tokens, lengths), row = self._locate(index)
+        input_ids = torch.from_numpy(tokens[row])
+        length = int(lengths[row])
+        if self.trim:
+            input_ids = input_ids[:length]
+        return {"input_ids": input_ids, "length": length}
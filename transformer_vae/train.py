@@ -1,13 +1,17 @@
 """
     Train Transformer-VAEs using the Huggingface Trainer with Weights and Biasis.
 """
+import collections
+import json
 import logging
 import os
 import sys
 from dataclasses import dataclass, field
 from typing import Optional
 
-from datasets import load_dataset
+import torch
+from torch.utils.data import Subset
+from datasets import Dataset, DatasetDict, load_dataset
 import transformers
 from transformers import (
     AutoTokenizer,
@@ -20,10 +24,13 @@ from transformers.integrations import is_wandb_available
 from transformers.trainer_utils import is_main_process
 
 from transformer_vae.trainer import VAE_Trainer
-from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding
+from transformer_vae.data_collator import DataCollatorForLanguageAutoencoding, DynamicPaddingDataCollatorForLanguageAutoencoding
 from transformer_vae.trainer_callback import TellModelGlobalStep
-from transformer_vae.model import T5_VAE_Model, Funnel_VAE_Model, Funnel_T5_VAE_Model, Funnel_gpt2_VAE_Model
+from transformer_vae.token_store import TokenStore
+from transformer_vae.sample_reader import DEFAULT_SEPARATOR, MultilineSampleReader
+from transformer_vae.model import QUANTIZED_WEIGHTS_NAME, T5_VAE_Model, Funnel_VAE_Model, Funnel_T5_VAE_Model, Funnel_gpt2_VAE_Model
 from transformer_vae.sequence_checks import SEQ_CHECKS
+from transformer_vae.mmd import MMD_KERNELS, MMD_ESTIMATORS
 from transformer_vae.config import T5_VAE_Config, Funnel_VAE_Config, Funnel_T5_VAE_Config, Funnel_gpt2_VAE_Config
 
 
@@ -53,6 +60,10 @@ class VAE_TrainingArguments(TrainingArguments):
         default=20,
         metadata={"help": "The maximum length of sequences to be generated from latent points during evaluation."},
     )
+    generate_batch_size: int = field(
+        default=64,
+        metadata={"help": "Number of latent points to generate sequences from at once during evaluation."},
+    )
     n_random_samples: int = field(
         default=10,
         metadata={"help": "Number of random latent codes to sample from during evaluation."},
@@ -141,7 +152,35 @@ class ModelArguments:
     mmd_batch_size: int = field(
         default=None,
         metadata={
-            "help": "Run multuple, smaller batches for MMD-VAE regularisation loss (training batch size must be divisible by the MMD batch size)."
+            "help": "Run multuple, smaller batches for MMD-VAE regularisation loss (if the training batch size isn't divisible by the MMD batch size the last MMD batch is smaller)."
+        },
+    )
+    mmd_kernel: str = field(
+        default="gaussian",
+        metadata={"help": f"Kernel to use in the MMD-VAE regularisation loss. Options: {', '.join(MMD_KERNELS.keys())}"},
+    )
+    mmd_block_size: int = field(
+        default=1_024,
+        metadata={"help": "Compute MMD kernel values for this many latent codes at once, lower to save memory."},
+    )
+    mmd_estimator: str = field(
+        default="exact",
+        metadata={
+            "help": f"How to estimate the MMD-VAE regularisation loss, all but `exact` take linear time. Options: {', '.join(MMD_ESTIMATORS.keys())}"
+        },
+    )
+    mmd_n_features: int = field(
+        default=1_024,
+        metadata={"help": "Number of random Fourier features to use with the `rff` MMD estimator."},
+    )
+    mmd_estimator_block_size: int = field(
+        default=32,
+        metadata={"help": "Number of latent codes in each block of the `block` MMD estimator."},
+    )
+    distributed_mmd: bool = field(
+        default=False,
+        metadata={
+            "help": "In distributed training gather latent codes from all processes for MMD-VAE regularisation, so adding processes grows the MMD batch."
         },
     )
     dont_use_reg_loss: bool = field(
@@ -166,6 +205,10 @@ class ModelArguments:
         default=11,
         metadata={"help": "If using a skip connection, gradually zero the connection."},
     )
+    debug_checks: bool = field(
+        default=False,
+        metadata={"help": "Run extra checks on model inputs, these wait on the device so slow down training."},
+    )
     n_latent_tokens: int = field(
         default=None,
         metadata={
@@ -216,11 +259,29 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "An optional input evaluation data file to evaluate the perplexity on (a text file)."},
     )
+    multiline_samples: bool = field(
+        default=False,
+        metadata={"help": "Split txt files into samples on lines holding only `multiline_separator` rather than on each line."},
+    )
+    multiline_separator: str = field(
+        default=DEFAULT_SEPARATOR,
+        metadata={"help": "Line separating samples when using `multiline_samples`."},
+    )
+    token_store_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Train on token shards written by `python -m transformer_vae prepare` instead of tokenizing a dataset."
+        },
+    )
     overwrite_cache: bool = field(default=False, metadata={"help": "Overwrite the cached training and evaluation sets"})
     preprocessing_num_workers: Optional[int] = field(
         default=None,
         metadata={"help": "The number of processes to use for the preprocessing."},
     )
+    preprocessing_batch_size: int = field(
+        default=1_000,
+        metadata={"help": "Number of samples each preprocessing process tokenizes & writes at a time, bounds memory use."},
+    )
     mlm_probability: float = field(
         default=0.0, metadata={"help": "Ratio of tokens to mask for masked language modeling loss"}
     )
@@ -236,10 +297,21 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "How many classes in the data, found using a ClassLabel column if none given."},
     )
+    no_dynamic_padding: bool = field(
+        default=False,
+        metadata={
+            "help": "Always pad to `set_seq_size`, by default models that allow it pad each batch to its longest sequence."
+        },
+    )
 
     def __post_init__(self):
-        if self.dataset_name is None and self.train_file is None and self.validation_file is None:
-            raise ValueError("Need either a dataset name or a training/validation file.")
+        if (
+            self.dataset_name is None
+            and self.train_file is None
+            and self.validation_file is None
+            and self.token_store_dir is None
+        ):
+            raise ValueError("Need either a dataset name, a training/validation file or a token store.")
         else:
             if self.train_file is not None:
                 extension = self.train_file.split(".")[-1]
@@ -247,35 +319,76 @@ class DataTrainingArguments:
             if self.validation_file is not None:
                 extension = self.validation_file.split(".")[-1]
                 assert extension in ["csv", "json", "txt"], "`validation_file` should be a csv, a json or a txt file."
+        if self.multiline_samples:
+            for data_file in [self.train_file, self.validation_file]:
+                if data_file is not None and not data_file.endswith(".txt"):
+                    raise ValueError(f"`multiline_samples` only splits txt files. Got: {data_file}")
 
 
-def check_seq_size(tokenizer, text_column_name, data_args, datasets, set_seq_size):
-    def tokenize_function(examples):
-        return tokenizer(examples[text_column_name], padding="longest", truncation=True)
-
-    tokenized_datasets = datasets.map(
-        tokenize_function,
-        batched=True,
-        batch_size=1_000,
-        num_proc=data_args.preprocessing_num_workers,
-        remove_columns=[text_column_name],
-        load_from_cache_file=not data_args.overwrite_cache,
-    )
+def length_stats(histogram, max_length, percentiles=(50, 90, 95, 99, 100)):
+    """
+    Summarise a `{n_tokens: n_samples}` histogram, counting samples longer than `max_length` as truncated.
 
-    max_seq_size = max(
-        max([len(row) for row in tokenized_datasets["train"]["input_ids"][::1_000]]),
-        max([len(row) for row in tokenized_datasets[data_args.validation_name]["input_ids"][::1_000]]),
-    )
+    Each percentile gives the shortest sequence size that fits at least that percent of samples.
+    """
+    n_samples = sum(histogram.values())
+    lengths = sorted(histogram)
+    cumulative = 0
+    percentile_lengths = {}
+    for length in lengths:
+        cumulative += histogram[length]
+        for percentile in percentiles:
+            if percentile not in percentile_lengths and cumulative >= n_samples * percentile / 100:
+                percentile_lengths[percentile] = length
+    return {
+        "n_samples": n_samples,
+        "max_length": lengths[-1] if lengths else 0,
+        "n_truncated": sum(n for length, n in histogram.items() if length > max_length),
+        "percentiles": percentile_lengths,
+        "histogram": {length: histogram[length] for length in lengths},
+    }
+
+
+def length_histogram(dataset, batch_size=1_000, overwrite_cache=False):
+    """
+    Count the untruncated `n_tokens` of each sample, reading the column chunk by chunk.
 
-    if max_seq_size > set_seq_size:
+    The histogram is cached as json next to the dataset's Arrow cache file so it is only counted once per tokenization.
+    """
+    cache_path = None
+    if dataset.cache_files:
+        cache_path = os.path.splitext(dataset.cache_files[0]["filename"])[0] + "_lengths.json"
+        if os.path.exists(cache_path) and not overwrite_cache:
+            with open(cache_path) as f:
+                return collections.Counter({int(length): n for length, n in json.load(f).items()})
+
+    histogram = collections.Counter()
+    with dataset.formatted_as(columns=["n_tokens"]):
+        for start in range(0, len(dataset), batch_size):
+            histogram.update(dataset[start : start + batch_size]["n_tokens"])
+
+    if cache_path is not None:
+        with open(cache_path, "w") as f:
+            json.dump(histogram, f)
+    return histogram
+
+
+def check_seq_size(stats, set_seq_size):
+    # percentiles are in increasing order so each size is listed with the largest share of samples it fits
+    fits = {length: percentile for percentile, length in stats["percentiles"].items()}
+    suggestions = ", ".join(f"{length} fits {percentile}%" for length, percentile in fits.items())
+    if stats["n_truncated"]:
         logger.warn(
             "Model has too short a sequence size for dataset, run with truncating & joining examples.\n"
-            f"Dataset max text column size: {max_seq_size} Model max sequence size: {set_seq_size}"
+            f"{stats['n_truncated']:,} of {stats['n_samples']:,} samples will be truncated, "
+            f"dataset max text column size: {stats['max_length']} Model max sequence size: {set_seq_size}\n"
+            f"Sequence sizes by share of samples that fit: {suggestions}"
         )
-    elif set_seq_size > max_seq_size:
+    elif set_seq_size > stats["max_length"]:
         logger.info(
             "Model can handle larger sequence size than present in the dataset.\n"
-            f"Dataset max text column size: {max_seq_size} Model max sequence size: {set_seq_size}"
+            f"Dataset max text column size: {stats['max_length']} Model max sequence size: {set_seq_size}\n"
+            f"Sequence sizes by share of samples that fit: {suggestions}"
         )
 
 
@@ -351,15 +464,75 @@ def get_datasets(data_args):
         data_files["train"] = data_args.train_file
     if data_args.validation_file is not None:
         data_files[data_args.validation_name] = data_args.validation_file
+    if data_args.multiline_samples:
+        return DatasetDict(
+            {split: load_multiline_samples(data_file, data_args) for split, data_file in data_files.items()}
+        )
     extension = data_args.train_file.split(".")[-1]
     if extension == "txt":
         extension = "text"
-    # TODO have this dataset split samples on some substring
     return load_dataset(extension, data_files=data_files)
     # See more about loading any type of standard or custom dataset (from files, python dict, pandas DataFrame, etc) at
     # https://huggingface.co/docs/datasets/loading_datasets.html.
 
 
+def load_multiline_samples(path, data_args):
+    """
+    Load a `<|endoftext|>` separated text file as a dataset with a "text" column, without reading the whole file.
+
+    Chunks of samples are read from a memory-mapped `MultilineSampleReader` & written straight to the Arrow cache,
+    spread across `preprocessing_num_workers`.
+    """
+    reader = MultilineSampleReader(path, data_args.multiline_separator)
+    if len(reader) == 0:
+        return Dataset.from_dict({"text": []})
+    chunk_size = data_args.preprocessing_batch_size
+    chunks = Dataset.from_dict({"start": list(range(0, len(reader), chunk_size))})
+
+    def read_chunks(batch):
+        return {"text": [text for start in batch["start"] for text in reader.texts(start, start + chunk_size)]}
+
+    num_proc = data_args.preprocessing_num_workers
+    return chunks.map(
+        read_chunks,
+        batched=True,
+        batch_size=1,
+        writer_batch_size=chunk_size,
+        num_proc=min(num_proc, len(chunks)) if num_proc else None,
+        remove_columns=["start"],
+        cache_file_name=os.path.join(reader.cache_dir, f"{reader.fingerprint}.arrow"),
+        load_from_cache_file=not data_args.overwrite_cache,
+    )
+
+
+def load_tokenizer(model_args):
+    if model_args.tokenizer_name:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_args.tokenizer_name, cache_dir=model_args.cache_dir, use_fast=model_args.use_fast_tokenizer
+        )
+        if 'gpt' in model_args.tokenizer_name:
+            tokenizer.pad_token = tokenizer.eos_token
+    elif model_args.model_path:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_args.model_path, cache_dir=model_args.cache_dir, use_fast=model_args.use_fast_tokenizer
+        )
+    elif model_args.transformer_name:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_args.transformer_name, cache_dir=model_args.cache_dir, use_fast=model_args.use_fast_tokenizer
+        )
+    else:
+        raise ValueError(
+            "You are instantiating a new tokenizer from scratch. This is not supported by this script."
+            "You can do it from another script, save it, and load it from here, using --tokenizer_name."
+        )
+
+    if model_args.set_seq_size:
+        tokenizer.model_max_length = model_args.set_seq_size
+    tokenizer.mask_token = tokenizer.unk_token
+
+    return tokenizer
+
+
 def load_model_and_tokenizer(model_args):
     # Distributed training:
     # The `.from_pretrained` methods guarantee that only one local process can concurrently
@@ -383,6 +556,12 @@ def load_model_and_tokenizer(model_args):
             encoded_seq_size=model_args.encoded_seq_size,
             n_previous_latent_codes=model_args.n_previous_latent_codes,
             mmd_batch_size=model_args.mmd_batch_size,
+            mmd_kernel=model_args.mmd_kernel,
+            mmd_block_size=model_args.mmd_block_size,
+            mmd_estimator=model_args.mmd_estimator,
+            mmd_n_features=model_args.mmd_n_features,
+            mmd_estimator_block_size=model_args.mmd_estimator_block_size,
+            distributed_mmd=model_args.distributed_mmd,
             use_reg_loss=(not model_args.dont_use_reg_loss),
             reg_schedule_k=model_args.reg_schedule_k,
             reg_schedule_b=model_args.reg_schedule_b,
@@ -390,6 +569,7 @@ def load_model_and_tokenizer(model_args):
             skip_schedule_b=model_args.skip_schedule_b,
             n_latent_tokens=model_args.n_latent_tokens,
             use_extra_logs=is_wandb_available(),
+            debug_checks=model_args.debug_checks,
             use_skip_connection=model_args.use_skip_connection,
             use_latent_dropout=model_args.use_latent_dropout,
             max_latent_dropout_rate=model_args.max_latent_dropout_rate,
@@ -398,46 +578,54 @@ def load_model_and_tokenizer(model_args):
         )
         logger.warning("You are instantiating a new config instance from scratch (still using T5 checkpoint).")
 
-    if model_args.tokenizer_name:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_args.tokenizer_name, cache_dir=model_args.cache_dir, use_fast=model_args.use_fast_tokenizer
-        )
-        if 'gpt' in model_args.tokenizer_name:
-            tokenizer.pad_token = tokenizer.eos_token
-    elif model_args.model_path:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_args.model_path, cache_dir=model_args.cache_dir, use_fast=model_args.use_fast_tokenizer
-        )
-    elif model_args.transformer_name:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_args.transformer_name, cache_dir=model_args.cache_dir, use_fast=model_args.use_fast_tokenizer
-        )
-    else:
-        raise ValueError(
-            "You are instantiating a new tokenizer from scratch. This is not supported by this script."
-            "You can do it from another script, save it, and load it from here, using --tokenizer_name."
-        )
+    tokenizer = load_tokenizer(model_args)
 
-    if model_args.model_path:
-        model = MODEL[model_args.transformer_type].from_pretrained(
-            model_args.model_path,
-            from_tf=bool(".ckpt" in model_args.model_path),
-            config=config,
-            cache_dir=model_args.cache_dir,
-        )
+    if model_args.model_path and os.path.exists(os.path.join(model_args.model_path, QUANTIZED_WEIGHTS_NAME)):
+        logger.info("Loading int8 quantized model")
+        # quantized layers can't be resized, the checkpoint already matches its tokenizer
+        model = MODEL[model_args.transformer_type].from_quantized(model_args.model_path)
     else:
-        logger.info("Training new model from scratch")
-        model = MODEL[model_args.transformer_type](config)
-
-    model.resize_token_embeddings(len(tokenizer))
-    if model_args.set_seq_size:
-        tokenizer.model_max_length = model_args.set_seq_size
-    tokenizer.mask_token = tokenizer.unk_token
+        if model_args.model_path:
+            model = MODEL[model_args.transformer_type].from_pretrained(
+                model_args.model_path,
+                from_tf=bool(".ckpt" in model_args.model_path),
+                config=config,
+                cache_dir=model_args.cache_dir,
+            )
+        else:
+            logger.info("Training new model from scratch")
+            model = MODEL[model_args.transformer_type](config)
+        model.resize_token_embeddings(len(tokenizer))
 
     return model, tokenizer
 
 
-def preprocess_datasets(training_args, data_args, model_args, tokenizer, datasets):
+def tokenize_samples(tokenizer, texts):
+    """
+    Tokenize texts truncated to `tokenizer.model_max_length`, also returns each text's untruncated number of tokens.
+    """
+    n_special_tokens = tokenizer.num_special_tokens_to_add()
+    max_length = tokenizer.model_max_length - n_special_tokens
+    # tokenize without special tokens so each sample's untruncated size is known without tokenizing it again
+    rows = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    input_ids = [tokenizer.build_inputs_with_special_tokens(row[:max_length]) for row in rows]
+    return input_ids, [len(row) + n_special_tokens for row in rows]
+
+
+def uses_dynamic_padding(data_args, config):
+    return config is not None and config.allows_dynamic_padding and not data_args.no_dynamic_padding
+
+
+def get_data_collator(data_args, tokenizer, config, dynamic_padding):
+    if dynamic_padding:
+        logger.info("Padding each batch to its longest sequence.")
+        return DynamicPaddingDataCollatorForLanguageAutoencoding(
+            tokenizer=tokenizer, mlm_probability=data_args.mlm_probability, min_length=config.min_seq_size
+        )
+    return DataCollatorForLanguageAutoencoding(tokenizer=tokenizer, mlm_probability=data_args.mlm_probability)
+
+
+def preprocess_datasets(training_args, data_args, model_args, tokenizer, datasets, config=None):
     # Add class_label if needed
     if training_args.test_classification:
         if data_args.classification_column != "class_label":
@@ -465,29 +653,90 @@ def preprocess_datasets(training_args, data_args, model_args, tokenizer, dataset
     if text_column_name != "text":
         logger.info(f'Using column "{text_column_name}" as text column.')
 
-    if model_args.set_seq_size:
-        check_seq_size(tokenizer, text_column_name, data_args, datasets, model_args.set_seq_size)
+    # models that allow it pad each batch to its longest sequence, so store unpadded sequences & their lengths
+    dynamic_padding = uses_dynamic_padding(data_args, config)
+    max_length = tokenizer.model_max_length
 
     def tokenize_function(examples):
-        return tokenizer(examples[text_column_name], padding="max_length", truncation=True)
+        input_ids, n_tokens = tokenize_samples(tokenizer, examples[text_column_name])
+        if dynamic_padding:
+            batch = tokenizer.pad({"input_ids": input_ids}, padding=False)
+            batch["length"] = [len(row) for row in input_ids]
+        else:
+            # pad to the model's sequence size, not each chunk's longest sample, so all chunks get the same length
+            batch = tokenizer.pad({"input_ids": input_ids}, padding="max_length", max_length=max_length)
+        batch["n_tokens"] = n_tokens
+        return batch
 
+    # tokenize & write to the Arrow cache chunk by chunk so memory use doesn't grow with the dataset
     tokenized_datasets = datasets.map(
         tokenize_function,
         batched=True,
-        batch_size=None,  # apply tokenize_function to whole dataset at once (ensures longest length is global)
+        batch_size=data_args.preprocessing_batch_size,
+        writer_batch_size=data_args.preprocessing_batch_size,
         num_proc=data_args.preprocessing_num_workers,
         remove_columns=[text_column_name],
         load_from_cache_file=not data_args.overwrite_cache,
     )
 
+    if model_args.set_seq_size:
+        histogram = collections.Counter()
+        for dataset in tokenized_datasets.values():
+            histogram.update(
+                length_histogram(dataset, data_args.preprocessing_batch_size, overwrite_cache=data_args.overwrite_cache)
+            )
+        check_seq_size(length_stats(histogram, max_length), model_args.set_seq_size)
+
     if training_args.max_validation_size:
         tokenized_datasets[data_args.validation_name] = tokenized_datasets[data_args.validation_name].train_test_split(
             training_args.max_validation_size
         )["test"]
 
-    data_collator = DataCollatorForLanguageAutoencoding(tokenizer=tokenizer, mlm_probability=data_args.mlm_probability)
+    return get_data_collator(data_args, tokenizer, config, dynamic_padding), tokenized_datasets
 
-    return data_collator, tokenized_datasets
+
+def load_token_stores(training_args, data_args, model_args, tokenizer, config):
+    """
+    Open the train & validation token stores written by `python -m transformer_vae prepare`.
+    """
+    if training_args.test_classification:
+        raise ValueError("Token stores only hold token ids, so can't be used with `test_classification`.")
+    dynamic_padding = uses_dynamic_padding(data_args, config)
+    token_stores = {}
+    for split in ["train", data_args.validation_name]:
+        path = os.path.join(data_args.token_store_dir, split)
+        if not os.path.exists(path):
+            needed = training_args.do_train if split == "train" else training_args.do_eval
+            if needed:
+                raise ValueError(
+                    f"Token store has no {split} split. Expected the output of `python -m transformer_vae prepare` "
+                    f"at: {path}"
+                )
+            continue
+        token_stores[split] = TokenStore(path, trim=dynamic_padding)
+        if token_stores[split].manifest["vocab_size"] != len(tokenizer):
+            raise ValueError(
+                f"Token store was made with a different tokenizer. Got vocab size: {len(tokenizer)} "
+                f"Expected: {token_stores[split].manifest['vocab_size']}"
+            )
+        if token_stores[split].seq_size != tokenizer.model_max_length:
+            raise ValueError(
+                f"Token store rows have a different sequence size, re-run `prepare` with this `set_seq_size`. "
+                f"Got: {tokenizer.model_max_length} Expected: {token_stores[split].seq_size}"
+            )
+
+    if model_args.set_seq_size:
+        histogram = collections.Counter()
+        for token_store in token_stores.values():
+            histogram.update(token_store.n_tokens_histogram)
+        check_seq_size(length_stats(histogram, tokenizer.model_max_length), model_args.set_seq_size)
+
+    if training_args.max_validation_size and data_args.validation_name in token_stores:
+        validation = token_stores[data_args.validation_name]
+        indices = torch.randperm(len(validation))[: training_args.max_validation_size].tolist()
+        token_stores[data_args.validation_name] = Subset(validation, indices)
+
+    return get_data_collator(data_args, tokenizer, config, dynamic_padding), token_stores
 
 
 def get_optimizers(training_args, model):
@@ -518,17 +767,30 @@ def main():
     # Set seed before initializing model.
     set_seed(training_args.seed)
 
-    datasets = get_datasets(data_args)
+    datasets = get_datasets(data_args) if data_args.token_store_dir is None else None
 
     model, tokenizer = load_model_and_tokenizer(model_args)
 
-    data_collator, tokenized_datasets = preprocess_datasets(training_args, data_args, model_args, tokenizer, datasets)
+    train_lengths = None
+    if data_args.token_store_dir is not None:
+        data_collator, tokenized_datasets = load_token_stores(
+            training_args, data_args, model_args, tokenizer, config=model.config
+        )
+        if training_args.do_train and tokenized_datasets["train"].trim:
+            train_lengths = tokenized_datasets["train"].lengths().tolist()
+    else:
+        data_collator, tokenized_datasets = preprocess_datasets(
+            training_args, data_args, model_args, tokenizer, datasets, config=model.config
+        )
+        if training_args.do_train and "length" in tokenized_datasets["train"].column_names:
+            train_lengths = list(tokenized_datasets["train"]["length"])
 
     # Initialize our Trainer
     trainer = VAE_Trainer(
         model=model,
         args=training_args,
         train_dataset=tokenized_datasets["train"] if training_args.do_train else None,
+        train_lengths=train_lengths,
         eval_dataset=tokenized_datasets[data_args.validation_name] if training_args.do_eval else None,
         tokenizer=tokenizer,
         data_collator=data_collator,
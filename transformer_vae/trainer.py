@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-from tqdm import tqdm
 import logging
 from typing import Optional, Dict, List, Tuple, Union, Any
 from torch.utils.data.dataset import Dataset
@@ -18,6 +17,7 @@ from transformers.integrations import (
     MLflowCallback,
 )
 
+from transformer_vae.sampler import LengthGroupedSampler
 from transformer_vae.sequence_checks import SEQ_CHECKS
 from transformer_vae.trainer_callback import WandbCallbackUseModelLogs
 from transformer_vae.sklearn import train_svm
@@ -46,17 +46,38 @@ for logger_integration in NOT_ALLOWED_LOGGERS:
 
 
 class VAE_Trainer(trainer_script.Trainer):
-    def __init__(self, args=None, **kwargs):
+    def __init__(self, args=None, train_lengths=None, **kwargs):
         if args:
             self.test_classification = args.test_classification
+        # training sequence lengths, when given batches hold sequences of similar lengths for dynamic padding
+        self.train_lengths = train_lengths
         super().__init__(args=args, **kwargs)
 
-    def _text_from_latent(self, latent):
-        # TODO can I do many latents in parallel?
-        generation = self.model.generate(
-            latent=latent, bos_token_id=self.model.decoder_start_token_id, min_length=self.args.generate_min_len, max_length=self.args.generate_max_len
+    def _get_train_sampler(self):
+        if self.train_lengths is None or self.args.local_rank != -1 or trainer_script.is_torch_tpu_available():
+            return super()._get_train_sampler()
+        return LengthGroupedSampler(
+            self.train_lengths,
+            self.args.train_batch_size,
+            max_length=self.model.config.transformer.n_positions,
+            min_length=self.model.config.min_seq_size,
+            seed=self.args.seed,
+        )
+
+    @property
+    def _generate_kwargs(self):
+        return dict(
+            tokenizer=self.tokenizer,
+            batch_size=self.args.generate_batch_size,
+            min_length=self.args.generate_min_len,
+            max_length=self.args.generate_max_len,
         )
-        return self.tokenizer.decode(generation[0].tolist(), skip_special_tokens=True)
+
+    def _texts_from_latents(self, latents):
+        return self.model.decode_latents(latents, **self._generate_kwargs).texts
+
+    def _text_from_latent(self, latent):
+        return self._texts_from_latents(latent.view(1, -1))[0]
 
     def _interpolate_samples(self, eval_dataset):
         mini_eval_dataloader_iter = iter(
@@ -68,22 +89,19 @@ class VAE_Trainer(trainer_script.Trainer):
             )
         )
         samples = self._prepare_inputs(next(mini_eval_dataloader_iter))
-        latents = self.model(**samples).latent
-        start_latent, end_latent = latents[0].view(1, -1), latents[1].view(1, -1)
-        latent_diff = end_latent - start_latent
+        latents = self.model.encode(samples["input_ids"], samples.get("attention_mask"))
 
         seq_check_results = 0
         seq_check = SEQ_CHECKS[self.args.seq_check]
         table = wandb.Table(columns=["Interpolation Ratio", "Text", "Valid"])
         table.add_data(-10, self.tokenizer.decode(samples["input_ids"][0]), True)
 
-        for i in tqdm(range(11), desc="Sampling from interpolated latent points"):
+        texts = self.model.interpolate(latents[0], latents[1], steps=10, **self._generate_kwargs).texts[0]
+        for i, text in enumerate(texts):
             ratio = i / 10
-            latent = start_latent + ratio * latent_diff
-            text = self._text_from_latent(latent)
             valid = seq_check(text)
             table.add_data(ratio, text, valid)
-            if ratio > 0 and i < 1:
+            if 0 < i < 10:
                 seq_check_results += int(valid)
 
         table.add_data(10, self.tokenizer.decode(samples["input_ids"][1]), True)
@@ -95,14 +113,12 @@ class VAE_Trainer(trainer_script.Trainer):
             )
 
     def _random_samples(self):
-        # TODO can I greedy decode these in parallel?
         table = wandb.Table(columns=["Text", "Valid"])
         latent_points = torch.randn(self.args.n_random_samples, self.model.config.latent_size, device=self.model.device)
         seq_check_results = 0
         seq_check = SEQ_CHECKS[self.args.seq_check]
 
-        for i in tqdm(range(latent_points.size(0)), desc="Sampling from random latent points"):
-            text = self._text_from_latent(latent_points[i].view(1, -1))
+        for text in self._texts_from_latents(latent_points):
             valid = seq_check(text)
             table.add_data(text, valid)
             seq_check_results += int(valid)
@@ -122,9 +138,9 @@ class VAE_Trainer(trainer_script.Trainer):
                 class_label = inputs.pop("class_label")
 
             inputs = self._prepare_inputs(inputs)
-            outputs = self.model(**inputs)
+            latent = self.model.encode(inputs["input_ids"], attention_mask=inputs.get("attention_mask"))
 
-            row = [outputs.get("latent").tolist()]
+            row = [latent.tolist()]
             if self.test_classification:
                 row.append(class_label.tolist())  # type: ignore
 
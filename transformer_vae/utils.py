@@ -1,3 +1,8 @@
+import hashlib
+import math
+import torch
+
+
 def assertEqual(actual, expected, msg, first="Got", second="Expected"):
     if actual != expected:
         raise ValueError(msg + f' {first}: "{actual}" {second}: "{expected}"')
@@ -6,3 +11,83 @@ def assertEqual(actual, expected, msg, first="Got", second="Expected"):
 def assertIn(actual, expected, msg, first="Got", second="Expected one of"):
     if actual not in expected:
         raise ValueError(msg + f' {first}: "{actual}" {second}: {expected}')
+
+
+def sigmoid(x):
+    # plain python so schedules don't need a round trip to the device
+    if x >= 0:
+        return 1 / (1 + math.exp(-x))
+    z = math.exp(x)
+    return z / (1 + z)
+
+
+class MetricsAccumulator:
+    """
+    Sums training metrics (floats or tensors) without reading tensors back from the device.
+    Tensors are only read when `pop_means` is called at logging time.
+    """
+
+    def __init__(self, keys=()):
+        self.keys = tuple(keys)
+        self._reset()
+
+    def _reset(self):
+        self._totals = {k: 0.0 for k in self.keys}
+        self._n_updates = 0
+
+    def add(self, **metrics):
+        self._n_updates += 1
+        for k, v in metrics.items():
+            if isinstance(v, torch.Tensor):
+                v = v.detach()
+            self._totals[k] = self._totals.get(k, 0.0) + v
+
+    def pop_means(self):
+        """
+        Gets metrics averaged over the updates since the last call & resets them.
+        """
+        if self._n_updates < 1:
+            return {}
+        tensor_keys = [k for k, v in self._totals.items() if isinstance(v, torch.Tensor)]
+        result = {k: float(v) for k, v in self._totals.items() if k not in tensor_keys}
+        if tensor_keys:
+            # read all tensors from the device at once
+            values = torch.stack([self._totals[k].float().view(()) for k in tensor_keys]).tolist()
+            result.update(zip(tensor_keys, values))
+        result = {k: result[k] / self._n_updates for k in self._totals}
+        self._reset()
+        return result
+
+
+def _hash_state(hasher, value):
+    """
+    Hash a `state_dict` entry, quantized modules also store tuples of packed params & `torch.dtype` entries.
+    """
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu()
+        if value.is_quantized:
+            if value.qscheme() in (torch.per_tensor_affine, torch.per_tensor_symmetric):
+                hasher.update(repr((value.q_scale(), value.q_zero_point())).encode())
+            else:
+                _hash_state(hasher, (value.q_per_channel_scales(), value.q_per_channel_zero_points()))
+            value = value.int_repr()
+        hasher.update(value.contiguous().numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _hash_state(hasher, item)
+    else:
+        hasher.update(repr(value).encode())
+
+
+def checkpoint_fingerprint(model):
+    """
+    Short hash of a model's config & weights, identifies the checkpoint that produced a set of latent codes.
+    """
+    hasher = hashlib.sha1(model.config.to_json_string().encode())
+    for name, value in sorted(model.state_dict().items()):
+        if ".latent_queue." in name:
+            # training state, doesn't change the model's outputs
+            continue
+        hasher.update(name.encode())
+        _hash_state(hasher, value)
+    return hasher.hexdigest()[:16]